@@ -1,20 +1,63 @@
 import math
+import numpy    as np
+from functools  import lru_cache
+from collections import namedtuple
 from units      import *
 from functions  import normalize
 from vector3d   import Vector3D
 from constants  import G_const
 from earth      import Earth
+from drag       import get_drag_table
+
+
+
+# geopotential heights of the tops of the layers [km]
+LAYERS          = [11, 20, 32, 47, 51, 71, 84.85]
+
+# properties of the atmosphere at an altitude, and the Mach number of a speed there
+AtmosphereState = namedtuple('AtmosphereState', ['rho', 'pressure', 'temperature', 'speed_of_sound', 'mach'])
+
 
 
 
 class Atmosphere(object):
 
 
+    def state(self, alt, speed=0.0):
+        ''' Calculates every property of the atmosphere from one evaluation of its layers.
+
+            Arguments:
+                alt: altitude [m], or an array of them.
+                speed: speed relative to the atmosphere [m/s], or an array of them.
+
+            Returns:
+                AtmosphereState of density [kg/m^3], pressure [Pascals], temperature [Kelvin],
+                speed of sound [m/s] and Mach number.
+        '''
+
+        if isinstance(alt, np.ndarray):
+            temp      = self.get_standard_temperature(self.get_geopotential(alt / 1000))
+            sound     = 331.5 + 0.60 * kelvin2celcius(temp)
+            return AtmosphereState(self.calc_rho(alt), self.calc_ambient_pressure(alt), temp, sound, speed / sound)
+
+        a             = alt / 1000                                              # convert to [ km ]
+        geopot_height = self.get_geopotential(a)                                # [ km ]
+        temp          = self.get_standard_temperature(geopot_height)            # [ Kelvin ]
+        standard_p    = self.get_standard_pressure(geopot_height, temp)         # [ Pascals ]
+        R             = 287.5                                                   # specific gas constant for dry air
+        sound         = 331.5 + 0.60 * kelvin2celcius(temp)                     # [ m/s ]
+
+        if standard_p > 0:
+            return AtmosphereState(standard_p / (R * temp), standard_p, temp, sound, normalize(speed, 0, sound))
+
+        return AtmosphereState(0.0, 0.0, temp, sound, normalize(speed, 0, sound))
+
+
     def calc_rho(self, alt):
         ''' Calculates atmospheric density.
 
             Arguments:
-                alt: altitude [km].
+                alt: altitude [km], or an array of them.
 
             Returns:
                 atmospheric density [kg/m^3].
@@ -26,6 +69,10 @@ class Atmosphere(object):
         standard_p    = self.get_standard_pressure(geopot_height, temp)         # [ Pascals ]
         R             = 287.5                                                   # specific gas constant for dry air
 
+        if isinstance(standard_p, np.ndarray):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(standard_p > 0, standard_p / (R * temp), 0.0)
+
         return standard_p / (R * temp) if standard_p > 0 else 0.0
 
 
@@ -33,7 +80,7 @@ class Atmosphere(object):
         ''' Setup function for get_standard_pressure.
 
             Arguments:
-                altitude [km]
+                altitude [km], or an array of them.
 
             Returns:
                 atmospheric pressure [Pascals].
@@ -44,6 +91,9 @@ class Atmosphere(object):
         temp          = self.get_standard_temperature(geopot_height)            # [ Kelvin ]
         standard_p    = self.get_standard_pressure(geopot_height, temp)         # [ Pascals ]
 
+        if isinstance(standard_p, np.ndarray):
+            return np.where(standard_p > 0, standard_p, 0.0)
+
         return standard_p if standard_p > 0 else 0.0
 
 
@@ -52,13 +102,24 @@ class Atmosphere(object):
         ''' Calculates standard atmosphere pressure up to 84.85 km.
 
             Arguments:
-                g: geopotential height [km].
-                t: temperature [Kelvin].
+                g: geopotential height [km], or an array of them.
+                t: temperature [Kelvin], or an array of them.
 
             Returns:
                 pressure [Pascals].
         '''
 
+        # np.select takes the first layer whose top is above, as the ladder below does
+        if isinstance(g, np.ndarray):
+            with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+                return np.select([g <= top for top in LAYERS], [
+                    101325   * np.power(288.15 / t, -5.255877),
+                    22632.06 * np.exp(-0.1577 * (g - 11)),
+                    5474.889 * np.power(216.65 / t, 34.16319),
+                    868.0187 * np.power(228.65 / t, 12.2011),
+                    110.9063 * np.exp(-0.1262 * (g - 47)),
+                    66.93887 * np.power(270.65 / t, -12.2011),
+                    3.956420 * np.power(214.65 / t, -17.0816)], 0.0)
 
         if g <= 11:
             return 101325   * math.pow(288.15 / t, -5.255877)
@@ -83,12 +144,22 @@ class Atmosphere(object):
         ''' Calculates standard temperature.
 
             Arguments:
-                g: geopotential [km].
+                g: geopotential [km], or an array of them.
 
             Returns:
                 temperature [Kelvin].
         '''
 
+        if isinstance(g, np.ndarray):
+            return np.select([g <= top for top in LAYERS], [
+                288.15 - (6.5 * g),
+                np.full(g.shape, 216.65),
+                196.65 + g,
+                228.65 + 2.8 * (g - 32),
+                np.full(g.shape, 270.65),
+                270.65 - 2.8 * (g - 51),
+                214.65 - 2 * (g - 71)], 0.0)
+
         if   g <= 11:
             return 288.15 - (6.5 * g)
         elif g <= 20:
@@ -129,7 +200,7 @@ class Atmosphere(object):
         ''' Calculates the speed of sound at a given altitude.
 
             Arguments:
-                alt: altitude [m].
+                alt: altitude [m], or an array of them.
 
             Returns:
                 speed [m/s].
@@ -150,64 +221,237 @@ class Atmosphere(object):
 
             Arguments:
                 cd: Drag Coefficient [unitless].
-                a: altitude [m].
-                s: speed [m/s].
+                a: altitude [m], or an array of them.
+                s: speed [m/s], or an array of them.
 
             Returns:
                 adjusted drag coefficient [unitless].
 
         '''
 
-        mach_1      = self.speed_of_sound(a)
-        mach_num    = normalize(s, 0, mach_1)
+        if isinstance(a, np.ndarray) or isinstance(s, np.ndarray):
+            return self.calc_mach_drag_coefficient(cd, s / self.speed_of_sound(a))
 
-        max         = cd * 2
+        return self.calc_mach_drag_coefficient(cd, normalize(s, 0, self.speed_of_sound(a)))
 
-        if 0.8 <= mach_num < 1.0:
-            drag_coef = cd + max * ((mach_num - 0.8) * 5)
-        elif 1.0 <= mach_num < 3.0:
-            drag_coef = cd + max * ((3.0 - mach_num) * 0.5)
-        else:
-            drag_coef = cd
 
-        return drag_coef
 
+    def calc_mach_drag_coefficient(self, cd, mach_num):
+        ''' Approximates a mach-number-adjusted drag coefficient from the 'transonic' DragTable,
+            see calc_drag_coefficient().
 
+            Arguments:
+                cd: Drag Coefficient [unitless].
+                mach_num: Mach number, or an array of them.
+
+            Returns:
+                adjusted drag coefficient [unitless].
+        '''
 
+        return get_drag_table('transonic', cd).coefficient(mach_num)
 
-    def calc_drag(self, component):
-        ''' Returns aerodynamic drag force in Newtons.
+
+
+
+    def calc_drag(self, component, altitude=None, velocity_rel=None, state=None, angle=0.0):
+        ''' Returns aerodynamic drag force in Newtons, with the drag coefficient of the
+            component's DragTable at the Mach number, or its C_d if it has no table.
 
             Arguments:
                 rocket [object].
                 stage [object] (optional).
+                altitude: overrides the component altitude [m] (optional).
+                velocity_rel: overrides the component relative velocity [Vector3D] (optional).
+                state: AtmosphereState at the altitude, if already evaluated (optional).
+                angle: angle of attack [rad] (optional).
 
             Returns:
                 drag force [Newtons].
          '''
 
-        # drag_coef = self.calc_drag_coefficient(rocket.C_d, rocket.altitude, rocket.velocity_rel.magnitude())
-        #
-        # if component:
-        #     rho = self.calc_rho(component.a)
-        #     return component.C_d * (rho * component.v.magnitude()**2 * 0.5) * component.x_A
-        # else:
-        #     rho = self.calc_rho(rocket.altitude)
-        #     return drag_coef * (rho * rocket.velocity_rel.magnitude()**2 * 0.5) * rocket.x_A
+        if altitude is None:
+            try:
+                altitude = component.altitude
+            except:
+                altitude = Earth.get_lat_lon(component.position)[2]
+
+        if velocity_rel is None:
+            velocity_rel = component.velocity_rel
+
+        speed = velocity_rel.magnitude()
+
+        if state is None:
+            state = self.state(altitude, speed)
+
+        rho = state.rho
+        table = getattr(component, 'drag_table', None)
+        drag_coef = component.C_d if table is None else table.coefficient(state.mach, angle)
+
+        return drag_coef * (rho * speed**2 * 0.5) * component.x_A
+
+
+
+class AtmosphereTable(Atmosphere):
+    ''' The standard atmosphere interpolated linearly on a grid of altitudes, precomputed
+        once per process, for scalar altitudes or arrays of them. Above the top of the model
+        at 84.85 km geopotential height, and below sea level, it returns what Atmosphere does.
+
+        With the default 10 m grid, the largest errors against Atmosphere from sea level to
+        the top of the model are, away from and within one grid step of the layer boundaries:
+            density             4e-7 relative       1e-4 relative
+            pressure            4e-7 relative       1e-4 relative
+            temperature         1e-7 K              7e-3 K
+            speed of sound      1e-7 m/s            4e-3 m/s
+        At the boundaries the table follows the kinks in the temperature profile and the steps
+        of up to 1e-4 in the pressure of Atmosphere, whose layers do not quite meet, across a
+        grid step rather than at once. The errors shrink with the square of the step away from
+        the boundaries, and with the step itself at them.
+    '''
+
+    def __init__(self, step=10.0):
+        ''' Arguments:
+                step: largest spacing of the grid [m].
+        '''
+
+        self.step, self.top, self.altitudes, self.arrays, self.lists, self.rows, self.slopes, self.above = calc_table(step)
+        self.size               = len(self.altitudes)
+        self.above_row          = tuple(self.above[column] for column in COLUMNS)
+
+
+
+    def state(self, alt, speed=0.0):
+        ''' Returns the AtmosphereState at an altitude [m] and speed [m/s], or at arrays of
+            them, interpolating every property from one lookup of the grid.
+        '''
+
+        if isinstance(alt, np.ndarray):
+            rho, pressure, temperature, sound = [self.interpolate(column, alt) for column in COLUMNS]
+            return AtmosphereState(rho, pressure, temperature, sound, speed / sound)
+
+        if alt < 0.0:
+            return Atmosphere.state(self, alt, speed)
+
+        if alt >= self.top:
+            rho, pressure, temperature, sound = self.above_row
+            return AtmosphereState(rho, pressure, temperature, sound, speed / sound)
+
+        x                       = alt / self.step
+        i                       = int(x)
+        f                       = x - i
+        low                     = self.rows[i]
+        slope                   = self.slopes[i]
+        sound                   = low[3] + slope[3] * f
+
+        return AtmosphereState(low[0] + slope[0] * f, low[1] + slope[1] * f, low[2] + slope[2] * f, sound, speed / sound)
+
+
+
+    def interpolate(self, column, alt):
+        ''' Returns a column of the table, 'rho', 'pressure', 'temperature' or
+            'speed_of_sound', at an altitude or an array of altitudes [m].
+        '''
+
+        if isinstance(alt, np.ndarray):
+            values              = np.interp(alt, self.altitudes, self.arrays[column], right=self.above[column])
+            below               = alt < 0.0
+            if below.any():
+                values[below]   = self.analytic(column, alt[below])
+            return values
+
+        if alt < 0.0:
+            return self.analytic(column, alt)
+        if alt >= self.top:
+            return self.above[column]
+
+        x                       = alt / self.step
+        i                       = int(x)
+        values                  = self.lists[column]
 
-        try:
-            altitude = component.altitude
-        except:
-            altitude = Earth.get_lat_lon(component.position)[2]
+        return values[i] + (values[i+1] - values[i]) * (x - i)
 
-        drag_coef = self.calc_drag_coefficient(component.C_d, altitude, component.velocity_rel.magnitude())
 
-        rho = self.calc_rho(altitude)
 
-        if component.C_d == 0.1:
-            print(altitude, rho)
+    def analytic(self, column, alt):
 
-        return component.C_d * (rho * component.velocity_rel.magnitude()**2 * 0.5) * component.x_A
+        return calc_analytic(Atmosphere(), column, alt)
+
+
+
+    def calc_rho(self, alt):
+
+        return self.interpolate('rho', alt)
+
+
+
+    def calc_ambient_pressure(self, alt):
+
+        return self.interpolate('pressure', alt)
+
+
+
+    def speed_of_sound(self, alt):
+
+        return self.interpolate('speed_of_sound', alt)
+
+
+
+
+# columns of the table, in the order of AtmosphereState
+COLUMNS     = ['rho', 'pressure', 'temperature', 'speed_of_sound']
+
+
+
+def calc_analytic(atmosphere, column, alt):
+    ''' Returns a column of the table from the standard atmosphere at an altitude [m]. '''
+
+    if column == 'rho':
+        return atmosphere.calc_rho(alt)
+    if column == 'pressure':
+        return atmosphere.calc_ambient_pressure(alt)
+    if column == 'temperature':
+        return atmosphere.get_standard_temperature(atmosphere.get_geopotential(alt / 1000))
+
+    return atmosphere.speed_of_sound(alt)
+
+
+
+@lru_cache(maxsize=None)
+def calc_table(step):
+    ''' Returns the grid of an AtmosphereTable: its spacing and top [m], the altitudes, the
+        columns as read only arrays and as lists, the rows of every column and their increments
+        to the next row, and the values above the top. The grid ends exactly at the top of the model, where pressure and
+        density drop to zero.
+    '''
+
+    atmosphere          = Atmosphere()
+    radius              = Earth.radius_poles / 1000
+    top                 = radius * 84.85 / (radius - 84.85) * 1000                  # [m] geometric altitude of the top
+    size                = int(math.ceil(top / step))
+    altitudes           = np.linspace(0.0, top, size + 1)
+    altitudes[-1]       = np.nextafter(top, 0.0)
+    arrays              = {}
+    lists               = {}
+    above               = {}
+
+    for column in COLUMNS:
+        values          = np.array([calc_analytic(atmosphere, column, a) for a in altitudes])
+        values.setflags(write=False)
+        arrays[column]  = values
+        lists[column]   = tuple(values.tolist())
+        above[column]   = calc_analytic(atmosphere, column, top * 1.001)
+
+    rows                = tuple(zip(*[lists[column] for column in COLUMNS]))
+    slopes              = tuple(tuple(h - l for l, h in zip(low, high)) for low, high in zip(rows, rows[1:] + rows[-1:]))
+    altitudes.setflags(write=False)
+
+    return top / size, top, altitudes, arrays, lists, rows, slopes, above
+
+
+
+def get_atmosphere(model='analytic'):
+    ''' Returns the atmosphere of Params.atmosphere, 'analytic' or 'table'. '''
+
+    return AtmosphereTable() if model == 'table' else Atmosphere()
 
 
 if __name__ == "__main__":
@@ -220,5 +464,41 @@ if __name__ == "__main__":
 
         print(c)
 
+    # largest error of the table against the standard atmosphere at random altitudes, away
+    # from and within a grid step of the layer boundaries
+    import time
+    table       = AtmosphereTable()
+    radius      = Earth.radius_poles
+    boundaries  = np.array([radius * g / (radius - g) for g in [11e3, 20e3, 32e3, 47e3, 51e3, 71e3]])
+    altitudes   = np.random.uniform(0.0, table.top, 100000)
+    near        = np.abs(altitudes[:, None] - boundaries[None, :]).min(axis=1) < table.step
+
+    for column in ['rho', 'pressure', 'temperature', 'speed_of_sound']:
+        exact   = np.array([calc_analytic(a, column, x) for x in altitudes])
+        scalar  = np.array([table.interpolate(column, x) for x in altitudes.tolist()])
+        array   = table.interpolate(column, altitudes)
+        error   = np.abs(scalar - exact)
+        print("%-16s relative error %.1e, at the boundaries %.1e, scalar and array agree: %r" % \
+            (column, (error / np.abs(exact))[~near].max(), (error / np.abs(exact))[near].max(), bool(np.allclose(scalar, array, rtol=1e-12, atol=0.0))))
+
+    # the standard atmosphere over arrays agrees with its scalar ladders
+    speeds      = np.random.uniform(0.0, 3000.0, len(altitudes))
+    print("Arrays agree with scalars, density: %r, pressure: %r, drag coefficient: %r" % \
+        (bool(np.allclose(a.calc_rho(altitudes), [a.calc_rho(x) for x in altitudes.tolist()], rtol=1e-14, atol=0.0)),
+         bool(np.allclose(a.calc_ambient_pressure(altitudes), [a.calc_ambient_pressure(x) for x in altitudes.tolist()], rtol=1e-14, atol=0.0)),
+         bool(np.array_equal(a.calc_drag_coefficient(0.26, altitudes, speeds), [a.calc_drag_coefficient(0.26, x, s) for x, s in zip(altitudes.tolist(), speeds.tolist())]))))
+
+    # one state holds what the separate calls return
+    states      = [a.state(x, 300.0) for x in altitudes[:1000].tolist()]
+    print("State agrees with the separate calls: %r" % all(s.rho == a.calc_rho(x) and s.pressure == a.calc_ambient_pressure(x) and s.speed_of_sound == a.speed_of_sound(x) \
+        for s, x in zip(states, altitudes[:1000].tolist())))
+
+    for model in [a, table]:
+        start   = time.time()
+        for x in altitudes[:20000].tolist():
+            model.calc_rho(x)
+            model.calc_ambient_pressure(x)
+        print("%-16s %.2f us per density and pressure" % (type(model).__name__, (time.time() - start) / 20000 * 1e6))
+
 
 # end
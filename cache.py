@@ -0,0 +1,322 @@
+'''
+Persistent cache of simulation results, shared between runs and processes.
+
+Results are stored in an SQLite file under a key hashed from every field of
+the Params they were computed with, the kind of result and the trajectory
+inputs, so the same configuration is only ever flown once. Every entry also
+records the version of the simulation code, a hash of its source files, and
+entries left by any other version are dropped when the cache is opened. The
+file is bounded in size, the least recently used entries are evicted first.
+
+Within a run, Memo keeps the results of a function in memory, for optimizers
+that evaluate nearly the same inputs again.
+'''
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+
+
+
+# fields that do not change a result, at any depth
+IGNORED     = ['cache', 'workers', 'memo_size']
+
+_version    = None
+_caches     = {}
+
+
+
+def canonical(value):
+    ''' Returns a JSON serializable form of a value, the same for equal values. Classes,
+        such as Params and the engine, are reduced to their name and public attributes,
+        objects to their class and attributes.
+    '''
+
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if hasattr(value, 'dtype'):
+        return canonical(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), canonical(v)) for k, v in value.items())
+    if inspect.isclass(value):
+        return {'class': value.__module__ + '.' + value.__qualname__, 'attributes': attributes(value, IGNORED)}
+    if hasattr(value, '__dict__'):
+        return {'object': type(value).__module__ + '.' + type(value).__qualname__, 'attributes': canonical(vars(value))}
+
+    return repr(value)
+
+
+
+def attributes(cls, ignored=[]):
+    ''' Returns the canonical public class attributes of a class, inherited ones included. '''
+
+    values      = {}
+
+    for name in dir(cls):
+        if name.startswith('_') or name in ignored:
+            continue
+        value   = getattr(cls, name)
+        if callable(value) and not inspect.isclass(value):
+            continue
+        values[name] = canonical(value)
+
+    return values
+
+
+
+def params_hash(params):
+    ''' Returns a hash of every field of a Params class. '''
+
+    return hashlib.sha256(json.dumps(attributes(params, IGNORED), sort_keys=True).encode()).hexdigest()
+
+
+
+def code_version():
+    ''' Returns a hash of the source of every module next to this one, computed once per process. '''
+
+    global _version
+
+    if _version is None:
+        directory   = os.path.dirname(os.path.abspath(__file__))
+        digest      = hashlib.sha256()
+        for root, folders, files in sorted(os.walk(directory)):
+            folders[:] = sorted(f for f in folders if not f.startswith('.') and f != '__pycache__')
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    with open(os.path.join(root, name), 'rb') as file:
+                        digest.update(name.encode() + file.read())
+        _version    = digest.hexdigest()
+
+    return _version
+
+
+
+def get_cache(params):
+    ''' Returns the cache at Params.cache, opened once per path, or None if it is not set. '''
+
+    path        = getattr(params, 'cache', None)
+
+    if path is None:
+        return None
+    if path not in _caches:
+        _caches.setdefault(path, ResultCache(path))
+
+    return _caches[path]
+
+
+
+
+class ResultCache(object):
+
+    def __init__(self, path, max_bytes=256*1024**2, version=None):
+        ''' Arguments:
+                path: SQLite file, created if missing.
+                max_bytes: largest total size of the stored results [bytes].
+                version: version of the simulation code, defaults to code_version().
+        '''
+
+        self.path           = path
+        self.max_bytes      = max_bytes
+        self.version        = code_version() if version is None else version
+        self.hits           = 0
+        self.misses         = 0
+        self.local          = threading.local()
+
+
+
+    def connect(self):
+        ''' Returns a connection of this thread and process, opening it and dropping entries
+            of other code versions on first use. Other threads and forked workers open their own.
+        '''
+
+        local           = self.local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=60.0)
+            local.pid   = os.getpid()
+            local.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, kind TEXT, version TEXT, value TEXT, size INTEGER, accessed REAL)')
+            local.connection.execute('CREATE INDEX IF NOT EXISTS accessed ON results (accessed)')
+            local.connection.execute('DELETE FROM results WHERE version != ?', (self.version,))
+            local.connection.commit()
+
+        return local.connection
+
+
+
+    def key(self, kind, params, **inputs):
+        ''' Returns the key of a result of a kind for Params and the trajectory inputs. '''
+
+        text    = json.dumps({'kind': kind, 'params': params_hash(params), 'inputs': canonical(inputs)}, sort_keys=True)
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+
+
+    def get(self, kind, params, **inputs):
+        ''' Returns a stored result, or None. '''
+
+        connection  = self.connect()
+        key         = self.key(kind, params, **inputs)
+        row         = connection.execute('SELECT value FROM results WHERE key = ? AND version = ?', (key, self.version)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits   += 1
+        connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        connection.commit()
+
+        return json.loads(row[0])
+
+
+
+    def put(self, kind, params, value, **inputs):
+        ''' Stores a JSON serializable result, then evicts the least recently used results
+            until the cache is within max_bytes.
+        '''
+
+        connection  = self.connect()
+        text        = json.dumps(canonical(value))
+        connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.key(kind, params, **inputs), kind, self.version, text, len(text), time.time()))
+        self.evict()
+        connection.commit()
+
+
+
+    def evict(self):
+
+        connection  = self.connect()
+        size        = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+        for key, length in connection.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if size <= self.max_bytes:
+                break
+            connection.execute('DELETE FROM results WHERE key = ?', (key,))
+            size    -= length
+
+
+
+    def clear(self):
+
+        connection  = self.connect()
+        connection.execute('DELETE FROM results')
+        connection.commit()
+
+
+
+    def __len__(self):
+
+        return self.connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+
+
+class Memo(object):
+
+    def __init__(self, function, maxsize=256, tolerance=1e-9):
+        ''' Calls a function, serving the results of inputs that round to the same multiples
+            of the tolerance from a bounded least recently used store.
+
+            Arguments:
+                function: called with numbers, or lists of numbers, and anything hashable.
+                maxsize: most results kept.
+                tolerance: inputs closer than this are the same evaluation.
+        '''
+
+        self.function       = function
+        self.maxsize        = maxsize
+        self.tolerance      = tolerance
+        self.results        = OrderedDict()
+        self.lock           = threading.Lock()
+        self.hits           = 0
+        self.misses         = 0
+
+
+
+    def key(self, value):
+        ''' Returns the quantized, hashable form of an input. '''
+
+        if isinstance(value, (list, tuple)) or hasattr(value, 'dtype'):
+            return tuple(self.key(v) for v in list(value))
+        if isinstance(value, float) or (isinstance(value, int) and not isinstance(value, bool)):
+            return int(round(value / self.tolerance))
+
+        return value
+
+
+
+    def __call__(self, *inputs):
+
+        key             = self.key(inputs)
+
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            self.misses += 1
+
+        # threads evaluating the same inputs at once each evaluate them
+        result          = self.function(*inputs)
+
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+        return result
+
+
+
+    def clear(self):
+
+        with self.lock:
+            self.results.clear()
+
+
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    from params import Params
+
+    path        = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+    cache       = ResultCache(path, max_bytes=400)
+
+    # equal configurations share a key, any changed field gives another
+    Variant     = type('Params', (Params,), {'apogee': Params.apogee + 1})
+    print('Params hash: %s, variant: %s' % (params_hash(Params)[:12], params_hash(Variant)[:12]))
+
+    cache.put('simulate', Params, 12.5, payload=100.0, pitchover_angle=1.25)
+    print('Stored: %r, other payload: %r, other params: %r' % \
+        (cache.get('simulate', Params, payload=100.0, pitchover_angle=1.25),
+         cache.get('simulate', Params, payload=101.0, pitchover_angle=1.25),
+         cache.get('simulate', Variant, payload=100.0, pitchover_angle=1.25)))
+
+    # the oldest results are evicted past max_bytes
+    for payload in range(50):
+        cache.put('simulate', Params, {'result': payload * 1.5}, payload=float(payload))
+    print('Entries after 50 puts within %i bytes: %i, hits: %i, misses: %i' % (cache.max_bytes, len(cache), cache.hits, cache.misses))
+
+    # another code version drops every entry
+    print('Entries seen by another code version: %i' % len(ResultCache(path, version='other')))
+
+    # inputs within the tolerance are served from memory, the oldest dropped past maxsize
+    square      = Memo(lambda x, ratios: x**2 + sum(ratios), maxsize=2, tolerance=1e-6)
+    for x in [1.0, 1.0 + 1e-8, 2.0, 3.0, 1.0]:
+        square(x, [3.0, 1.5])
+    print('Memo hits: %i, misses: %i, kept: %i' % (square.hits, square.misses, len(square.results)))
@@ -0,0 +1,204 @@
+'''
+Drag coefficients as tables of the Mach number, and optionally the angle of attack.
+
+Every component that flies through the atmosphere, the rocket, a spent stage and the
+fairing, carries a DragTable built once from Params.drag and its own reference C_d.
+The table is interpolated linearly, for a scalar Mach number in the step loop or for
+arrays of them in the ensemble, and held at its end values outside the tabulated range.
+'''
+
+import bisect
+import numpy    as np
+from functools  import lru_cache
+
+
+
+class DragTable(object):
+
+    def __init__(self, mach, cd, angles=None):
+        ''' Arguments:
+                mach: increasing Mach numbers of the table, at least two.
+                cd: drag coefficient at each Mach number [unitless], or with angles, a row
+                    of them for every angle of attack.
+                angles: increasing angles of attack of the rows [rad] (optional).
+        '''
+
+        self.mach           = [float(m) for m in mach]
+        self.angles         = None if angles is None else [float(a) for a in angles]
+        rows                = [cd] if angles is None else cd
+        self.rows           = [[float(c) for c in row] for row in rows]
+
+        if len(self.mach) < 2 or any(b <= a for a, b in zip(self.mach, self.mach[1:])):
+            raise ValueError('DragTable needs two or more increasing Mach numbers')
+        if any(len(row) != len(self.mach) for row in self.rows):
+            raise ValueError('DragTable needs a drag coefficient for every Mach number')
+        if self.angles is not None and (len(self.angles) != len(self.rows) or any(b <= a for a, b in zip(self.angles, self.angles[1:]))):
+            raise ValueError('DragTable needs a row for every one of its increasing angles of attack')
+
+        # increments to the next Mach number, per unit Mach, as np.interp computes them
+        self.slopes         = [[(high - low) / (b - a) for low, high, a, b in zip(row, row[1:], self.mach, self.mach[1:])] for row in self.rows]
+        self.arrays         = np.array(self.rows)
+
+        # the drag coefficient if it is the same at every Mach number and angle, or None
+        self.uniform        = self.rows[0][0] if all(c == self.rows[0][0] for row in self.rows for c in row) else None
+
+
+
+    def coefficient(self, mach, angle=0.0):
+        ''' Interpolates the drag coefficient.
+
+            Arguments:
+                mach: Mach number, or an array of them.
+                angle: angle of attack [rad], or an array of them, unused by tables without angles.
+
+            Returns:
+                drag coefficient [unitless], or an array of them.
+        '''
+
+        if isinstance(mach, np.ndarray) or isinstance(angle, np.ndarray):
+            return self.batch(mach, angle)
+
+        if self.angles is None:
+            return self.interpolate(0, mach)
+
+        j, f                = locate(self.angles, angle)
+        low                 = self.interpolate(j, mach)
+
+        return low + (self.interpolate(j + 1, mach) - low) * f if f else low
+
+
+
+    def interpolate(self, row, mach):
+        ''' Returns a row of the table at a scalar Mach number. '''
+
+        points              = self.mach
+
+        if mach <= points[0]:
+            return self.rows[row][0]
+        if mach >= points[-1]:
+            return self.rows[row][-1]
+
+        i                   = bisect.bisect_right(points, mach) - 1
+
+        return self.slopes[row][i] * (mach - points[i]) + self.rows[row][i]
+
+
+
+    def batch(self, mach, angle=0.0):
+        ''' Returns the drag coefficients of arrays of Mach numbers and angles of attack. '''
+
+        mach                = np.asarray(mach, dtype=float)
+
+        if self.angles is None:
+            return np.interp(mach, self.mach, self.arrays[0])
+
+        mach, angle         = np.broadcast_arrays(mach, np.asarray(angle, dtype=float))
+        rows                = np.array([np.interp(mach, self.mach, row) for row in self.arrays])
+        angles              = np.asarray(self.angles)
+        j                   = np.clip(np.searchsorted(angles, angle, side='right') - 1, 0, len(angles) - 2)
+        f                   = np.clip((angle - angles[j]) / (angles[j + 1] - angles[j]), 0.0, 1.0)
+        columns             = np.arange(mach.size).reshape(mach.shape)
+
+        return rows[j, columns] + (rows[j + 1, columns] - rows[j, columns]) * f
+
+
+
+
+def locate(points, x):
+    ''' Returns the index of the interval of increasing points that holds x, and the
+        fraction of the way across it, held at the ends.
+    '''
+
+    if x <= points[0]:
+        return 0, 0.0
+    if x >= points[-1]:
+        return len(points) - 2, 1.0
+
+    i                       = bisect.bisect_right(points, x) - 1
+
+    return i, (x - points[i]) / (points[i + 1] - points[i])
+
+
+
+def constant(cd):
+    ''' The same drag coefficient at every Mach number. '''
+
+    return DragTable([0.0, 1.0], [cd, cd])
+
+
+
+def transonic(cd):
+    ''' The drag coefficient rising from its subsonic value at Mach 0.8 to three times it at
+        Mach 1, and falling back by Mach 3.
+        Reference: https://history.nasa.gov/SP-367/f86.htm
+    '''
+
+    return DragTable([0.0, 0.8, 1.0, 3.0], [cd, cd, 3 * cd, cd])
+
+
+
+# profiles of Params.drag, by name
+PROFILES    = {'constant': constant, 'transonic': transonic}
+
+
+
+@lru_cache(maxsize=256)
+def calc_profile(profile, cd):
+    ''' Returns the DragTable of a named profile for a reference C_d, built once per process
+        and shared by every component that uses it.
+    '''
+
+    return PROFILES[profile](cd)
+
+
+
+def get_drag_table(profile, cd, component=None):
+    ''' Returns the DragTable of a component.
+
+        Arguments:
+            profile: Params.drag, a profile name or a DragTable, or a dict of them by component.
+            cd: reference drag coefficient of the component [unitless].
+            component: 'rocket', 'stage' or 'fairing'.
+
+        Returns:
+            DragTable.
+    '''
+
+    if isinstance(profile, dict):
+        profile     = profile[component]
+
+    if isinstance(profile, DragTable):
+        return profile
+
+    return calc_profile(profile, float(cd))
+
+
+
+
+if __name__ == '__main__':
+
+    import time
+
+    # the transonic profile is the shape Atmosphere.calc_mach_drag_coefficient approximated
+    table       = get_drag_table('transonic', 0.26)
+    machs       = np.random.uniform(0.0, 5.0, 100000)
+    bump        = np.where((0.8 <= machs) & (machs < 1.0), 0.26 + 0.52 * (machs - 0.8) * 5, np.where((1.0 <= machs) & (machs < 3.0), 0.26 + 0.52 * (3.0 - machs) * 0.5, 0.26))
+    scalar      = np.array([table.coefficient(m) for m in machs.tolist()])
+    print('Transonic profile matches the bump: %r, scalar and batch agree: %r' % \
+        (bool(np.allclose(scalar, bump, rtol=1e-12, atol=0.0)), bool(np.array_equal(scalar, table.coefficient(machs)))))
+
+    # a table by angle of attack, between its rows at angles between them
+    angled      = DragTable([0.0, 1.0, 2.0], [[0.3, 0.6, 0.4], [0.5, 1.0, 0.8]], angles=[0.0, 0.2])
+    angles      = np.random.uniform(-0.1, 0.3, len(machs))
+    scalar      = np.array([angled.coefficient(m, a) for m, a in zip(machs.tolist(), angles.tolist())])
+    print('Angle of attack, Mach 1 at 0.1 rad: %.3f, scalar and batch agree: %r' % \
+        (angled.coefficient(1.0, 0.1), bool(np.allclose(scalar, angled.coefficient(machs, angles), rtol=1e-14, atol=0.0))))
+    print('Uniform, constant: %r, transonic: %r' % (get_drag_table('constant', 0.26).uniform, table.uniform))
+
+    for name, call in [('scalar', lambda: [table.coefficient(m) for m in machs.tolist()]), ('batch', lambda: table.coefficient(machs))]:
+        start   = time.time()
+        call()
+        print('%-8s %.3f us per coefficient' % (name, (time.time() - start) / len(machs) * 1e6))
+
+
+# end
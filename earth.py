@@ -1,4 +1,5 @@
 import math
+import numpy      as np
 from vector3d   import Vector3D
 from constants  import G_const
 
@@ -103,6 +104,12 @@ class Earth(object):
 
         r1       = Earth.radius_equator
         r2       = Earth.radius_poles
+
+        if isinstance(lat, np.ndarray):
+            n    = (r1**2 * np.cos(lat))**2 + (r2**2 * np.sin(lat))**2
+            d    = (r1 * np.cos(lat))**2 + (r2 * np.sin(lat))**2
+            return np.sqrt(n/d)
+
         n        = (r1**2 * math.cos(lat))**2 + (r2**2 * math.sin(lat))**2
         d        = (r1 * math.cos(lat))**2 + (r2 * math.sin(lat))**2
         r        = math.sqrt(n/d)
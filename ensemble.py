@@ -0,0 +1,640 @@
+'''
+Lockstep simulation of an ensemble of vehicles.
+
+Pitchover sweeps, payload searches and dispersion studies fly many copies of the
+same vehicle that differ only in their inputs. Instead of running a Simulation
+for each, the ensemble holds the state of every member as arrays with one row
+per member: position and velocity in a shared StateArray, tank, nitrogen and
+fairing masses per stage, and the stage index, throttle and phase flags. Every
+step advances all members with the same NumPy operations. Members that have
+reached orbit, burned out or run to the end of the simulation are masked out.
+
+Each member follows Simulation.run_simulation with the 'constant' integrator at
+the fixed timestep. That covers the launch phase and, optionally, the coast to
+apogee and the circularization burn. The discrete events (staging, SECO,
+pitchover and orbit checks) update only the members they apply to. Afterwards
+the final state of each member is written back into its Rocket and Simulation,
+so a member can be analysed exactly like a serial run. Booster and fairing
+recovery, the geo transfer, event location and the analytic coast are not part
+of the ensemble.
+'''
+
+import orbital
+import numpy as np
+from collections.abc import Sequence
+from constants      import G_const, _u
+from vector3d       import Vector3D, Vector3DArray
+from earth          import Earth
+from atmosphere     import get_atmosphere
+from orbit          import Orbit
+from integrator     import StateArray
+from keplerian      import keplerian_orbit
+from simulation     import Simulation
+from rocket         import Rocket
+from params         import Config
+
+
+# member phases
+LAUNCH          = 0
+CIRCULARIZE     = 1
+DONE            = 2
+
+
+
+class Ensemble(object):
+
+    def __init__(self, rockets):
+        ''' Arguments:
+                rockets: one Rocket per member, with its payload and trajectory.pitchover_angle
+                    set. The ensemble flies them, and each holds its member's final state
+                    afterwards. Every member must have the same timestep and atmosphere
+                    model, which the ensemble steps through together.
+        '''
+
+        for name in ['timestep', 'atmosphere']:
+            if len(set([getattr(rocket.params, name) for rocket in rockets])) > 1:
+                raise ValueError('ensemble members differ in Params.%s, which they share' % name)
+
+        self.rockets                = rockets
+        self.simulations            = [Simulation(rocket, rocket.trajectory) for rocket in rockets]
+        self.size                   = len(rockets)
+        self.rows                   = np.arange(self.size)
+        self.dt                     = rockets[0].params.timestep
+        self.elapsed                = 0.0
+        self.launch_hold            = list(self.simulations[0].launch_hold)
+        self.atmosphere             = get_atmosphere(rockets[0].params.atmosphere)
+        self.sea_level_pressure     = self.atmosphere.calc_ambient_pressure(0.0)
+
+        for simulation in self.simulations:
+            simulation.rocket.orbit = False
+            simulation.engine_startup_sequence()
+
+        # per member and stage, masses [kg] and the constants of their flow
+        self.fuel                   = self.gather(lambda sim, stage, i: sum([tank.fuel_mass for tank in stage.tanks]))
+        self.lox                    = self.gather(lambda sim, stage, i: sum([tank.lox_mass  for tank in stage.tanks]))
+        self.n2                     = self.gather(lambda sim, stage, i: stage.nitrogen_tank.commodity_mass)
+        self.fairing                = self.gather(lambda sim, stage, i: stage.fairing_mass)
+        self.cores                  = self.gather(lambda sim, stage, i: sim.params.cores[i])
+        self.dry_mass               = self.gather(lambda sim, stage, i: stage.dry_mass) - self.cores * self.n2 - self.fairing     # dry mass less nitrogen and fairing
+        self.tanks                  = self.gather(lambda sim, stage, i: len(stage.tanks))
+        self.engines                = self.gather(lambda sim, stage, i: len(stage.engines) * sim.params.cores[i])
+        self.flow_rate              = self.gather(lambda sim, stage, i: sim.params.engine.flow_rate[sim.params.performance] * len(stage.engines))
+        self.purge                  = self.gather(lambda sim, stage, i: sim.params.engine.IPS_purge[stage.nitrogen_tank.commodity.id] * len(stage.engines))
+        self.stage_throttle         = self.gather(lambda sim, stage, i: sim.params.throttle[i])
+        self.fuel_resid             = self.gather(lambda sim, stage, i: stage.fuel_resid)
+        self.lox_resid              = self.gather(lambda sim, stage, i: stage.lox_resid)
+
+        # propellant left at burnout, the last stage keeps its circularization propellant
+        last                        = self.gather(lambda sim, stage, i: i + 1 == sim.params.stages) > 0
+        self.fuel_limit             = np.where(last, self.member(lambda sim: sim.circ_fuel)[:, None] + self.fuel_resid, self.fuel_resid + self.gather(lambda sim, stage, i: stage.fuel_shutdown))
+        self.lox_limit              = np.where(last, self.member(lambda sim: sim.circ_lox)[:, None]  + self.lox_resid,  self.lox_resid  + self.gather(lambda sim, stage, i: stage.lox_shutdown))
+        self.last_stage             = self.member(lambda sim: sim.params.stages - 1).astype(int)
+
+        # engine startup and shutdown quantities per stage, all tanks together
+        def sequence(name, commodity):
+            return self.gather(lambda sim, stage, i: getattr(sim.params.engine, name)[commodity] * len(stage.engines)) * (1 if commodity == 'N2' else self.tanks)
+
+        self.chill                  = {c: sequence('Chill', c)    for c in ['N2', 'LOx', 'Kerosene']}
+        self.start                  = {c: sequence('Start', c)    for c in ['N2', 'LOx', 'Kerosene']}
+        self.shutdown               = {c: sequence('Shutdown', c) for c in ['N2', 'LOx', 'Kerosene']}
+
+        # per member constants
+        self.ox_f_ratio             = self.member(lambda sim: sim.params.engine.ox_f_ratio)
+        self.thrust_vac             = self.member(lambda sim: sim.params.engine.thrust['VAC'])
+        self.thrust_sl              = self.member(lambda sim: sim.params.engine.thrust['SL'])
+        self.drag_tables            = self.group(lambda sim: sim.rocket.drag_table)
+
+        # tables that hold one coefficient need only the density
+        if all(table.uniform is not None for table, members in self.drag_tables):
+            self.drag_area          = self.member(lambda sim: sim.rocket.drag_table.uniform * sim.rocket.x_A)
+            self.drag_tables        = None
+        else:
+            self.drag_area          = self.member(lambda sim: sim.rocket.x_A)
+        self.fairing_mass           = self.member(lambda sim: sim.rocket.fairing.mass)
+        self.jettison               = self.member(lambda sim: sim.rocket.fairing.jettison)
+        self.pitchover              = np.array([sim.trajectory.pitchover for sim in self.simulations], dtype=float)
+        self.maneuver_step          = self.member(lambda sim: sim.trajectory.maneuver_step)
+        self.coast_time             = self.member(lambda sim: sim.trajectory.coast_time)
+        self.duration               = self.member(lambda sim: sim.params.duration)
+        self.target_apogee          = self.member(lambda sim: orbital.utilities.radius_from_altitude(sim.params.apogee*1000, body=orbital.earth))
+
+        # position and velocity, rows 2i inertial and 2i+1 relative for member i
+        self.states                 = StateArray(self.size)
+        for rocket in rockets:
+            state                   = rocket.stages[-1].state
+            self.states.allocate(state.position, state.velocity, state.position_rel, state.velocity_rel)
+
+        self.position               = self.states.y[0::2, :3]
+        self.velocity               = self.states.y[0::2, 3:]
+        self.velocity_rel           = self.states.y[1::2, 3:]
+        self.orientation            = np.array([rocket.orientation.points for rocket in rockets])
+        self.altitude               = self.member(lambda sim: sim.rocket.altitude)
+        self.mass                   = self.member(lambda sim: sim.rocket.mass)
+
+        # pitchover maneuvers, filled in as each member reaches the pitchover
+        length                      = max([sim.trajectory.intermediates + 2 for sim in self.simulations])
+        self.maneuver               = np.zeros((self.size, length, 3))
+        self.maneuver_length        = self.member(lambda sim: sim.trajectory.intermediates + 2).astype(int)
+        self.rotation_axis          = np.zeros((self.size, 3))
+
+        # flight status
+        self.phase                  = np.full(self.size, LAUNCH)
+        self.stage                  = np.zeros(self.size, dtype=int)
+        self.throttle               = self.member(lambda sim: sim.rocket.stages[0].throttle)
+        self.stage_separation       = np.ones(self.size)
+        self.separation_sequence    = np.zeros(self.size)
+        self.fairing_status         = np.ones(self.size)
+        self.pitchover_status       = np.zeros(self.size, dtype=int)
+        self.orbit                  = np.zeros(self.size, dtype=bool)
+        self.circ_burn              = np.zeros(self.size, dtype=int)                                        # 0 before, 1 during, -1 after the burn
+        self.apogee                 = np.zeros(self.size)                                                   # altitude at the last check, to find apogee
+        self.target_velocity        = np.full(self.size, np.inf)
+        self.end                    = np.zeros(self.size)                                                   # elapsed time at which each member finished
+
+
+
+    @classmethod
+    def from_params(cls, params, pitchover_angles=None, payloads=None):
+        ''' Builds an ensemble with a new Rocket per member.
+
+            Arguments:
+                params: Params or a Config for every member, or a sequence with one per member.
+                pitchover_angles: pitchover angle per member [deg] (optional).
+                payloads: payload mass per member [kg] (optional).
+        '''
+
+        # a Config is itself a tuple, any other sequence holds params per member
+        per_member          = isinstance(params, Sequence) and not isinstance(params, Config)
+        size                = max([len(x) for x in [pitchover_angles, payloads] if isinstance(x, (Sequence, np.ndarray))] + [len(params) if per_member else 1])
+        rockets             = []
+
+        for i in range(size):
+            rocket          = Rocket(params[i] if per_member else params)
+            if payloads is not None:
+                rocket.modify_payload(payloads[i])
+            if pitchover_angles is not None:
+                rocket.trajectory.pitchover_angle = pitchover_angles[i]
+            rockets.append(rocket)
+
+        return cls(rockets)
+
+
+
+    def member(self, f):
+        ''' Returns f(simulation) for every member as an array. '''
+
+        return np.array([f(sim) for sim in self.simulations], dtype=float)
+
+
+
+    def gather(self, f):
+        ''' Returns f(simulation, stage, stage number) for every member and stage as an (N, stages) array. '''
+
+        return np.array([[f(sim, stage, i) for i, stage in enumerate(sim.rocket.stages)] for sim in self.simulations], dtype=float)
+
+
+
+    def group(self, f):
+        ''' Returns the distinct objects f(simulation) of the members, each with a boolean mask
+            of the members that share it, so shared tables are evaluated once per step.
+        '''
+
+        objects             = [f(sim) for sim in self.simulations]
+        distinct            = list({id(o): o for o in objects}.values())
+
+        return [(o, np.array([other is o for other in objects])) for o in distinct]
+
+
+
+    def run(self, circularize=False):
+        ''' Flies every member through the launch phase, and through the coast and
+            circularization burn if circularize is True.
+
+            Returns:
+                a dict of results per member.
+        '''
+
+        self.circularize = circularize
+
+        while True:
+
+            self.check_launch_phase_status()
+            self.check_circularization_status()
+
+            running = self.phase != DONE
+            if not running.any():
+                break
+
+            self.update_state(running)
+
+        for i in range(self.size):
+            self.write_back(i)
+
+        return self.results()
+
+
+
+    def update_state(self, running):
+        ''' Advances every running member by one timestep. '''
+
+        dt                      = self.dt
+
+        if self.launch_hold[0] < self.launch_hold[1]:
+            self.launch_hold[0] += dt
+        else:
+            t0                  = self.elapsed
+            self.elapsed        = round(self.elapsed + dt, 9)
+            self.update_orientation(running)
+
+            acceleration        = self.calc_accel()
+            self.states.accel[0::2]     = acceleration
+            self.states.accel[1::2]     = acceleration
+            self.states.active[0::2]    = running
+            self.states.active[1::2]    = running
+            self.states.step(dt, t0)
+
+        coasting                = running & (self.stage_separation == 0)
+        self.separation_sequence[coasting] += dt
+        ignition                = coasting & (self.separation_sequence >= self.coast_time)
+        self.stage_separation[ignition]     = 1
+        self.separation_sequence[ignition]  = 0.0
+
+        self.update_mass(running)
+        self.altitude           = Vector3DArray(self.position).get_lat_lon()[2]
+
+
+
+    def update_orientation(self, running):
+        ''' Steers every running member as Simulation.update_rocket_orientation does. '''
+
+        elapsed                 = self.elapsed
+        start, end              = self.pitchover.T
+        up                      = Vector3DArray(self.position).unit().points
+
+        vertical                = running & (elapsed < start)
+        self.orientation[vertical] = up[vertical]
+
+        # first step at or past the pitchover start, the maneuver is built from the orientation then
+        begin                   = running & ~vertical & (self.pitchover_status == 0)
+        if begin.any():
+            self.orientation[begin] = up[begin]
+            for i in np.flatnonzero(begin):
+                self.calc_pitchover(i)
+            self.pitchover_status[begin] = 1
+
+        held                    = begin & (elapsed == start)
+        pitch                   = running & ~vertical & ~held & ((self.pitchover_status == 1) | (elapsed <= end))
+
+        if pitch.any():
+            i                   = np.floor((elapsed - start[pitch]) * (1/self.maneuver_step[pitch])).astype(int)
+            i                   = np.minimum(i, self.maneuver_length[pitch] - 1)
+            self.orientation[pitch] = self.maneuver[pitch, i]
+            self.pitchover_status[pitch & (elapsed >= end)] = 2
+
+        turn                    = running & ~vertical & ~held & ~pitch
+        prograde                = turn & self.orbit
+        self.orientation[prograde] = Vector3DArray(self.velocity[prograde]).unit().points
+
+        gravity_turn            = turn & ~self.orbit
+        if gravity_turn.any():
+            position            = Vector3DArray(self.position[gravity_turn])
+            v_angle             = position.angle(self.velocity_rel[gravity_turn])
+            o_angle             = position.angle(self.orientation[gravity_turn])
+
+            rows                = np.flatnonzero(gravity_turn)
+            behind              = o_angle < v_angle
+            past                = behind & (v_angle > np.radians(90.0))
+            follow              = behind & ~past
+
+            if past.any():
+                orientation     = Vector3DArray(self.orientation[rows[past]])
+                self.orientation[rows[past]] = orientation.rotate(self.rotation_axis[rows[past]], v_angle[past] - np.radians(90.0)).points
+            self.orientation[rows[follow]] = Vector3DArray(self.velocity_rel[rows[follow]]).unit().points
+
+
+
+    def calc_pitchover(self, i):
+        ''' Builds member i's pitchover maneuver with Trajectory.calc_pitchover at its current position. '''
+
+        rocket                  = self.rockets[i]
+        rocket.position.update(self.position[i].tolist())
+        rocket.orientation      = rocket.position.unit()
+        rocket.trajectory.calc_pitchover()
+
+        maneuver                = np.array(rocket.trajectory.pitchover_maneuver)
+        self.maneuver[i]        = maneuver[np.minimum(np.arange(self.maneuver.shape[1]), len(maneuver) - 1)]
+        self.rotation_axis[i]   = Vector3D(rocket.trajectory.rotation_axis.points).unit().points
+
+
+
+    def calc_accel(self):
+        ''' Returns the acceleration from thrust, drag and gravity of every member, as
+            Simulation.calc_accel does for the rocket's current state.
+        '''
+
+        rows                    = self.rows
+        stage                   = self.stage
+        altitude                = self.altitude
+        mass                    = self.mass
+
+        # thrust, interpolated between sea level and vacuum by the ambient pressure
+        pressure                = np.zeros(self.size)
+        low                     = altitude < 100000
+        pressure[low]           = self.atmosphere.calc_ambient_pressure(altitude[low])
+        pressure_norm           = np.clip(pressure / self.sea_level_pressure, 0.0, 1.0)
+        thrust                  = self.engines[rows, stage] * (self.thrust_vac - pressure_norm * (self.thrust_vac - self.thrust_sl))
+        thrust                  = thrust * self.throttle * self.stage_separation
+
+        acceleration            = Vector3DArray(self.orientation).unit().points * (thrust / mass)[:, None]
+
+        # drag, below 85 km
+        drag                    = np.zeros(self.size)
+        low                     = altitude < 85000
+        if low.any() and self.drag_tables is None:
+            rho                 = self.atmosphere.calc_rho(altitude[low])
+            speed               = Vector3DArray(self.velocity_rel[low]).magnitude()
+            drag[low]           = rho * speed**2 * 0.5 * self.drag_area[low]
+        elif low.any():
+            velocity_rel        = Vector3DArray(self.velocity_rel[low])
+            speed               = velocity_rel.magnitude()
+            state               = self.atmosphere.state(altitude[low], speed)
+            drag_coef           = np.empty(len(speed))
+            for table, members in self.drag_tables:
+                members         = members[low]
+                angle           = 0.0
+                if table.angles is not None:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        angle   = np.nan_to_num(Vector3DArray(self.orientation[low][members]).angle(velocity_rel.points[members]))
+                drag_coef[members] = table.coefficient(state.mach[members], angle)
+            drag[low]           = drag_coef * state.rho * speed**2 * 0.5 * self.drag_area[low]
+        acceleration            -= Vector3DArray(self.velocity_rel).unit().points * (drag / mass)[:, None]
+
+        # gravity
+        position                = Vector3DArray(self.position)
+        g                       = G_const * Earth.mass / position.magnitude() ** 2
+        acceleration            -= position.unit().points * g[:, None]
+
+        return acceleration
+
+
+
+    def update_mass(self, running):
+        ''' Expends the propellant and nitrogen of every running member over a timestep. '''
+
+        rows                    = self.rows
+        stage                   = self.stage
+        dt                      = np.where(running, self.dt, 0.0)
+
+        flow_rate               = self.flow_rate[rows, stage] * self.throttle * dt * self.stage_separation
+        self.fuel[rows, stage]  -= flow_rate / (1 + self.ox_f_ratio)
+        self.lox[rows, stage]   -= flow_rate * self.ox_f_ratio / (1 + self.ox_f_ratio)
+        self.n2[rows, stage]    -= self.purge[rows, stage] * dt
+
+        # fairing jettison above its altitude
+        jettison                = running & (self.altitude >= self.jettison)
+        self.fairing[jettison, stage[jettison]] -= self.fairing_mass[jettison] * self.fairing_status[jettison]
+        self.fairing_status[jettison] = 0
+
+        self.calc_mass()
+
+
+
+    def calc_mass(self):
+
+        stage_mass              = self.dry_mass + self.cores * self.n2 + self.fairing + self.fuel + self.lox
+        self.mass               = stage_mass.sum(axis=1)
+
+
+
+    def check_launch_phase_status(self):
+        ''' Ends the launch of members that reached the target apogee or burned out their last
+            stage, and stages the members whose current stage burned out.
+        '''
+
+        launch                  = self.phase == LAUNCH
+        if not launch.any():
+            return
+
+        rows                    = self.rows
+        stage                   = self.stage
+        periapsis, apoapsis     = self.calc_keplerian()
+
+        reached                 = launch & (apoapsis >= self.target_apogee)
+        if reached.any():
+            self.SECO(reached)
+
+        burnout                 = launch & ~reached & ((self.fuel[rows, stage] <= self.fuel_limit[rows, stage]) | (self.lox[rows, stage] <= self.lox_limit[rows, stage]))
+        last                    = burnout & (stage == self.last_stage)
+        self.stage_separation[burnout] = 0
+
+        if (burnout & ~last).any():
+            self.separate_stage(burnout & ~last)
+
+        for i in np.flatnonzero(reached | last):
+            self.end_launch(i)
+
+
+
+    def calc_keplerian(self):
+        ''' Returns the periapsis and apoapsis distance of every member [m], as keplerian_orbit. '''
+
+        position                = Vector3DArray(self.position)
+        h_hat                   = position.cross(self.velocity)
+        e_hat                   = Vector3DArray(self.velocity).cross(h_hat).points / _u - position.unit().points
+        e                       = np.sqrt(np.einsum('ij,ij->i', e_hat, e_hat))
+        e[e == 1]               = 1 - 1e-16
+        p                       = h_hat.magnitude() ** 2 / _u
+
+        return p / (1 + e), p / (1 - e)
+
+
+
+    def SECO(self, members):
+
+        stage                   = self.stage[members]
+        self.n2[members, stage]     -= self.shutdown['N2'][members, stage]
+        self.lox[members, stage]    -= self.shutdown['LOx'][members, stage]
+        self.fuel[members, stage]   -= self.shutdown['Kerosene'][members, stage]
+        self.throttle[members]  = 0.0
+        self.calc_mass()
+
+
+
+    def separate_stage(self, members):
+
+        previous                = self.stage[members]
+        stage                   = previous + 1
+        self.stage[members]     = stage
+
+        # the fairing moves up to the next stage until it is jettisoned
+        fairing                 = self.fairing_mass[members] * self.fairing_status[members]
+        self.fairing[members, stage]    += fairing
+        self.fairing[members, previous] -= fairing
+
+        for masses in [self.dry_mass, self.n2, self.fairing, self.fuel, self.lox]:
+            masses[members, previous] = 0.0
+
+        # engine startup of the next stage
+        for sequence in [self.chill, self.start]:
+            self.n2[members, stage]     -= sequence['N2'][members, stage]
+            self.lox[members, stage]    -= sequence['LOx'][members, stage]
+            self.fuel[members, stage]   -= sequence['Kerosene'][members, stage]
+
+        self.throttle[members]  = self.stage_throttle[members, stage]
+        self.calc_mass()
+
+
+
+    def end_launch(self, i):
+        ''' Checks whether member i made orbit with enough propellant left to circularize, with
+            Simulation.check_orbit_status on its written back state.
+        '''
+
+        self.write_back(i)
+        simulation              = self.simulations[i]
+        self.orbit[i]           = simulation.check_orbit_status()
+        simulation.rocket.orbit = bool(self.orbit[i])
+
+        if self.orbit[i] and self.circularize:
+            self.phase[i]       = CIRCULARIZE
+        else:
+            self.phase[i]       = DONE
+            self.end[i]         = self.elapsed
+
+
+
+    def check_circularization_status(self):
+        ''' Starts the circularization burn at apogee, ends it at orbital velocity, and ends the
+            simulation once the propellant or the duration runs out.
+        '''
+
+        circularize             = self.phase == CIRCULARIZE
+        if not circularize.any():
+            return
+
+        rows                    = self.rows
+        stage                   = self.stage
+
+        start                   = circularize & (self.altitude < self.apogee) & (self.circ_burn == 0)
+        self.throttle[start]    = self.stage_throttle[rows, stage][start]
+        self.circ_burn[start]   = 1
+        for i in np.flatnonzero(start):
+            self.target_velocity[i] = Orbit(self.altitude[i], self.altitude[i]).velocity_apogee
+
+        speed                   = Vector3DArray(self.velocity).magnitude()
+        end                     = circularize & (self.circ_burn == 1) & (speed >= self.target_velocity)
+        self.throttle[end]      = 0.0
+        self.circ_burn[end]     = -1
+
+        done                    = circularize & ((self.fuel[rows, stage] + self.lox[rows, stage] <= 0.0) | (self.elapsed > self.duration))
+        self.phase[done]        = DONE
+        self.end[done]          = self.elapsed
+
+        self.apogee[circularize] = self.altitude[circularize]
+
+
+
+    def write_back(self, i):
+        ''' Copies member i's state into its Rocket and Simulation. '''
+
+        rocket                  = self.rockets[i]
+        simulation              = self.simulations[i]
+        state                   = rocket.stages[-1].state
+        state.states.y[state.row:state.row+2] = self.states.y[2*i:2*i+2]
+        rocket.get_current_state(self.end[i] if self.phase[i] == DONE else self.elapsed)
+        rocket.orientation      = Vector3D(self.orientation[i].tolist())
+
+        for j, stage in enumerate(rocket.stages):
+
+            if j < self.stage[i]:
+                stage.dry_mass  = stage.prop_mass = stage.mass = 0.0
+                for tank in stage.tanks:
+                    tank.fuel_mass = tank.lox_mass = 0.0
+                continue
+
+            for tank in stage.tanks:
+                tank.fuel_mass  = self.fuel[i, j] / len(stage.tanks)
+                tank.lox_mass   = self.lox[i, j]  / len(stage.tanks)
+
+            stage.nitrogen_tank.commodity_mass = self.n2[i, j]
+            stage.nitrogen_tank.update_mass()
+            stage.fairing_mass  = self.fairing[i, j]
+            stage.update_mass()
+
+        rocket.stages[self.stage[i]].throttle = self.throttle[i]
+        rocket.mass             = rocket.sum_stage_masses()
+
+        simulation.stage                = int(self.stage[i])
+        simulation.stage_separation     = int(self.stage_separation[i])
+        simulation.separation_sequence  = self.separation_sequence[i]
+        simulation.fairing_status       = int(self.fairing_status[i])
+        simulation.pitchover_status     = int(self.pitchover_status[i])
+        simulation.launch_sequence      = self.phase[i] == LAUNCH and self.throttle[i] > 0.0
+        simulation.circ_burn            = {0: False, 1: True, -1: -1}[self.circ_burn[i]]
+        simulation.apogee               = self.apogee[i]
+        simulation.launch_hold          = list(self.launch_hold)
+        simulation.elapsed              = self.end[i] if self.phase[i] == DONE else self.elapsed
+
+
+
+    def results(self):
+        ''' Returns a dict per member of its orbit, elapsed time [s], periapsis and apoapsis
+            distance [m], altitude [m], last stage propellant [kg], payload [kg] and pitchover angle [deg].
+        '''
+
+        results                 = []
+
+        for rocket, simulation in zip(self.rockets, self.simulations):
+            periapsis, apoapsis = keplerian_orbit(rocket.position, rocket.velocity)
+            results.append({
+                'orbit'             : rocket.orbit,
+                'elapsed'           : simulation.elapsed,
+                'periapsis'         : periapsis,
+                'apoapsis'          : apoapsis,
+                'altitude'          : rocket.altitude,
+                'prop_mass'         : rocket.stages[-1].prop_mass,
+                'payload'           : rocket.payload,
+                'pitchover_angle'   : rocket.trajectory.pitchover_angle
+            })
+
+        return results
+
+
+
+
+if __name__ == '__main__':
+
+    import time
+    from params import Params
+
+    # sweep the pitchover angle of a vehicle that reaches orbit, through the circularization
+    # burn, and fly a few of the members serially for comparison. Members that fall back
+    # descend almost vertically, where the gravity turn flips the orientation from step to
+    # step, so rounding differences of 1e-9 grow until the two runs part; members that reach
+    # orbit agree to rounding.
+    config          = Config.from_params(Params).replace(engines=[4, 1], duration=3000)
+    angles          = np.linspace(0.9, 1.5, 64)
+    payload         = 60.0
+
+    t               = time.time()
+    ensemble        = Ensemble.from_params(config, pitchover_angles=angles, payloads=[payload] * len(angles))
+    results         = ensemble.run(circularize=True)
+    t_ensemble      = time.time() - t
+
+    t               = time.time()
+    for k in [0, 21, 42, 63]:
+        rocket      = Rocket(config)
+        rocket.modify_payload(payload)
+        rocket.trajectory.pitchover_angle = angles[k]
+        simulation  = Simulation(rocket, rocket.trajectory)
+        simulation.run_simulation(circularize=True)
+        periapsis, apoapsis = keplerian_orbit(rocket.position, rocket.velocity)
+        r           = results[k]
+        print('pitchover %.3f | serial %.1f s %.3f %.3f km %.3f kg %r | ensemble %.1f s %.3f %.3f km %.3f kg %r' % (angles[k],
+            simulation.elapsed, (periapsis - Earth.radius_equator)/1e3, (apoapsis - Earth.radius_equator)/1e3, rocket.stages[-1].prop_mass, rocket.orbit,
+            r['elapsed'], (r['periapsis'] - Earth.radius_equator)/1e3, (r['apoapsis'] - Earth.radius_equator)/1e3, r['prop_mass'], r['orbit']))
+        if rocket.orbit:
+            assert r['orbit'] and abs(r['periapsis'] - periapsis) < 1.0 and abs(r['apoapsis'] - apoapsis) < 1.0 and abs(r['prop_mass'] - rocket.stages[-1].prop_mass) < 1e-6
+    t_serial        = (time.time() - t) / 4
+
+    print('%i members | ensemble %.2f s | serial %.2f s per member, %.1f s for all' % (len(angles), t_ensemble, t_serial, t_serial * len(angles)))
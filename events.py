@@ -0,0 +1,92 @@
+'''
+Event detection inside an integration step.
+
+An event is a function of time and the state array that crosses zero when
+something happens during flight (burnout, reaching the target apogee, fairing
+jettison altitude, apogee, the end of a burn). After each step the event
+functions are compared at both ends, and a crossing is located by bisection
+on the step's cubic Hermite interpolant, so the time of the event no longer
+depends on the size of the step.
+'''
+
+
+
+class Event(object):
+
+    def __init__(self, name, function, direction=0, terminal=True):
+        ''' Arguments:
+                name: identifies the event in the simulation's event log.
+                function: g(t, y) of time [s] and the state array, zero at the event.
+                direction: 1 to trigger only when g rises through zero, -1 only
+                    when it falls, 0 for either.
+                terminal: whether the step is cut short to end on the event.
+        '''
+
+        self.name       = name
+        self.function   = function
+        self.direction  = direction
+        self.terminal   = terminal
+
+
+
+    def crossed(self, g0, g1):
+        ''' Returns True if g crossed zero between two evaluations in the event's direction. '''
+
+        if self.direction >= 0 and g0 < 0.0 <= g1:
+            return True
+        if self.direction <= 0 and g0 > 0.0 >= g1:
+            return True
+
+        return False
+
+
+
+    def locate(self, interpolate, t0, t1, g0, tolerance):
+        ''' Locates the zero crossing inside a step by bisection.
+
+            Arguments:
+                interpolate: function returning the state array at a time inside the step.
+                t0, t1: times at the ends of the step [s].
+                g0: value of the event function at t0.
+                tolerance: width of the final bracket [s].
+
+            Returns:
+                the end of the bracket past the crossing [s].
+        '''
+
+        while t1 - t0 > tolerance:
+
+            t           = 0.5 * (t0 + t1)
+            g           = self.function(t, interpolate(t))
+
+            if self.crossed(g0, g):
+                t1      = t
+            else:
+                t0, g0  = t, g
+
+        return t1
+
+
+
+
+if __name__ == '__main__':
+
+    import numpy as np
+    from vector3d import Vector3D
+    from integrator import StateArray
+
+    # drop a body from 10 m and find when it reaches the ground
+    timestep    = 1.0 # [s]
+    states      = StateArray(1)
+    body        = states.allocate(Vector3D([0.0, 10.0, 0.0]), Vector3D([0.0, 0.0, 0.0]), Vector3D([0.0, 10.0, 0.0]), Vector3D([0.0, 0.0, 0.0]))
+    impact      = Event('impact', lambda t, y: y[0, 1], direction=-1)
+
+    t           = 0.0
+    while body.position.y > 0.0:
+        body.accelerate(Vector3D([0.0, -9.80665, 0.0]))
+        states.step(timestep, t)
+        t       += timestep
+
+    t_impact    = impact.locate(states.interpolate, t - timestep, t, impact.function(t - timestep, states.last[3]), 1e-6)
+
+    print('Impact at %.6f s, exact %.6f s' % (t_impact, np.sqrt(2 * 10.0 / 9.80665)))
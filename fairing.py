@@ -1,6 +1,4 @@
 from math           import pi
-from vector3d       import Vector3D
-from runge_kutta    import StateVector
 
 
 
@@ -14,9 +12,14 @@ class Fairing(object):
     x_A             = 0.5 * pi * (diameter * 0.5)**2
     C_d             = 0.1
 
-    # position and velocity states
-    state           = StateVector(Vector3D([0,0,0]), Vector3D([0,0,0]))
-    state_rel       = StateVector(Vector3D([0,0,0]), Vector3D([0,0,0]))
 
-    # for simulation
-    recovery_status = 1
+    def __init__(self):
+
+        # position and velocity states, allocated by the rocket
+        self.state              = None
+
+        # drag coefficient by Mach number, from Params.drag
+        self.drag_table         = None
+
+        # for simulation
+        self.recovery_status    = 1
@@ -1,11 +1,13 @@
 import math
 import copy
+import numpy             as np
 import pandas            as pd
 import matplotlib.pyplot as plt
 from earth               import Earth
 from graphs              import *
 from pyquaternion        import Quaternion
-from rotation_matrix     import rotate_Z
+from rotation_matrix     import rotate_Z, rotation_angle
+from vector3d            import Vector3DArray
 from ground_track        import calc_distance_to_horizon
 import simplekml
 
@@ -18,6 +20,7 @@ class FlightRecorder(object):
         cols            = ['t','ax','ay','az','px_rel','py_rel','pz_rel','px','py','pz','vx','vy','vz','s1px_rel','s1py_rel','s1pz_rel','s1_lox','s1_fuel','s2_lox','s2_fuel','alt','q','v','a','dr']
         self.data       = pd.DataFrame(columns = cols)
         self.counter    = 1
+        self.samples    = []                                # relative position, relative velocity and altitude of every tenth step
         self.kml        = simplekml.Kml()
 
         self.trajectory = self.kml.newlinestring(name="Trajectory")
@@ -39,16 +42,13 @@ class FlightRecorder(object):
 
     def record_data(self, elapsed, acceleration, rocket, drag):
 
-        # pos_rel      = rotate_Z(-rocket.params.theta * self.counter, rocket.position)
         pos_rel      = rocket.position_rel
         stage1       = rocket.stages[0]
         stage2       = rocket.stages[1]
-        s1           = stage1.state.vector
-        s1_pos       = Vector3D([s1[0].p, s1[1].p, s1[2].p])
-        s1_pos_rel   = rotate_Z(-rocket.params.theta * self.counter, s1_pos)
-        f            = rocket.fairing.state.vector
-        f_pos        = Vector3D([f[0].p, f[1].p, f[2].p])
-        f_pos_rel    = rotate_Z(-rocket.params.theta * self.counter, f_pos)
+        s1_pos       = stage1.state.position
+        s1_pos_rel   = rotate_Z(-rotation_angle(elapsed), s1_pos)
+        f_pos        = rocket.fairing.state.position
+        f_pos_rel    = rotate_Z(-rotation_angle(elapsed), f_pos)
 
         g            = Earth.calc_gravity(rocket.position.magnitude())
         gravity      = rocket.position.unit().inverse()
@@ -61,7 +61,7 @@ class FlightRecorder(object):
                     pos_rel.x,              pos_rel.y,              pos_rel.z,
                     rocket.position.x,      rocket.position.y,      rocket.position.z,
                     rocket.velocity.x,      rocket.velocity.y,      rocket.velocity.z,
-                    s1[0].p,                s1[1].p,                s1[2].p,
+                    s1_pos.x,               s1_pos.y,               s1_pos.z,
                     stage1.tanks[0].lox_mass,   stage1.tanks[0].fuel_mass,
                     stage2.tanks[0].lox_mass,   stage2.tanks[0].fuel_mass,
                     rocket.altitude,        drag,
@@ -74,55 +74,8 @@ class FlightRecorder(object):
             if elapsed>000:
                 print(elapsed)
 
-                lat, lon, alt = Earth.get_lat_lon(pos_rel)
-                self.ground_track.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),0)])
-                self.trajectory.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),round(rocket.altitude))])
-
-                # if rocket.params.recover:
-                #     lat, lon, alt = Earth.get_lat_lon(s1_pos_rel)
-                #     self.stage1_trajectory.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),round(alt))])
-                #
-                #     lat, lon, alt = Earth.get_lat_lon(f_pos_rel)
-                #     self.fairing_trajectory.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),round(alt))])
-
-                if rocket.altitude >= 100000:
-
-                    # ground track width
-                    A            = rocket.velocity_rel
-                    B            = pos_rel.unit().inverse()
-                    proj         = A.dot(B) / B.dot(B)
-                    B.scale(proj)
-                    axis         = A.difference(B)
-
-                    ang         = 0
-
-                    d, theta, x, y, angle, m, new, _0 = calc_distance_to_horizon(pos_rel, ang)
-
-                    KP          = math.pi-theta
-                    err         = 0 - math.degrees(angle)
-                    ang         += KP * err
-
-                    while abs(err) > 1e-4:
-                        d, theta, x, y, angle, m, new, _0 = calc_distance_to_horizon(pos_rel, ang)
-                        err      = 0 - math.degrees(angle)
-                        ang      += KP * err
-
-                    q1           = Quaternion(axis=axis.points, radians=_0)
-                    q2           = Quaternion(axis=axis.points, radians=-_0)
-                    w            = pos_rel.unit().inverse()
-                    w_prime1     = q1.rotate(w.points)
-                    w_prime2     = q2.rotate(w.points)
-                    vec1         = Vector3D(w_prime1)
-                    vec2         = Vector3D(w_prime2)
-                    vec1.scale(m)
-                    vec2.scale(m)
-                    vec1.add(pos_rel)
-                    vec2.add(pos_rel)
-
-                    lat, lon, alt = Earth.get_lat_lon(vec1)
-                    self.ground_track1.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),0)])
-                    lat, lon, alt = Earth.get_lat_lon(vec2)
-                    self.ground_track2.coords.addcoordinates([(math.degrees(lon),math.degrees(lat),0)])
+                # converted to the KML tracks all at once by write_tracks()
+                self.samples.append(list(pos_rel.points) + list(rocket.velocity_rel.points) + [rocket.altitude])
 
                 # self.data.loc[self.counter/10] = data
                 # self.data.loc[self.counter] = data
@@ -133,8 +86,63 @@ class FlightRecorder(object):
 
 
 
+    def write_tracks(self):
+        ''' Converts the samples to the coordinates of the trajectory and ground tracks, and
+            the edges of the ground track seen from above 100 km, every sample at once.
+        '''
+
+        if not self.samples:
+            return
+
+        samples         = np.array(self.samples)
+        lat, lon, alt   = Vector3DArray(samples[:, :3]).get_lat_lon()
+        lat, lon        = np.degrees(lat).tolist(), np.degrees(lon).tolist()
+
+        self.ground_track.coords = [(x, y, 0) for x, y in zip(lon, lat)]
+        self.trajectory.coords   = [(x, y, round(a)) for x, y, a in zip(lon, lat, samples[:, 6].tolist())]
+
+        high            = samples[:, 6] >= 100000
+        if not high.any():
+            return
+
+        # ground track width
+        pos_rel         = Vector3DArray(samples[high, :3])
+        A               = Vector3DArray(samples[high, 3:6])
+        B               = pos_rel.unit().inverse()
+        proj            = A.dot(B) / B.dot(B)
+        B.scale(proj)
+        axis            = A.difference(B)
+
+        # the horizon of every sample, iterated only while its own error is above the tolerance
+        ang             = np.zeros(len(proj))
+        m               = np.zeros(len(proj))
+        _0              = np.zeros(len(proj))
+        KP              = None
+        active          = np.ones(len(proj), dtype=bool)
+
+        while active.any():
+            d, theta, x, y, angle, m[active], new, _0[active] = calc_distance_to_horizon(pos_rel[active], ang[active])
+            if KP is None:
+                KP      = math.pi - theta
+            err         = 0 - np.degrees(angle)
+            ang[active] += KP[active] * err
+            active[active] = np.abs(err) > 1e-4
+
+        w               = pos_rel.unit().inverse()
+        edges           = []
+        for sign in [1, -1]:
+            edge        = w.rotate(axis.unit(), sign * _0)
+            edge.scale(m)
+            lat, lon, alt = edge.sum(pos_rel).get_lat_lon()
+            edges.append([(x, y, 0) for x, y in zip(np.degrees(lon).tolist(), np.degrees(lat).tolist())])
+
+        self.ground_track1.coords, self.ground_track2.coords = edges
+
+
+
     def save_kml(self):
 
+        self.write_tracks()
         self.kml.save("trajectory.kml")
 
 
@@ -0,0 +1,382 @@
+'''
+Vectorized Runge-Kutta integration of every body in a simulation.
+
+The position and velocity of each body (stages and fairing) are held in one
+contiguous float64 array, with an inertial and a relative row per body, so
+that a single rk4 call advances all of them at once instead of integrating
+each axis of each frame separately. An embedded Dormand-Prince 5(4) pair
+provides adaptive stepping with error control, and the last step can be
+interpolated and retaken shorter to stop on an event inside it.
+'''
+
+import numpy as np
+from vector3d import Vector3D
+
+
+
+def rk4(f, t, y, dt):
+    ''' Implements Runge-Kutta 4th order numerical integration over an array of states.
+
+        Arguments:
+            f: derivative function f(t, y), returns an array shaped like y.
+            t: time at the start of the step [s].
+            y: state array, one [px, py, pz, vx, vy, vz] row per body.
+            dt: timestep [s].
+
+        Returns:
+            state array at t + dt.
+    '''
+
+    k1          = f(t, y)
+    k2          = f(t + dt * 0.5, y + k1 * (dt * 0.5))
+    k3          = f(t + dt * 0.5, y + k2 * (dt * 0.5))
+    k4          = f(t + dt, y + k3 * dt)
+
+    return y + (k1 + 2.0 * (k2 + k3) + k4) * (dt / 6.0)
+
+
+
+# Dormand-Prince 5(4) coefficients
+DP_C    = [0.0, 1/5, 3/10, 4/5, 8/9, 1.0, 1.0]
+DP_A    = [
+    [],
+    [1/5],
+    [3/40,          9/40],
+    [44/45,         -56/15,         32/9],
+    [19372/6561,    -25360/2187,    64448/6561,     -212/729],
+    [9017/3168,     -355/33,        46732/5247,     49/176,     -5103/18656],
+    [35/384,        0.0,            500/1113,       125/192,    -2187/6784,     11/84]
+]
+DP_B4   = [5179/57600,  0.0,    7571/16695,     393/640,    -92097/339200,  187/2100,   1/40]
+DP_E    = [b5 - b4 for b5, b4 in zip(DP_A[6] + [0.0], DP_B4)]
+
+
+
+def dopri45(f, t, y, dt):
+    ''' Implements one Dormand-Prince 5(4) step over an array of states.
+
+        Arguments:
+            f: derivative function f(t, y), returns an array shaped like y.
+            t: time at the start of the step [s].
+            y: state array, one [px, py, pz, vx, vy, vz] row per body.
+            dt: timestep [s].
+
+        Returns:
+            5th order state array at t + dt, and the difference from the
+            embedded 4th order solution as an estimate of the local error.
+    '''
+
+    k               = [f(t, y)]
+
+    for c, a in zip(DP_C[1:], DP_A[1:]):
+        yi          = y + dt * sum(aj * kj for aj, kj in zip(a, k) if aj != 0.0)
+        k.append(f(t + c * dt, yi))
+
+    # the last stage is evaluated at the 5th order solution
+    error           = dt * sum(e * kj for e, kj in zip(DP_E, k) if e != 0.0)
+
+    return yi, error
+
+
+
+def hermite(t0, y0, dy0, t1, y1, dy1, t):
+    ''' Cubic Hermite interpolation between two states and their derivatives.
+
+        Arguments:
+            t0, t1: times at the ends of the step [s].
+            y0, y1: state arrays at t0 and t1.
+            dy0, dy1: derivative arrays at t0 and t1.
+            t: time to interpolate at [s].
+
+        Returns:
+            state array at t.
+    '''
+
+    h           = t1 - t0
+    s           = (t - t0) / h
+
+    h00         = (1 + 2*s) * (1 - s)**2
+    h10         = s * (1 - s)**2
+    h01         = s**2 * (3 - 2*s)
+    h11         = s**2 * (s - 1)
+
+    return h00 * y0 + h10 * h * dy0 + h01 * y1 + h11 * h * dy1
+
+
+
+
+class StateArray(object):
+
+    def __init__(self, bodies):
+
+        self.y          = np.zeros((bodies * 2, 6))                 # rows 2i inertial, 2i+1 relative [px, py, pz, vx, vy, vz]
+        self.accel      = np.zeros((bodies * 2, 3))                 # acceleration applied over the next step
+        self.active     = np.zeros(bodies * 2, dtype=bool)          # rows that will be advanced by the next step
+        self.applied    = self.accel[self.active]                   # acceleration of the rows being advanced
+        self.functions  = {}                                        # row: acceleration function re-evaluated at every stage
+        self.callbacks  = []
+        self.bodies     = 0
+        self.last       = None                                      # (t0, dt, rows, y0, method) of the last step, kept for interpolation
+        self.slopes     = None                                      # derivatives at both ends of the last step, evaluated on demand
+
+        # adaptive step statistics
+        self.stats      = {'accepted': 0, 'rejected': 0, 'evaluations': 0, 'min_step': float('inf'), 'max_step': 0.0}
+
+
+
+    def allocate(self, position, velocity, position_rel, velocity_rel):
+        ''' Reserves the next inertial / relative row pair and returns a handle to it. '''
+
+        row                 = self.bodies * 2
+        self.y[row, :3]     = position.points
+        self.y[row, 3:]     = velocity.points
+        self.y[row+1, :3]   = position_rel.points
+        self.y[row+1, 3:]   = velocity_rel.points
+        self.bodies         += 1
+
+        return BodyState(self, row)
+
+
+
+    def derivative(self, t, y):
+        ''' Returns [velocity, acceleration] for the rows being advanced. '''
+
+        dy          = np.empty_like(y)
+        dy[:, :3]   = y[:, 3:]
+        dy[:, 3:]   = self.applied
+
+        for i, f in self.callbacks:
+            dy[i:i+2, 3:] = f(t, y[i], y[i+1])
+
+        self.stats['evaluations'] += 1
+
+        return dy
+
+
+
+    def prepare(self):
+        ''' Gathers the accelerations applied since the last step for the active rows. '''
+
+        rows                = np.flatnonzero(self.active)
+        self.applied        = self.accel[self.active]
+        self.callbacks      = [(int(np.searchsorted(rows, row)), f) for row, f in self.functions.items()]
+
+
+
+    def finish(self, t, dt, y0, method):
+
+        self.last           = (t, dt, self.active.copy(), y0, method)
+        self.slopes         = None
+        self.active[:]      = False
+        self.functions      = {}
+
+
+
+    def step(self, dt, t=0.0):
+        ''' Advances every row that had an acceleration applied since the last step. '''
+
+        self.prepare()
+        y0                  = self.y.copy()
+        self.y[self.active] = rk4(self.derivative, t, y0[self.active], dt)
+        self.finish(t, dt, y0, rk4)
+
+
+
+    def interpolate(self, t):
+        ''' Returns the state array at a time inside the last step. '''
+
+        t0, dt, rows, y0, method = self.last
+
+        if self.slopes is None:
+            self.slopes     = (self.derivative(t0, y0[rows]), self.derivative(t0 + dt, self.y[rows]))
+
+        y                   = y0.copy()
+        y[rows]             = hermite(t0, y0[rows], self.slopes[0], t0 + dt, self.y[rows], self.slopes[1], t)
+
+        return y
+
+
+
+    def retake(self, dt):
+        ''' Undoes the last step and takes it again with a shorter timestep. '''
+
+        t0, _, rows, y0, method = self.last
+        self.y[:]           = y0
+        self.y[rows]        = method(self.derivative, t0, y0[rows], dt)
+        self.last           = (t0, dt, rows, y0, method)
+        self.slopes         = None
+
+
+
+    def snapshot(self):
+        ''' Returns a copy of the rows, queued accelerations and the last step, for restore(). '''
+
+        return (self.y.copy(), self.accel.copy(), self.active.copy(), dict(self.functions), self.last, self.slopes, dict(self.stats))
+
+
+
+    def restore(self, snapshot):
+        ''' Returns every row to the state saved by snapshot(). '''
+
+        y, accel, active, functions, self.last, self.slopes, stats = snapshot
+        self.y[:]           = y
+        self.accel[:]       = accel
+        self.active[:]      = active
+        self.functions      = dict(functions)
+        self.stats          = dict(stats)
+
+
+
+    def step_adaptive(self, dt, t, atol, rtol, max_dt, min_dt=1e-6):
+        ''' Advances the active rows with an error controlled Dormand-Prince step,
+            shrinking the step until the local error is within tolerance. Raises a
+            RuntimeError if the error is not finite, or if the step would shrink below
+            min_dt, rather than shrinking it forever.
+
+            Arguments:
+                dt: proposed timestep [s].
+                t: time at the start of the step [s].
+                atol: absolute tolerance [m, m/s].
+                rtol: relative tolerance [unitless].
+                max_dt: largest timestep the next proposal may grow to [s].
+                min_dt: smallest timestep a rejected step may shrink to [s].
+
+            Returns:
+                timestep taken [s], proposed next timestep [s].
+        '''
+
+        self.prepare()
+        y0                  = self.y.copy()
+        y                   = y0[self.active]
+
+        while True:
+
+            y_new, error    = dopri45(self.derivative, t, y, dt)
+            scale           = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+            norm            = float(np.sqrt(np.mean((error / scale) ** 2)))
+
+            if not np.isfinite(norm):
+                raise RuntimeError('adaptive step error is not finite at t = %r s, dt = %r s, state %r' % (t, dt, y.tolist()))
+
+            # grow or shrink the step towards an error norm of one
+            factor          = 5.0 if norm == 0.0 else min(5.0, max(0.2, 0.9 * norm ** -0.2))
+
+            if norm <= 1.0:
+                break
+
+            if dt * factor < min_dt:
+                raise RuntimeError('adaptive step fell below %r s at t = %r s, error norm %r, state %r' % (min_dt, t, norm, y.tolist()))
+
+            self.stats['rejected'] += 1
+            dt              *= factor
+
+        self.y[self.active] = y_new
+        self.finish(t, dt, y0, lambda f, t, y, dt: dopri45(f, t, y, dt)[0])
+
+        self.stats['accepted']  += 1
+        self.stats['min_step']  = min(self.stats['min_step'], dt)
+        self.stats['max_step']  = max(self.stats['max_step'], dt)
+
+        return dt, min(dt * factor, max_dt)
+
+
+
+
+class BodyState(object):
+
+    def __init__(self, states, row):
+
+        self.states     = states
+        self.row        = row
+
+
+
+    @property
+    def position(self):
+        return Vector3D(self.states.y[self.row, :3].tolist())
+
+
+    @property
+    def velocity(self):
+        return Vector3D(self.states.y[self.row, 3:].tolist())
+
+
+    @property
+    def position_rel(self):
+        return Vector3D(self.states.y[self.row+1, :3].tolist())
+
+
+    @property
+    def velocity_rel(self):
+        return Vector3D(self.states.y[self.row+1, 3:].tolist())
+
+
+
+    def read(self, position, velocity, velocity_rel):
+        ''' Copies the inertial state and relative velocity into existing vectors. '''
+
+        y                   = self.states.y
+        position.update(y[self.row, :3].tolist())
+        velocity.update(y[self.row, 3:].tolist())
+        velocity_rel.update(y[self.row+1, 3:].tolist())
+
+
+
+    def propagate(self, position, velocity, dt):
+        ''' Moves the inertial row to a state propagated outside the integrator over dt,
+            carrying the relative row along with it. Both rows receive the same
+            acceleration, so their difference grows linearly in time.
+        '''
+
+        y                   = self.states.y
+        offset              = y[self.row+1] - y[self.row]
+        y[self.row, :3]     = position.points
+        y[self.row, 3:]     = velocity.points
+        y[self.row+1]       = y[self.row] + offset
+        y[self.row+1, :3]   += offset[3:] * dt
+
+
+
+    def accelerate(self, accel):
+        ''' Applies the same acceleration to the inertial and relative rows over the next step.
+
+            Arguments:
+                accel: constant acceleration [Vector3D], or a function
+                    f(t, state, state_rel) returning the acceleration, which
+                    is then re-evaluated at every Runge-Kutta stage.
+        '''
+
+        if callable(accel):
+            self.states.functions[self.row]     = accel
+        else:
+            self.states.accel[self.row:self.row+2] = accel.points
+
+        self.states.active[self.row:self.row+2] = True
+
+
+
+
+if __name__ == '__main__':
+
+    # initial params
+    timestep     = 0.1 # [s]
+    duration     = 1.0 # [s]
+
+    states       = StateArray(1)
+    body         = states.allocate(Vector3D([0.0, 9.8, 0.0]), Vector3D([0.0, 0.0, 0.0]), Vector3D([0.0, 9.8, 0.0]), Vector3D([0.0, 0.0, 0.0]))
+    acceleration = Vector3D([0.0, -9.8, 0.0])
+
+    # numerical integration loop
+    for x in range( int(duration/timestep) ):
+        body.accelerate(acceleration)
+        states.step(timestep)
+
+    print('Position: %r m, Velocity: %r m/s after %i second(s)' % (body.position.points, body.velocity.points, duration))
+
+    # a diverging state, and a stiff one that needs steps below the minimum, raise rather than shrinking the step forever
+    for name, accel in [('diverging', Vector3D([float('nan'), 0.0, 0.0])), ('stiff', lambda t, y, y_rel: -1e12 * y[:3])]:
+        body.accelerate(accel)
+        try:
+            states.step_adaptive(1.0, duration, 1e-6, 1e-9, 60.0, min_dt=1e-3)
+        except RuntimeError as error:
+            print('%s: %s' % (name, str(error)[:60]))
@@ -1,6 +1,6 @@
 import math
 import orbital
-from constants import _u
+from constants import _u, J2
 from earth import Earth
 from vector3d import Vector3D
 
@@ -63,6 +63,132 @@ def keplerian_orbit(position, velocity):
 
 
 
+def radial_energy(position, velocity, radius):
+    ''' Returns half the square of the radial velocity the orbit would have at the given
+        radius, which is negative when the orbit does not reach it. Unlike the apoapsis
+        distance it varies smoothly with the state as the orbit approaches circular.
+        Unit: [m^2/s^2]
+    '''
+
+    # angular momentum
+    h     = position.cross(velocity).magnitude()
+
+    # specific orbital energy at the current state less the energy at radius
+    # with the same angular momentum
+    return velocity.magnitude() ** 2 / 2 - _u / position.magnitude() - (h ** 2 / (2 * radius ** 2) - _u / radius)
+
+
+
+def stumpff(z):
+    ''' Returns the Stumpff functions C(z) and S(z) of the universal variable formulation. '''
+
+    if z > 1e-6:
+        s     = math.sqrt(z)
+        return (1 - math.cos(s)) / z, (s - math.sin(s)) / s ** 3
+    elif z < -1e-6:
+        s     = math.sqrt(-z)
+        return (math.cosh(s) - 1) / -z, (math.sinh(s) - s) / s ** 3
+    else:
+        return 1/2 - z/24 + z**2/720, 1/6 - z/120 + z**2/5040
+
+
+
+def kepler_propagate(position, velocity, dt, mu=_u, j2=False):
+    ''' Propagates a two-body state by solving Kepler's equation in universal variables,
+        valid for any orbit type. With j2, the secular drift of the node, argument of
+        perigee and mean anomaly due to Earth's oblateness is added.
+
+        Arguments:
+            position: inertial position [Vector3D].
+            velocity: inertial velocity [Vector3D].
+            dt: time of flight [s].
+            mu: gravitational parameter [m^3/s^2].
+            j2: include J2 secular terms [bool].
+
+        Returns:
+            position [Vector3D], velocity [Vector3D] after dt.
+    '''
+
+    r0        = position.magnitude()
+    v0        = velocity.magnitude()
+    vr0       = position.dot(velocity) / r0
+    alpha     = 2 / r0 - v0 ** 2 / mu                                       # reciprocal of the semi-major axis
+    sqrt_mu   = math.sqrt(mu)
+
+    # Newton iteration on the universal anomaly
+    x         = sqrt_mu * abs(alpha) * dt
+    for i in range(50):
+        z     = alpha * x ** 2
+        C, S  = stumpff(z)
+        F     = r0 * vr0 / sqrt_mu * x ** 2 * C + (1 - alpha * r0) * x ** 3 * S + r0 * x - sqrt_mu * dt
+        dF    = r0 * vr0 / sqrt_mu * x * (1 - z * S) + (1 - alpha * r0) * x ** 2 * C + r0
+        step  = F / dF
+        x     -= step
+        if abs(step) < 1e-9:
+            break
+
+    z         = alpha * x ** 2
+    C, S      = stumpff(z)
+
+    # Lagrange coefficients
+    f         = 1 - x ** 2 / r0 * C
+    g         = dt - x ** 3 / sqrt_mu * S
+
+    r         = Vector3D([f * position.x + g * velocity.x, f * position.y + g * velocity.y, f * position.z + g * velocity.z])
+    r_mag     = r.magnitude()
+
+    f_dot     = sqrt_mu / (r_mag * r0) * (alpha * x ** 3 * S - x)
+    g_dot     = 1 - x ** 2 / r_mag * C
+
+    v         = Vector3D([f_dot * position.x + g_dot * velocity.x, f_dot * position.y + g_dot * velocity.y, f_dot * position.z + g_dot * velocity.z])
+
+    if j2 and alpha > 0:
+        r, v  = j2_secular_drift(position, velocity, r, v, dt, mu)
+
+    return r, v
+
+
+
+def j2_secular_drift(position, velocity, r, v, dt, mu=_u):
+    ''' Rotates a propagated state by the secular J2 drift accumulated over dt: the node
+        about the polar axis, then the argument of perigee and mean anomaly within the
+        orbital plane.
+    '''
+
+    h_vec     = position.cross(velocity)
+    h         = h_vec.magnitude()
+    a         = 1 / (2 / position.magnitude() - velocity.magnitude() ** 2 / mu)
+    p         = h ** 2 / mu
+    e         = math.sqrt(max(0.0, 1 - p / a))
+    cos_i     = h_vec.z / h
+
+    n         = math.sqrt(mu / a ** 3)
+    k         = 1.5 * n * J2 * (Earth.radius_equator / p) ** 2
+    d_node    = -k * cos_i * dt
+    d_arg     = k * (2 - 2.5 * (1 - cos_i ** 2)) * dt
+    d_mean    = k * math.sqrt(1 - e ** 2) * (1 - 1.5 * (1 - cos_i ** 2)) * dt
+
+    # in-plane rotation about the angular momentum, then node rotation about z
+    axis      = h_vec.unit()
+    z_axis    = Vector3D([0.0, 0.0, 1.0])
+    r         = rotate(rotate(r, axis, d_arg + d_mean), z_axis, d_node)
+    v         = rotate(rotate(v, axis, d_arg + d_mean), z_axis, d_node)
+
+    return r, v
+
+
+
+def rotate(vector, axis, angle):
+    ''' Rotates a vector about a unit axis by angle [rad], Rodrigues' formula. '''
+
+    cos_a     = math.cos(angle)
+    sin_a     = math.sin(angle)
+    k_cross   = axis.cross(vector)
+    k_dot     = axis.dot(vector)
+
+    return Vector3D([vector.points[i] * cos_a + k_cross.points[i] * sin_a + axis.points[i] * k_dot * (1 - cos_a) for i in range(3)])
+
+
 
 
 if __name__ == "__main__":
@@ -75,3 +201,10 @@ if __name__ == "__main__":
     k       = keplerian_orbit(pos, vel)
 
     print("PERIGEE: %f km, APOGEE: %f km" % ((k[0]-R_e)*0.001,(k[1]-R_e)*0.001))
+
+    # coast half a period, to apogee
+    a       = 1 / (2 / pos.magnitude() - vel.magnitude() ** 2 / _u)
+    t       = math.pi * math.sqrt(a ** 3 / _u)
+    r, v    = kepler_propagate(pos, vel, t)
+
+    print("HALF PERIOD: %f s, ALTITUDE: %f km, RADIAL VELOCITY: %f m/s" % (t, (r.magnitude()-R_e)*0.001, r.dot(v)/r.magnitude()))
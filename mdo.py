@@ -1,10 +1,10 @@
 from __future__     import division, print_function
-import copy
 from openmdao.api   import Problem, Group, ExplicitComponent, ScipyOptimizeDriver, ExecComp, IndepVarComp
 from rocket         import Rocket
-from params         import Params
+from params         import Params, Config
+from cache          import Memo
 
-Params.optimized = False
+config              = Config.from_params(Params).replace(optimized=False)
 
 
 
@@ -21,25 +21,36 @@ class rocketDV(ExplicitComponent):
 
     def compute(self, inputs, outputs):
 
-        params              = copy.deepcopy(Params)
+        # COBYLA and the finite difference partials evaluate the same mass ratios again
+        outputs['error']    = evaluate([inputs[i][0] for i in inputs])
+        print('Evaluations: %i, repeats: %i' % (evaluate.misses, evaluate.hits))
 
-        params.payload      = Params.mdo_payload
 
-        params.mass_ratios  = [inputs[i][0] for i in inputs]
-        odyne               = Rocket(params)
 
-        while abs(odyne.thrust_GTOW - Params.thrust_GTOW) > 0.01:
-            params.payload  += (odyne.thrust_GTOW - Params.thrust_GTOW) * 10
-            odyne           = Rocket(params)
-        print(odyne.payload, odyne.thrust_GTOW)
+def fly(mass_ratios):
+    ''' Returns the simulation result of the rocket with the mass ratios, its payload sized
+        for the thrust to weight ratio of Params.
+    '''
 
-        if odyne.payload <= 0.0:
-            odyne.modify_payload(0.0)
-            odyne.trajectory.calc_pitchover()
-        else:
-            odyne.trajectory.optimize_pitchover()
+    params              = config.replace(payload=Params.mdo_payload, mass_ratios=mass_ratios)
+    odyne               = Rocket(params)
 
-        outputs['error']    = odyne.trajectory.simulate()
+    while abs(odyne.thrust_GTOW - Params.thrust_GTOW) > 0.01:
+        params          = params.replace(payload=params.payload + (odyne.thrust_GTOW - Params.thrust_GTOW) * 10)
+        odyne           = Rocket(params)
+    print(odyne.payload, odyne.thrust_GTOW)
+
+    if odyne.payload <= 0.0:
+        odyne.modify_payload(0.0)
+        odyne.trajectory.calc_pitchover()
+    else:
+        odyne.trajectory.optimize_pitchover()
+
+    return odyne.trajectory.simulate(cache=True)
+
+
+
+evaluate            = Memo(fly, Params.memo_size, Params.memo_tolerance)
 
 
 
@@ -7,16 +7,13 @@ from commodities.nylon  import Nylon
 
 
 
-A = Atmosphere()
-
-
 class Parachute(object):
 
 
     def __init__(self):
 
         self.C_d        = 1.75
-        self.rho        = A.calc_rho(0.0)
+        self.rho        = Atmosphere().calc_rho(0.0)
         self.W          = 333.0 * g_earth               # [N]
         self.v          = 8.0                           # [m/s]
         self.material   = Nylon
@@ -1,3 +1,4 @@
+from collections            import namedtuple
 from units                  import *
 from engine                 import Hadley
 from fairing                import Fairing
@@ -6,7 +7,6 @@ from tanks                  import HeliumTank, NitrogenTank
 from parachute              import Parachute
 from azimuth                import calc_launch_azimuth
 from sun_syncronous         import sun_syncronous_inclination
-from rotation_matrix        import rotation_angle
 from commodities.aluminum   import Aluminum
 
 
@@ -36,6 +36,11 @@ class Params(object):
     # Fairing params
     fairing                 = Fairing
 
+    # Drag params, one profile for the rocket, spent stages and fairing, each scaled by its own C_d,
+    # or a dict of them by 'rocket', 'stage' and 'fairing'. The pitchover angles, payloads and mass
+    # ratios above and in coordinates are tuned with 'constant'.
+    drag                    = 'constant'    # 'constant' holds C_d, 'transonic' triples it around Mach 1, or a DragTable
+
     # Recovery params
     recovery = {
         'ballute'           : 5, # [kg]
@@ -64,8 +69,17 @@ class Params(object):
 
     # Simulation params
     timestep                = 0.1  # [s]
+    atmosphere              = 'analytic'    # 'analytic' evaluates the standard atmosphere at every call, 'table' interpolates a precomputed grid
+    integrator              = 'constant'    # 'constant' holds acceleration over a step, 'rk4' re-evaluates it at every stage, 'rk45' adaptive
+    atol                    = 1e-6          # [m, m/s] absolute tolerance of the adaptive integrator
+    rtol                    = 1e-9          # relative tolerance of the adaptive integrator
+    max_timestep            = 60.0          # [s] largest adaptive step
+    min_timestep            = 1e-6          # [s] smallest step the adaptive integrator shrinks to before it gives up
+    locate_events           = False         # end steps on staging, apogee, fairing jettison and burnout, always on for 'rk45'
+    event_tolerance         = 1e-4          # [s] how closely events are located inside a step
+    analytic_coast          = False         # jump unpowered coasts to apogee or the end of the simulation with a Kepler solve
+    coast_j2                = False         # include J2 secular drift in the analytic coast
     duration                = 6000 # [s] how long to run the simulation
-    theta                   = rotation_angle(timestep)
     mdo                     = True
     output                  = True
     recover                 = False
@@ -109,8 +123,74 @@ class Params(object):
     launch_azimuth          = calc_launch_azimuth(latitude, inclination, injection, apogee, direction) # [deg]
     launch_azimuth          = 220.0
     optimized               = False
+    pitchover_solver        = 'pi'      # 'pi' runs the proportional loop the stored angles were found with, 'brent' or 'secant' bracket the injection angle error, 'multisection' searches it in parallel
+    workers                 = 1         # processes for parallel searches
+    cache                   = None      # file of the persistent result cache, None to fly every configuration
+    memo_size               = 256       # evaluations optimizers keep in memory
+    memo_tolerance          = 1e-9      # inputs closer than this are evaluated once [deg, kg, -]
     trajectory_params = {
         'pitchover_angle'   : pitchover_angle,      # [deg]
         'coast_time'        : 5.0,                  # [s]
         'pitchover'         : [15.0, 16.0]          # [s] T+ start / end pitchover
     }
+
+
+
+
+def freeze(value):
+    ''' Returns a value with its lists turned into tuples and its dicts into FrozenDicts. '''
+
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+
+    return value
+
+
+
+
+class FrozenDict(dict):
+    ''' A dict that can not be modified and hashes by value, for the dict fields of a Config. '''
+
+    def __hash__(self):
+
+        return hash(tuple(sorted(self.items())))
+
+
+    def __reduce__(self):
+
+        return (FrozenDict, (dict(self),))
+
+
+    def _frozen(self, *args, **kwargs):
+
+        raise TypeError('FrozenDict can not be modified')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _frozen
+
+
+
+
+class Config(namedtuple('Config', [name for name in dir(Params) if not name.startswith('_')])):
+    ''' An immutable Params, with a field for every one of its attributes. It compares and
+        hashes by value, pickles for worker processes and is used wherever Params is, so
+        variants are derived with replace() rather than by modifying Params or subclassing it.
+        Fields that Params computes from others, such as the launch azimuth from the
+        inclination, are not recomputed by replace().
+    '''
+
+    __slots__ = ()
+
+
+    @classmethod
+    def from_params(cls, params=Params):
+        ''' Returns the Config of a Params class, or of another Config. '''
+
+        return cls(**dict((name, freeze(getattr(params, name))) for name in cls._fields))
+
+
+    def replace(self, **fields):
+        ''' Returns a copy with the given fields changed. '''
+
+        return self._replace(**dict((name, freeze(value)) for name, value in fields.items()))
@@ -1,40 +1,223 @@
+import os
 import copy
+import json
+import multiprocessing
 import numpy                as np
 import pandas               as pd
 import matplotlib.pyplot    as plt
 import matplotlib.tri       as tri
+from concurrent.futures     import ProcessPoolExecutor, as_completed
 from rocket                 import compute_max_payload
-from params                 import Params
+from params                 import Params, Config
 from azimuth                import calc_launch_azimuth
 
 
 
 
-def calc_performance(inclinations, apogees):
+def cell_params(inclination, apogee):
+    ''' Returns the Config of one cell of the envelope, derived from Params.
+    '''
 
-        data                            = np.ndarray(shape=(len(inclinations), len(apogees)))
+    launch_site                         = 'psc-kodiak' if inclination >= 60.0 else 'hawaii'
+    latitude, longitude, altitude       = Params.coordinates[launch_site][:3]
+
+    return Config.from_params(Params).replace(
+        inclination                     = inclination,
+        launch_site                     = launch_site,
+        latitude                        = latitude,
+        longitude                       = longitude,
+        altitude                        = altitude,
+        apogee                          = apogee,
+        perigee                         = apogee,
+        launch_azimuth                  = calc_launch_azimuth(latitude, inclination, Params.injection, apogee, Params.direction))
+
+
+
+
+def calc_cell(inclination, apogee, payload=100.0, pitchover_angle=None, params=None):
+    ''' Computes the maximum payload of one cell of the envelope.
+
+        Arguments:
+            inclination: [deg]
+            apogee: [km]
+            payload: first guess [kg].
+            pitchover_angle: first guess [deg], defaults to that of the launch site.
+            params: Config of the cell, defaults to cell_params(inclination, apogee).
+
+        Returns:
+            dict of the cell's inclination [deg], apogee [km], maximum payload [kg], pitchover
+            angle [deg], the payloads and ascents flown to find them, and whether the first
+            guesses were seeded from neighbouring cells.
+    '''
+
+    seeded                              = pitchover_angle is not None
+    step                                = 2.0 if seeded else 10.0                       # [kg] a seeded guess is close to the root
+    params                              = cell_params(inclination, apogee) if params is None else params
+    rocket                              = compute_max_payload(payload, step, params=params, pitchover_angle=pitchover_angle)
+
+    return {
+        'inclination'                   : inclination,
+        'apogee'                        : apogee,
+        'payload'                       : float(rocket.payload),
+        'pitchover_angle'               : float(rocket.trajectory.pitchover_angle),
+        'payloads'                      : rocket.solver_stats['evaluations'],
+        'ascents'                       : sum([h['ascents'] for h in rocket.payload_history]),
+        'converged'                     : bool(rocket.solver_stats['converged']),
+        'seeded'                        : seeded
+    }
+
+
+
+
+def seed_cell(cells, inclinations, apogees, x, y):
+    ''' Predicts the maximum payload and pitchover angle of cell (x, y) from its solved
+        neighbours. Along each axis of the grid, the nearest solved cell on either side is
+        extrapolated linearly through the one beyond it, or taken as it is if that one is
+        not solved, and the predictions are averaged. Cells that did not converge are
+        ignored.
+
+        Returns:
+            payload [kg] and pitchover angle [deg], or None, None without a solved neighbour.
+    '''
+
+    def solved(x, y):
+        if 0 <= x < len(inclinations) and 0 <= y < len(apogees):
+            cell                        = cells.get((inclinations[x], apogees[y]))
+            if cell is not None and cell['converged']:
+                return np.array([cell['payload'], cell['pitchover_angle']])
+        return None
+
+    predictions                         = []
+
+    for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        near                            = solved(x + dx, y + dy)
+        far                             = solved(x + 2 * dx, y + 2 * dy)
+        if near is not None:
+            predictions.append(near if far is None else 2.0 * near - far)
+
+    if not predictions:
+        return None, None
+
+    payload, pitchover_angle            = np.mean(predictions, axis=0)
+
+    return float(payload), float(pitchover_angle)
+
+
+
+
+def cell_file(directory, inclination, apogee):
+
+    return os.path.join(directory, 'cell_%g_%g.json' % (inclination, apogee))
 
-        for x, i in enumerate(inclinations):
 
-            Params.inclination          = i
-            Params.launch_site          = 'psc-kodiak' if i >= 60.0 else 'hawaii'
-            Params.latitude             = Params.coordinates[Params.launch_site][0]
-            Params.longitude            = Params.coordinates[Params.launch_site][1]
-            Params.altitude             = Params.coordinates[Params.launch_site][2]
 
-            for y, j in enumerate(apogees):
 
-                Params.apogee           = j
-                Params.perigee          = j
-                Params.launch_azimuth   = calc_launch_azimuth(Params.latitude, Params.inclination, Params.injection, Params.apogee, Params.direction)
-                rocket                  = compute_max_payload()
+def sweep_performance(inclinations, apogees, workers=None, directory='envelope_cells', warm_start=True):
+    ''' Computes the maximum payload of every cell of the envelope, the cells farmed out to a
+        process pool. Each finished cell is written to its own file in directory as soon as
+        it completes, and cells already on disk are read back instead of flown again, so a
+        sweep that was interrupted resumes where it stopped. The workers start the platform's
+        default way, so each cell's Config is derived here and handed to its worker, which
+        may not share this process's Params.
 
-                data[x][y]              = rocket.payload
+        With warm_start, the sweep spreads out from the first cell like a wavefront: a cell
+        is only started once one of its neighbours is solved, with its first guesses seeded
+        from them by seed_cell(). Without it, every cell starts cold at once.
+
+        Arguments:
+            inclinations: [deg]
+            apogees: [km]
+            workers: processes, defaults to Params.workers.
+            directory: where the cells are written.
+            warm_start: seed cells from their solved neighbours.
+
+        Returns:
+            dict of the cells as calc_cell() returns them, by (inclination, apogee).
+    '''
+
+    workers                             = Params.workers if workers is None else workers
+    cells                               = {}
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for i in inclinations:
+        for j in apogees:
+            if os.path.isfile(cell_file(directory, i, j)):
+                with open(cell_file(directory, i, j)) as file:
+                    cells[(i, j)]       = json.load(file)
+
+    remaining                           = [(x, y) for x in range(len(inclinations)) for y in range(len(apogees)) if (inclinations[x], apogees[y]) not in cells]
+    print("Cells: %i, on disk: %i, to fly: %i" % (len(inclinations) * len(apogees), len(cells), len(remaining)))
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context()) as pool:
+
+        futures                         = {}
+
+        def submit(x, y):
+            payload, pitchover_angle    = seed_cell(cells, inclinations, apogees, x, y) if warm_start else (None, None)
+            payload                     = 100.0 if payload is None else payload
+            future                      = pool.submit(calc_cell, inclinations[x], apogees[y], payload, pitchover_angle, cell_params(inclinations[x], apogees[y]))
+            futures[future]             = (x, y)
+            remaining.remove((x, y))
+
+        def submit_ready():
+            # cells next to a solved one, or the first cell left if none is
+            ready                       = [(x, y) for x, y in remaining if not warm_start or
+                                            any((inclinations[x + dx], apogees[y + dy]) in cells for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+                                                if 0 <= x + dx < len(inclinations) and 0 <= y + dy < len(apogees))]
+            if not ready and not futures and remaining:
+                ready                   = remaining[:1]
+            for x, y in ready:
+                submit(x, y)
+
+        submit_ready()
+
+        while futures:
+
+            future                      = next(as_completed(futures))
+            x, y                        = futures.pop(future)
+            i, j                        = inclinations[x], apogees[y]
+            cells[(i, j)]               = future.result()
+
+            # write to a temporary file first, so a crash never leaves half a cell on disk
+            path                        = cell_file(directory, i, j)
+            with open(path + '.tmp', 'w') as file:
+                json.dump(cells[(i, j)], file, indent=4)
+            os.replace(path + '.tmp', path)
+
+            print("Inclination: %.1f, Apogee: %.1f, Payload: %.2f, payloads: %i, ascents: %i, seeded: %r" % \
+                (i, j, cells[(i, j)]['payload'], cells[(i, j)]['payloads'], cells[(i, j)]['ascents'], cells[(i, j)]['seeded']))
+
+            submit_ready()
+
+    # ascents saved by seeding, against the cold cells of this sweep
+    cold                                = [c['ascents'] for c in cells.values() if not c.get('seeded')]
+    warm                                = [c['ascents'] for c in cells.values() if c.get('seeded')]
+    if cold and warm:
+        print("Ascents per cell, cold: %.1f, seeded: %.1f, saved: %i of %i" % \
+            (np.mean(cold), np.mean(warm), int(round(np.mean(cold) * len(warm) - sum(warm))), int(round(np.mean(cold) * len(warm)))))
+
+    return cells
+
+
+
+
+def calc_performance(inclinations, apogees, workers=None, directory='envelope_cells', warm_start=True):
+
+        cells                           = sweep_performance(inclinations, apogees, workers, directory, warm_start)
+        data                            = np.ndarray(shape=(len(inclinations), len(apogees)))
+
+        for x, i in enumerate(inclinations):
+            for y, j in enumerate(apogees):
+                data[x][y]              = cells[(i, j)]['payload']
 
 
         df                              = pd.DataFrame(index=inclinations, columns=apogees, data=data)
         df.to_excel('performance_envelope2.xlsx')
 
+        return df
+
 
 
 
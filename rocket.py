@@ -1,12 +1,12 @@
 import math
-import copy
+import time
 import orbital
 from constants          import g_earth
-from functions          import tabs
+from functions          import tabs, normalize
 from params             import Params
 from stage              import Stage
 from vector3d           import Vector3D
-from runge_kutta        import StateVector
+from integrator         import StateArray
 from earth              import Earth
 from atmosphere         import Atmosphere
 from simulation         import Simulation
@@ -14,7 +14,10 @@ from trajectory         import Trajectory
 from flight_recorder    import FlightRecorder
 from visualization      import Render3D
 from dv                 import calc_dv
-from rotation_matrix    import rotate_Z
+from rotation_matrix    import rotate_Z, rotation_angle
+from solvers            import solve, broyden
+from cache              import get_cache
+from drag               import get_drag_table
 
 class Rocket(object):
 
@@ -34,10 +37,13 @@ class Rocket(object):
         self.velocity_rel       = Vector3D([0,0,0])
         self.init_position      = self.position.copy()
 
+        # position and velocity states of every stage plus the fairing
+        self.states             = StateArray(params.stages + 1)
+
         # fairing
-        self.fairing            = params.fairing
-        self.fairing.state      = StateVector(self.position, self.velocity)
-        self.fairing.state_rel  = StateVector(self.position_rel, self.velocity_rel)
+        self.fairing            = params.fairing()
+        self.fairing.state      = self.states.allocate(self.position, self.velocity, self.position_rel, self.velocity_rel)
+        self.fairing.drag_table = get_drag_table(params.drag, self.fairing.C_d, 'fairing')
 
         # stages
         self.stages             = [Stage(x, self) for x in range(params.stages)]
@@ -46,6 +52,7 @@ class Rocket(object):
         self.thrust_GTOW        = self.stages[0].thrust / (self.mass * g_earth)
         self.x_A                = math.pi * (0.5 * self.fairing.diameter) ** 2
         self.C_d                = 0.26
+        self.drag_table         = get_drag_table(params.drag, self.C_d, 'rocket')
 
         # orientation and altitude
         self.orientation        = self.position.unit()
@@ -93,7 +100,7 @@ class Rocket(object):
             prop_mass           = 0.0
 
             # get mass of stage plus all stages above
-            for j in range(Params.stages, -1, -1):
+            for j in range(self.params.stages, -1, -1):
 
                 if j-1 > i:
 
@@ -114,15 +121,17 @@ class Rocket(object):
 
 
 
-    def get_current_state(self):
+    def get_current_state(self, elapsed=0.0):
+        ''' Reads the current state of the rocket.
+
+            Arguments:
+                elapsed: time since launch [s], by which the Earth has rotated under the rocket.
+        '''
 
-        state               = self.stages[-1].state.vector
-        self.position.update([state[0].p, state[1].p, state[2].p])
-        self.velocity.update([state[0].v, state[1].v, state[2].v])
+        state               = self.stages[-1].state
+        state.read(self.position, self.velocity, self.velocity_rel)
 
-        state_rel           = self.stages[-1].state_rel.vector
-        self.position_rel   = rotate_Z(-self.params.theta * self.flight_recorder.counter, self.position)
-        self.velocity_rel.update([state_rel[0].v, state_rel[1].v, state_rel[2].v])
+        self.position_rel   = rotate_Z(-rotation_angle(elapsed), self.position)
 
         self.altitude       = Earth.get_lat_lon(self.position)[2]
         self.downrange      = self.init_position.angle(self.position_rel) * Earth.radius_equator
@@ -164,8 +173,8 @@ class Rocket(object):
                 'Mass: %s %.2f kg '                % (tabs(8), self.stages[x].mass),
                 'Thrust: %s %.1f N '               % (tabs(7), self.stages[x].thrust),
                 'T/W Ratio: %s %.2f '              % (tabs(6), self.stages[x].thrust / (sum([x.mass for x in self.stages[x:]]) * g_earth)),
-                'Engines: %s %i '                  % (tabs(7), Params.engines[x]),
-                'Isp: %s %i '                      % (tabs(9), Params.engine.Isp[j][Params.performance]),
+                'Engines: %s %i '                  % (tabs(7), self.params.engines[x]),
+                'Isp: %s %i '                      % (tabs(9), self.params.engine.Isp[j][self.params.performance]),
                 'Burn Duration: %s %.1f s'         % (tabs(4), self.stages[x].burn_duration),
                 'Tank Height: %s %.2f m '          % (tabs(5), self.stages[x].tank.height),
                 'Tank Mass: %s %.2f kg '           % (tabs(6), self.stages[x].tank.dry_mass),
@@ -202,8 +211,8 @@ class Rocket(object):
             import pyexcel
 
             data = [['diameter', self.diameter * 1000, 'mm'], ['fairingLength', self.fairing.length * 1000, 'mm']]
-            data += [['engine_offset', Params.engine.offset, 'mm']]
-            data += [['stage_offset', self.stages[1].tank.height + Params.engine.height + Params.engine.offset, 'mm']]
+            data += [['engine_offset', self.params.engine.offset, 'mm']]
+            data += [['stage_offset', self.stages[1].tank.height + self.params.engine.height + self.params.engine.offset, 'mm']]
 
             for x, stage in enumerate(self.stages):
                 data += [['fuelTank%i_height'   % (x+1), round(self.stages[x].tank.fuel_h * 1000, 0), 'mm']]
@@ -215,31 +224,264 @@ class Rocket(object):
 
 
 
-# Recursive
+def calc_propellant_margin(rocket, apogee_weight=0.0):
+    ''' Returns the propellant left in the last stage of a flown rocket beyond what the
+        circularization burn and the residuals need [kg], negative when it falls short.
+
+        Arguments:
+            rocket: flown rocket.
+            apogee_weight: 0 for the margin alone, as the payload loop has always used it.
+                A stage that burned out below the target apogee keeps only its reserves,
+                so that margin stays positive there. With a weight, the apogee it still
+                lacked counts against it instead, apogee_weight kilograms per kilometre
+                [kg/km], which moves the maximum payload.
+    '''
+
+    sim                 = rocket.trajectory.simulation
+    stage               = rocket.stages[-1]
+    margin              = stage.prop_mass - (sim.circ_fuel + sim.circ_lox + stage.fuel_resid + stage.lox_resid)
+
+    if apogee_weight and sim.check_apogee() == False:
+        apogee          = orbital.utilities.altitude_from_radius(sim.keplerian[1], body=orbital.earth) / 1000.0
+        margin          = min(margin, 0.0) - apogee_weight * (rocket.params.apogee - apogee)
+
+    return margin
+
+
+
+
+def calc_injection_error(rocket):
+    ''' Returns the injection angle error of a flown rocket, the angle of its velocity above
+        horizontal at the end of the launch phase over a right angle, as optimize_pitchover
+        solves for.
+    '''
 
-def compute_max_payload(error=0.0, integral=0.0, payload=100.0):
+    return normalize(math.pi * 0.5 - rocket.trajectory.simulation.injection_angle, 0.0, math.pi * 0.5)
 
+
+
+
+def compute_max_payload(payload=100.0, step=10.0, method='pi', xtol=0.1, ftol=0.01, max_iterations=50, params=None, pitchover_angle=None, apogee_weight=None):
+    ''' Finds the largest payload that still reaches orbit, as the root of the propellant
+        margin. Every payload tried flies a new rocket with its pitchover optimized.
+
+        'pi' is the proportional-integral loop the payload has always been found with. It
+        steps the payload by the margin until the margin turns negative, and every payload
+        starts its pitchover from pitchover_angle. 'brent' and 'secant' bracket the root
+        instead, and start the pitchover from the angle solved for the nearest payload
+        already tried. The legacy margin stays positive where the last stage burns out
+        below the target apogee, so they solve the apogee weighted margin, which can put the
+        maximum payload a little higher.
+
+        Arguments:
+            payload: first guess [kg].
+            step: first bracketing step [kg], unused by 'pi'.
+            method: 'pi', 'brent' or 'secant', see solvers.solve().
+            xtol: payload tolerance [kg], unused by 'pi'.
+            ftol: propellant margin tolerance [kg], unused by 'pi'.
+            max_iterations: most payloads to fly.
+            params: Params of the rockets, defaults to Params.
+            pitchover_angle: first guess of the pitchover [deg], defaults to that of params.
+            apogee_weight: see calc_propellant_margin() [kg/km], defaults to 0 for 'pi' and
+                to 1 for 'brent' and 'secant'.
+
+        Returns:
+            the rocket flown with the largest payload that kept a positive margin, or with
+            the solver's estimate if none did. Its payload_history lists every payload
+            tried in order, with the propellant margin, pitchover angle and ascents flown, and
+            its solver_stats are those of the payload solve.
+    '''
+
+    params              = Params if params is None else params
+    apogee_weight       = (0.0 if method == 'pi' else 1.0) if apogee_weight is None else apogee_weight
+    rockets             = {}
+    history             = []
+
+    # a payload already solved for this configuration is taken from Params.cache and flown once
+    cache               = get_cache(params)
+    inputs              = {'payload': payload, 'step': step, 'method': method, 'xtol': xtol, 'ftol': ftol, 'max_iterations': max_iterations,
+                           'pitchover_angle': pitchover_angle, 'apogee_weight': apogee_weight}
+    cached              = cache.get('max_payload', params, **inputs) if cache is not None else None
+
+    if cached is not None:
+        odyne           = Rocket(params)
+        odyne.modify_payload(cached['payload'])
+        odyne.trajectory.pitchover_angle = cached['pitchover_angle']
+        odyne.trajectory.simulate()
+        odyne.payload_history = cached['history']
+        odyne.solver_stats = dict(cached['stats'], cached=True)
+        print("Max payload: %.2f, cached" % cached['payload'])
+        return odyne
+
+    def fly(payload):
+        odyne           = Rocket(params)
+        odyne.modify_payload(payload)
+
+        # warm start the pitchover from the nearest payload solved so far
+        if rockets and method != 'pi':
+            nearest     = min(rockets, key=lambda p: abs(p - payload))
+            odyne.trajectory.pitchover_angle = rockets[nearest].trajectory.pitchover_angle
+        elif pitchover_angle is not None:
+            odyne.trajectory.pitchover_angle = pitchover_angle
+
+        odyne.trajectory.optimize_pitchover()
+        odyne.trajectory.simulate()
+        margin          = float(calc_propellant_margin(odyne, apogee_weight))
+        rockets[payload] = odyne
+
+        history.append({
+            'payload'           : payload,
+            'margin'            : margin,
+            'pitchover_angle'   : odyne.trajectory.pitchover_angle,
+            'ascents'           : odyne.trajectory.solver_stats['evaluations']
+        })
+        print("Payload: %.2f, Margin: %.3f, Pitchover: %.4f" % (payload, margin, odyne.trajectory.pitchover_angle))
+
+        return margin
+
+    if method == 'pi':
+        payload, stats  = _pi_payload(fly, payload, max_iterations)
+    else:
+        payload, stats  = solve(fly, payload, step, 0.0, float('inf'), method, xtol, ftol, max_iterations)
+
+    # the margin jumps as the payload crosses discrete events, settle on the side that reaches orbit
+    feasible            = [h['payload'] for h in history if h['margin'] >= 0.0]
+    payload             = max(feasible) if feasible else payload
+    odyne               = rockets[payload]
+    odyne.payload_history = history
+    odyne.solver_stats  = stats
+
+    print("Max payload: %.2f, payloads: %i, ascents: %i, time: %.1f s, converged: %r" % \
+        (payload, stats['evaluations'], sum([h['ascents'] for h in history]), stats['time'], stats['converged']))
+
+    if cache is not None:
+        cache.put('max_payload', params, {'payload': payload, 'pitchover_angle': odyne.trajectory.pitchover_angle, 'history': history, 'stats': stats}, **inputs)
+
+    return odyne
+
+
+
+
+def _pi_payload(fly, payload, max_iterations):
+    ''' The legacy proportional-integral payload loop. Returns the last payload flown before
+        the margin turned negative, and statistics like those of solvers.solve().
+    '''
+
+    start               = time.time()
     gain                = 0.2
     tau_i               = 0.001
-    new_payload         = payload + (gain * error + tau_i * integral)
-    print("Error: %.2f, Integral: %.2f, Payload: %.2f" % (error,integral,new_payload))
-    params              = copy.deepcopy(Params)
+    error               = 0.0
+    integral            = 0.0
+    converged           = False
+
+    for i in range(max_iterations):
+        new_payload     = payload + (gain * error + tau_i * integral)
+        error           = fly(new_payload)
+        integral        += error
+        if error < 0.0:
+            converged   = True
+            break
+        payload         = new_payload
+
+    stats               = {
+        'method'        : 'pi',
+        'evaluations'   : i + 1,
+        'time'          : time.time() - start,
+        'error'         : error,
+        'converged'     : converged
+    }
+
+    return payload, stats
+
+
+
+
+def solve_payload_pitchover(payload=100.0, pitchover_angle=None, workers=None, max_iterations=30, params=None, apogee_weight=1.0):
+    ''' Finds the maximum payload and its pitchover angle together, as the root of the
+        propellant margin and the injection angle error, rather than optimizing the pitchover
+        inside every step of the payload search. Each evaluation is a single ascent of a new
+        rocket with both given, and the Jacobian's finite differences are flown in parallel.
+        The rocket returned is flown through circularization like simulate() does.
+
+        The margin moves in steps of up to a couple of kilograms as the payload crosses
+        discrete events, so it is solved to within half a kilogram, aiming half a kilogram
+        above zero so that a converged payload still reaches orbit. The injection angle
+        error is flat once the rocket injects past horizontal, which it does if the payload
+        grows or the pitchover steepens from a solution. So the solve is kept on the side
+        where it still climbs: finite differences step down, the error is aimed just above
+        zero, and ascents that inject past horizontal are rejected.
+
+        Arguments:
+            payload: first guess [kg].
+            pitchover_angle: first guess [deg], by default the pitchover is optimized for the
+                first payload guess.
+            workers: processes for the finite differences, defaults to params.workers.
+            max_iterations: most Broyden steps.
+            params: Params of the rockets, defaults to Params.
+            apogee_weight: see calc_propellant_margin() [kg/km]. Without it the margin of a
+                stage that burns out below the target apogee is flat, and the Jacobian has
+                nothing to follow there.
+
+        Returns:
+            the rocket flown with the solution. Its solver_stats are those of solvers.broyden(),
+            with the ascents flown for the first guess counted in.
+    '''
+
+    start               = time.time()
+    params              = Params if params is None else params
+    workers             = params.workers if workers is None else workers
+    margin              = 0.5                                           # [kg]
+    injection           = 1e-5
+    ascents             = 0
+
+    if pitchover_angle is None:
+        odyne           = Rocket(params)
+        odyne.modify_payload(payload)
+        odyne.trajectory.optimize_pitchover()
+        pitchover_angle = odyne.trajectory.pitchover_angle
+        ascents         = odyne.trajectory.solver_stats['evaluations']
+
+    # both residuals are settled by the end of the launch phase, which is all each evaluation flies
+    def fly(x):
+        odyne           = Rocket(params)
+        odyne.modify_payload(x[0])
+        odyne.trajectory.pitchover_angle = x[1]
+        odyne.trajectory.simulation = Simulation(odyne, odyne.trajectory)
+        odyne.trajectory.simulation.run_simulation()
+        propellant      = calc_propellant_margin(odyne, apogee_weight)
+        error           = calc_injection_error(odyne)
+        print("Payload: %.3f, Pitchover: %.5f, Margin: %.3f, Injection: %.6f" % (x[0], x[1], propellant, error))
+
+        # past horizontal the injection error is flat and tells the solver nothing
+        if error < -injection:
+            return None
+
+        return [propellant - margin, error - injection]
+
+    x, stats            = broyden(fly, [payload, pitchover_angle],
+                            h           = [-5.0,    -0.01],         # [kg, deg]
+                            lower       = [0.0,     0.0],
+                            upper       = [float('inf'), 10.0],
+                            max_step    = [50.0,    0.2],
+                            xtol        = [0.1,     1e-4],
+                            ftol        = [margin,  injection],
+                            workers     = workers,
+                            max_iterations = max_iterations)
+
+    stats['evaluations'] += ascents
+    stats['rounds']     += ascents
+    stats['time']       = time.time() - start
+
     odyne               = Rocket(params)
-    odyne.modify_payload(new_payload)
-    odyne.trajectory.optimize_pitchover()
+    odyne.modify_payload(x[0])
+    odyne.trajectory.pitchover_angle = x[1]
     odyne.trajectory.simulate()
-    sim                 = odyne.trajectory.simulation
-    stage               = odyne.trajectory.rocket.stages[-1]
-    error               = stage.prop_mass - (sim.circ_fuel + sim.circ_lox + stage.fuel_resid + stage.lox_resid)
-    print(error)
-    integral            += error
+    odyne.solver_stats  = stats
 
-    if error < 0.0:
-        odyne.modify_payload(payload)
-        return odyne
-    else:
-        return compute_max_payload(error, integral, new_payload)
+    print("Payload: %.2f, Pitchover: %.4f, ascents: %i, rounds: %i, time: %.1f s, converged: %r" % \
+        (x[0], x[1], stats['evaluations'], stats['rounds'], stats['time'], stats['converged']))
 
+    return odyne
 
 
 
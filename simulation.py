@@ -1,34 +1,57 @@
 import copy
 import math
 import orbital
+import numpy as np
 from functions      import *
-from runge_kutta    import *
 from units          import *
-from constants      import g_earth, geostationary
+from constants      import g_earth, geostationary, G_const
 from vector3d       import Vector3D
 from earth          import Earth
-from atmosphere     import Atmosphere
+from atmosphere     import get_atmosphere
 from orbit          import Orbit
-from keplerian      import keplerian_orbit, keplerian_elements
+from keplerian      import keplerian_orbit, keplerian_elements, radial_energy, kepler_propagate
 from pyquaternion   import Quaternion
-from dv             import calc_dv
-
-earth = Earth()
-atmosphere = Atmosphere()
+from dv             import calc_dv, calc_mf
+from events         import Event
+from params         import Config
 
 
 
 class Simulation(object):
 
+    # mutable flight state saved by snapshot(), by the object it belongs to
+    flight_state = {
+        'simulation'        : ['started', 'dt', 'dt_next', 'event', 'event_log', 'keplerian', 'apogee', 'circ_fuel', 'circ_lox', 'circ_stats', 'injection', 'injection_angle', 'target_orbit',
+                               'launch_sequence', 'stage_separation', 'circ_burn', 'fairing_status', 'separation_sequence', 'launch_hold', 'liftoff',
+                               'pitchover_status', 'steering', 'stage', 'elapsed', 'geo_transfer', 'acceleration', 'drag', 'gravity_loss', 'drag_loss'],
+        'rocket'            : ['position', 'position_rel', 'velocity', 'velocity_rel', 'orientation', 'altitude', 'downrange', 'mass', 'orbit'],
+        'stage'             : ['throttle', 'dry_mass', 'prop_mass', 'mass', 'fairing_mass', 'residual_mass', 'recovery_status', 'downrange',
+                               'position', 'velocity', 'position_rel', 'velocity_rel'],
+        'tank'              : ['fuel_mass', 'lox_mass'],
+        'nitrogen_tank'     : ['commodity_mass', 'mass'],
+        'fairing'           : ['recovery_status', 'position', 'velocity', 'position_rel', 'velocity_rel'],
+        'trajectory'        : ['pitchover_maneuver', 'rotation_axis'],
+        'flight_recorder'   : ['counter']
+    }
+
     def __init__(self, rocket, trajectory):
 
         self.rocket                     = rocket                                                            # rocket object
         self.params                     = rocket.params
         self.trajectory                 = trajectory                                                        # trajectory object
+        self.earth                      = Earth()
+        self.atmosphere                 = get_atmosphere(rocket.params.atmosphere)
+        self.sea_level_pressure         = self.atmosphere.calc_ambient_pressure(0.0)                        # [Pa]
         self.dt                         = rocket.params.timestep                                            # 0.1 [s] forward increment
+        self.adaptive                   = rocket.params.integrator == 'rk45'                                # error controlled step size
+        self.dt_next                    = self.dt                                                           # proposed size of the next adaptive step
+        self.locate_events              = rocket.params.locate_events or self.adaptive                      # end steps on events rather than check once per step
+        self.event                      = None                                                              # name of the event the last step ended on
+        self.event_log                  = []                                                                # (name, time) of every event located
 
         # orbital elements
         self.injection                  = Orbit(kilo2unit(self.params.injection), kilo2unit(self.params.apogee))      # injection orbit object
+        self.injection_angle            = None                                                              # angle of the velocity from vertical at the end of the launch phase [rad]
         self.target_orbit               = Orbit(kilo2unit(self.params.perigee),   kilo2unit(self.params.apogee))      # target orbit object
 
         self.keplerian                  = keplerian_orbit(self.rocket.position, self.rocket.velocity)       # perigee and apogee velocity based on current state
@@ -44,13 +67,18 @@ class Simulation(object):
         self.separation_sequence        = 0.0
         self.launch_hold                = [0.0, 1.0]
         self.liftoff                    = False
+        self.pitchover_status           = 0
+        self.steering                   = 'vertical'
         self.stage                      = 0
         self.elapsed                    = 0.0
         self.geo_transfer               = False
+        self.started                    = False                                                             # engines started, the flight can be resumed
+        self.coast_steps                = None                                                              # steps of the analytic coast to apogee
 
         # forces
         self.acceleration               = Vector3D([0,0,0])
         self.drag                       = 0.0
+        self.direction                  = Vector3D()                                                        # scratch unit vector for calc_accel
 
         # other
         self.gravity_loss               = 0.0
@@ -58,6 +86,78 @@ class Simulation(object):
 
 
 
+    def snapshot(self):
+        ''' Returns the mutable flight state of the simulation and its rocket: state vectors,
+            tank masses, throttles and flags. Unlike copy.deepcopy(rocket) it leaves out
+            the structure of the vehicle and the flight recorder's data, so that restore()
+            can return a vehicle to it in an optimizer iteration without cloning anything.
+        '''
+
+        rocket              = self.rocket
+        objects             = [(self, 'simulation'), (rocket, 'rocket'), (rocket.fairing, 'fairing'),
+                               (self.trajectory, 'trajectory'), (rocket.flight_recorder, 'flight_recorder')]
+
+        for stage in rocket.stages:
+            objects         += [(stage, 'stage'), (stage.nitrogen_tank, 'nitrogen_tank')] + [(tank, 'tank') for tank in stage.tanks]
+
+        saved               = [(obj, {name: copy_state(getattr(obj, name)) for name in Simulation.flight_state[kind] if hasattr(obj, name)}) for obj, kind in objects]
+
+        return saved, rocket.states.snapshot()
+
+
+
+    def restore(self, snapshot):
+        ''' Returns the simulation and its rocket to a state saved by snapshot(), which can be
+            restored any number of times.
+        '''
+
+        saved, states       = snapshot
+
+        for obj, values in saved:
+            for name, value in values.items():
+                setattr(obj, name, copy_state(value))
+
+        self.rocket.states.restore(states)
+
+
+
+    def run_until(self, t, recover=False, log=False):
+        ''' Starts the flight and runs the launch phase up to time t, stopping before the first
+            step that would end at or past it, and returns a snapshot of that state. Searches
+            whose parameters only affect the flight after t restore each candidate from the
+            snapshot and continue it with run_simulation, rather than flying the shared
+            prefix again.
+
+            Arguments:
+                t: time [s] within the launch phase.
+                recover, log: as for run_simulation.
+
+            Returns:
+                snapshot of the flight at the checkpoint.
+        '''
+
+        self.recover            = recover
+        self.log                = log
+
+        if self.started == False:
+            self.rocket.orbit   = False
+            self.engine_startup_sequence()
+            self.started        = True
+
+        while round(self.elapsed + self.calc_next_step(), 9) < t and self.check_launch_phase_status() == True:
+            self.update_state()
+
+        return self.snapshot()
+
+
+
+    def calc_next_step(self):
+        ''' Returns the length of the next step [s], before any event cuts it short. '''
+
+        return self.calc_adaptive_step() if self.adaptive else self.params.timestep
+
+
+
     def calc_fuel_lox_resid(self):
 
         for i, stage in enumerate(self.rocket.stages):
@@ -76,20 +176,24 @@ class Simulation(object):
 
         self.recover                    = recover
         self.log                        = log
-        self.rocket.orbit               = False
-        self.engine_startup_sequence()                                                                      # expends the necessary prop mass for current stage
+
+        # a flight restored from a checkpoint resumes where it left off
+        if self.started == False:
+            self.rocket.orbit           = False
+            self.engine_startup_sequence()                                                                  # expends the necessary prop mass for current stage
+            self.started                = True
 
         while self.check_launch_phase_status() == True:                                                     # do stuff while launching
             self.update_state()                                                                             # updates the rocket position, velocity state
 
         # returns True or False
         self.rocket.orbit   = self.check_orbit_status()                                                       # did it successfully reach orbit with enough remaining prop mass?
+        self.injection_angle = self.rocket.position.angle(self.rocket.velocity)
 
         # get first stage downrange distance
         if self.recover:
             stage           = self.rocket.stages[0]
-            state_rel       = stage.state_rel.vector
-            p_rel           = Vector3D([state_rel[0].p, state_rel[1].p, state_rel[2].p])
+            p_rel           = stage.state.position_rel
             stage.downrange = self.rocket.init_position.angle(p_rel) * Earth.radius_equator
 
         # continue simulating through circularization
@@ -118,8 +222,7 @@ class Simulation(object):
             self.modified_third_stage()
 
             # new apogee
-            self.params.perigee = geostationary
-            self.params.apogee = geostationary
+            self.params = self.rocket.params = Config.from_params(self.params).replace(perigee=geostationary, apogee=geostationary)
             self.target_orbit = Orbit(self.params.perigee, self.params.apogee)
 
             # geostationary transfer orbit burn
@@ -152,6 +255,11 @@ class Simulation(object):
                 [self.trajectory.pitchover_angle, self.trajectory.coast_time],
                 self.rocket.orbit))
 
+            if self.adaptive:
+                stats = self.rocket.states.stats
+                print("steps %i | rejected %i | evaluations %i | min step %.4f | max step %.2f" % \
+                    (stats['accepted'], stats['rejected'], stats['evaluations'], stats['min_step'], stats['max_step']))
+
 
 
 
@@ -178,12 +286,15 @@ class Simulation(object):
 
 
 
-    def calc_thrust(self):
-        ''' returns force as a scalar. Unit: [N] '''
+    def calc_thrust(self, altitude=None, state=None):
+        ''' returns force as a scalar. Unit: [N]. The ambient pressure is taken from the
+            AtmosphereState at the altitude if one is given.
+        '''
 
+        altitude        = self.rocket.altitude if altitude is None else altitude
         engines         = len(self.rocket.stages[self.stage].engines) * self.params.cores[self.stage]
-        atm_p           = atmosphere.calc_ambient_pressure(self.rocket.altitude)
-        atm_p_norm      = constrain_normalized(atm_p, 0.0, atmosphere.calc_ambient_pressure(0.0))
+        atm_p           = self.atmosphere.calc_ambient_pressure(altitude) if state is None else state.pressure
+        atm_p_norm      = constrain_normalized(atm_p, 0.0, self.sea_level_pressure)
         if self.geo_transfer == True:
             thrust      = self.rocket.stages[self.stage].engines[0].thrust
         else:
@@ -194,23 +305,87 @@ class Simulation(object):
 
 
 
-    def calc_accel(self):
+    def calc_mass_flow(self):
+        ''' returns the rate at which the current stage expends mass. Unit: [kg/s] '''
 
-        thrust          = self.calc_thrust() * self.rocket.stages[self.stage].throttle * self.stage_separation
-        accel           = self.rocket.orientation.unit()
-        accel.scale(thrust/self.rocket.mass)
+        stage           = self.rocket.stages[self.stage]
 
-        if self.rocket.altitude < 85000:
-            self.drag   = atmosphere.calc_drag(self.rocket)
-            drag        = self.rocket.velocity_rel.unit().inverse()
-            drag.scale(self.drag/self.rocket.mass)
+        if self.geo_transfer == True:
+            engine      = stage.engines[0]
+            flow_rate   = (engine.flow_rate['fuel'] + engine.flow_rate['ox']) * len(stage.engines) * stage.throttle * len(stage.tanks)
         else:
-            drag        = Vector3D([0,0,0])
-            self.drag   = 0.0
+            flow_rate   = self.params.engine.flow_rate[self.params.performance] * len(stage.engines) * stage.throttle * self.stage_separation * len(stage.tanks)
+            flow_rate   += self.params.engine.IPS_purge[stage.nitrogen_tank.commodity.id] * len(stage.engines)
+
+        return flow_rate
 
-        g               = earth.calc_gravity(self.rocket.position.magnitude())
-        gravity         = self.rocket.position.unit().inverse()
-        gravity.scale(g)
+
+
+
+    def calc_thrust_direction(self, t, position, velocity, velocity_rel):
+        ''' Returns the thrust direction at an intermediate time and state, following
+            the steering law that update_rocket_orientation selected for the current step.
+        '''
+
+        if self.steering   == 'vertical':
+            return position.unit()
+        elif self.steering == 'pitchover':
+            vector          = self.trajectory.pitchover_maneuver
+            i               = int((t - self.rocket.trajectory.pitchover[0]) * (1/self.trajectory.maneuver_step))
+            return Vector3D(list(vector[max(0, min(i, len(vector)-1))]))
+        elif self.steering == 'prograde':
+            return velocity.unit()
+        elif self.steering == 'gravity_turn' and position.angle(self.rocket.orientation) < position.angle(velocity_rel):
+            return velocity_rel.unit()
+        else:
+            return self.rocket.orientation.unit()
+
+
+
+
+    def calc_accel(self, position=None, velocity=None, velocity_rel=None, mass=None, t=None):
+        ''' Returns the acceleration from thrust, drag and gravity. Defaults to the
+            rocket's current state; passing a time, position, velocities and mass
+            evaluates it at that state instead, leaving the logged drag untouched.
+        '''
+
+        current         = position is None
+
+        if current:
+            position    = self.rocket.position
+            velocity_rel= self.rocket.velocity_rel
+            mass        = self.rocket.mass
+            altitude    = self.rocket.altitude
+            accel       = self.rocket.orientation.unit()
+        else:
+            altitude    = Earth.get_lat_lon(position)[2]
+            accel       = self.calc_thrust_direction(t, position, velocity, velocity_rel)
+
+        # thrust and drag share one evaluation of the atmosphere
+        speed           = velocity_rel.magnitude()
+        state           = self.atmosphere.state(altitude, speed)
+        thrust          = self.calc_thrust(altitude, state) * self.rocket.stages[self.stage].throttle * self.stage_separation
+
+        # angle of attack between the thrust direction and the relative wind, for drag tables by angle
+        angle           = accel.angle(velocity_rel) if self.rocket.drag_table.angles is not None and speed > 0 else 0.0
+        accel.scale(thrust/mass)
+
+        # thrust, drag and gravity are summed into the thrust vector, the unit vectors
+        # of drag and gravity are written into a reused scratch vector
+        acceleration    = accel
+        direction       = self.direction
+
+        if altitude < 85000:
+            drag_force  = self.atmosphere.calc_drag(self.rocket, altitude, velocity_rel, state, angle)
+            acceleration.add_scaled(velocity_rel.unit(out=direction), -(drag_force/mass))
+        else:
+            drag_force  = 0.0
+
+        if current:
+            self.drag   = drag_force
+
+        g               = self.earth.calc_gravity(position.magnitude())
+        acceleration.add_scaled(position.unit(out=direction), -g)
 
 
         # calculate the component of thrust that is negated by gravity
@@ -239,51 +414,216 @@ class Simulation(object):
         # self.drag_loss        += self.drag/self.rocket.mass * self.dt
 
 
-        acceleration    = Vector3D([0,0,0])
-        acceleration.add(accel)
-        acceleration.add(drag)
-        acceleration.add(gravity)
+        return acceleration
 
 
-        return acceleration
 
 
+    def calc_accel_function(self, t0):
+        ''' Returns calc_accel as a function of the state, so that the integrator can
+            re-evaluate thrust, drag and gravity at every Runge-Kutta stage. The steering
+            law is followed through the step while the mass decreases at the current
+            flow rate from its value at the start of the step, t0.
+        '''
 
-    def calc_component_accel(self, component):
+        mass            = self.rocket.mass
+        mass_flow       = self.calc_mass_flow()
 
-        state                   = component.state.vector
-        state_rel               = component.state_rel.vector
-        component.position      = Vector3D([state[0].p, state[1].p, state[2].p])
-        component.velocity      = Vector3D([state[0].v, state[1].v, state[2].v])
-        component.position_rel  = Vector3D([state_rel[0].p, state_rel[1].p, state_rel[2].p])
-        component.velocity_rel  = Vector3D([state_rel[0].v, state_rel[1].v, state_rel[2].v])
+        def accel(t, state, state_rel):
+            position     = Vector3D(state[:3].tolist())
+            velocity     = Vector3D(state[3:].tolist())
+            velocity_rel = Vector3D(state_rel[3:].tolist())
+            return self.calc_accel(position, velocity, velocity_rel, mass - mass_flow * (t - t0), t).points
 
-        pos                     = component.position.copy()
-        vel                     = component.velocity.copy()
-        speed                   = earth.surface_speed(pos)
-        atm_vect                = Vector3D([-pos.y, pos.x, 0]).unit()
-        atm_vect.scale(speed)
-        vel.subtract(atm_vect)
+        return accel
+
+
+
+    def calc_burn_time(self):
+        ''' returns the time until the current stage reaches its residual propellant. Unit: [s] '''
+
+        stage                   = self.rocket.stages[self.stage]
+
+        if self.geo_transfer == True or stage.throttle * self.stage_separation == 0.0:
+            return float('inf')
+
+        if self.stage+1 == self.params.stages:
+            fuel_resid          = self.circ_fuel + stage.fuel_resid
+            lox_resid           = self.circ_lox  + stage.lox_resid
+        else:
+            fuel_resid          = stage.fuel_resid + stage.fuel_shutdown
+            lox_resid           = stage.lox_resid  + stage.lox_shutdown
+
+        flow_rate               = self.params.engine.flow_rate[self.params.performance] * len(stage.engines) * stage.throttle * len(stage.tanks)
+        fuel_rate               = flow_rate / (1 + self.params.engine.ox_f_ratio)
+        lox_rate                = flow_rate - fuel_rate
+
+        fuel                    = sum([tank.fuel_mass for tank in stage.tanks]) - fuel_resid
+        lox                     = sum([tank.lox_mass  for tank in stage.tanks]) - lox_resid
+
+        return max(0.0, min(fuel / fuel_rate, lox / lox_rate))
+
+
+
+
+    def calc_adaptive_step(self):
+        ''' Returns the next adaptive step, shortened so that steps land on the end of the
+            launch hold, the pitchover start and the end of the simulation, and held at the
+            maneuver resolution through the pitchover itself. Everything else that happens
+            inside a step is located by the events.
+        '''
+
+        dt                      = self.dt_next
+        pitchover               = self.rocket.trajectory.pitchover
+
+        if self.launch_hold[0] < self.launch_hold[1]:
+            return self.launch_hold[1] - self.launch_hold[0]
+
+        if self.elapsed < pitchover[0]:
+            dt                  = min(dt, pitchover[0] - self.elapsed)
+        elif self.elapsed < pitchover[1]:
+            dt                  = min(dt, self.trajectory.maneuver_step)
+
+        if self.launch_sequence == False:
+            dt                  = min(dt, self.params.duration - self.elapsed + 1e-6)
+
+        return dt
+
+
+
+
+    def calc_events(self, t0):
+        ''' Returns the events that can end the step starting at t0, for the current phase
+            of flight. Each is checked once per step by check_stage_status, check_apogee,
+            check_circularization_status, update_mass or check_launch_phase_status, which
+            also accept a step that ended on the event.
+        '''
+
+        row                     = self.rocket.stages[-1].state.row
+        stage                   = self.rocket.stages[self.stage]
+        events                  = []
+
+        def altitude(y, row):
+            return Earth.get_lat_lon(Vector3D(y[row, :3].tolist()))[2]
+
+        # propellant down to the residual at the current flow rate
+        burn_time               = self.calc_burn_time()
+        if self.launch_sequence and burn_time < float('inf'):
+            events.append(Event('burnout', lambda t, y: burn_time - (t - t0), direction=-1))
+
+        # end of the coast between stage separation and ignition
+        if self.stage_separation == 0:
+            coast               = self.trajectory.coast_time - self.separation_sequence
+            events.append(Event('ignition', lambda t, y: coast - (t - t0), direction=-1))
+
+        if self.fairing_status == 1:
+            events.append(Event('fairing', lambda t, y: altitude(y, row) - self.rocket.fairing.jettison, direction=1))
+
+        if self.launch_sequence:
+            target_apogee       = orbital.utilities.radius_from_altitude(self.params.apogee*1000, body=orbital.earth)
+            events.append(Event('target_apogee', lambda t, y: radial_energy(Vector3D(y[row, :3].tolist()), Vector3D(y[row, 3:].tolist()), target_apogee), direction=1))
 
-        drag_force              = atmosphere.calc_drag(component)
-        drag                    = vel.unit().inverse()
-        drag.scale(drag_force/component.residual_mass)
+        elif self.recover:
+            for name, component in [('stage_impact', self.rocket.stages[0]), ('fairing_impact', self.rocket.fairing)]:
+                if component.recovery_status == 1:
+                    events.append(Event(name, lambda t, y, r=component.state.row: altitude(y, r), direction=-1))
 
-        g                       = earth.calc_gravity(component.position.magnitude())
-        gravity                 = component.position.unit().inverse()
-        gravity.scale(g)
+        elif self.circ_burn == False:
+            # altitude rate, the velocity along the ellipsoid normal
+            def altitude_rate(t, y):
+                lat, lon, h     = Earth.get_lat_lon(Vector3D(y[row, :3].tolist()))
+                up              = [math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)]
+                return float(np.dot(up, y[row, 3:]))
+            events.append(Event('apogee', altitude_rate, direction=-1))
 
-        acceleration            = Vector3D([0,0,0])
+        elif self.circ_burn == True:
+            target_velocity     = self.target_orbit.velocity_apogee
+            events.append(Event('circularized', lambda t, y: float(np.linalg.norm(y[row, 3:])) - target_velocity, direction=1))
+
+        return events
+
+
+
+    def locate_event(self, t0):
+        ''' Finds the first event that occurred in the step just taken from t0. A terminal
+            event cuts the step short so that it ends just past the event.
+        '''
+
+        states                  = self.rocket.states
+        t1                      = t0 + self.dt
+        y0                      = states.last[3]
+        crossings               = []
+
+        for event in self.calc_events(t0):
+            g0                  = event.function(t0, y0)
+            if event.crossed(g0, event.function(t1, states.y)):
+                crossings.append((event.locate(states.interpolate, t0, t1, g0, self.params.event_tolerance), event))
+
+        if crossings:
+            t, event            = min(crossings, key=lambda c: c[0])
+            self.event_log.append((event.name, t))
+
+            if event.terminal and t < t1:
+                states.retake(t - t0)
+                self.dt         = t - t0
+                self.elapsed    = round(t, 9)
+                self.event      = event.name
+
+
+
+
+    def calc_component_accel(self, component, position=None, velocity=None, velocity_rel=None):
+        ''' Returns the drag and gravity acceleration of a jettisoned component. Defaults to
+            the component's current state, which is also copied onto the component.
+        '''
+
+        if position is None:
+            state                   = component.state
+            component.position      = state.position
+            component.velocity      = state.velocity
+            component.position_rel  = state.position_rel
+            component.velocity_rel  = state.velocity_rel
+            position                = component.position
+            velocity                = component.velocity
+            velocity_rel            = component.velocity_rel
+
+        speed                   = self.earth.surface_speed(position)
+        atm_vect                = Vector3D([-position.y, position.x, 0]).unit()
+        atm_vect.scale(speed)
+        vel                     = velocity.difference(atm_vect)
+
+        drag_force              = self.atmosphere.calc_drag(component, Earth.get_lat_lon(position)[2], velocity_rel)
+        drag                    = drag_force/component.residual_mass
+        g                       = self.earth.calc_gravity(position.magnitude())
+
+        acceleration            = Vector3D()
 
         if component.recovery_status == 1:
-            acceleration.add(drag)
-            acceleration.add(gravity)
+            acceleration.add_scaled(vel.unit(out=self.direction), -drag)
+            acceleration.add_scaled(position.unit(out=self.direction), -g)
 
 
         return acceleration
 
 
 
+    def calc_component_accel_function(self, component):
+        ''' Returns calc_component_accel as a function of the state, re-evaluated at every
+            Runge-Kutta stage.
+        '''
+
+        self.calc_component_accel(component)
+
+        def accel(t, state, state_rel):
+            position     = Vector3D(state[:3].tolist())
+            velocity     = Vector3D(state[3:].tolist())
+            velocity_rel = Vector3D(state_rel[3:].tolist())
+            return self.calc_component_accel(component, position, velocity, velocity_rel).points
+
+        return accel
+
+
+
 
     def update_mass(self):
 
@@ -309,7 +649,7 @@ class Simulation(object):
 
         # if altitude is above the specified fairing jettison, subtract the fairing mass
         # from this stage's dry mass, and then set the fairing mass to zero
-        if self.rocket.altitude   >= self.rocket.fairing.jettison:
+        if self.rocket.altitude   >= self.rocket.fairing.jettison or self.event == 'fairing':
             stage.fairing_mass    -= self.rocket.fairing.mass * self.fairing_status
             self.fairing_status   = 0
 
@@ -324,16 +664,34 @@ class Simulation(object):
     def update_state(self):
 
 
+        # a step cut short by an event or lengthened by a coast is followed by a full one
+        if self.adaptive:
+            self.dt = self.calc_adaptive_step()
+        elif self.locate_events or self.params.analytic_coast:
+            self.dt = self.params.timestep
+
         if self.launch_hold[0] < self.launch_hold[1]:
             self.launch_hold[0] += self.dt
+        elif self.params.analytic_coast and self.check_coast_status():
+            self.coast()
         else:
+            t0 = self.elapsed
+            self.event = None
             self.elapsed += self.dt
-            self.elapsed = round(self.elapsed,1)
+            self.elapsed = round(self.elapsed,9)
             self.update_rocket_orientation()
 
             # the acceleration that should always be applied to the second stage
             self.acceleration = self.calc_accel()
 
+            # either hold that acceleration over the step, or re-evaluate it at every stage
+            if self.params.integrator in ('rk4', 'rk45'):
+                vehicle_accel   = self.calc_accel_function(t0)
+                component_accel = self.calc_component_accel_function
+            else:
+                vehicle_accel   = self.acceleration
+                component_accel = self.calc_component_accel
+
             if self.recover == True:
 
                 # iterate over both stages
@@ -343,18 +701,18 @@ class Simulation(object):
                     if self.stage == 0:
 
                         # apply the normal acceleration
-                        accel = self.acceleration
+                        accel = vehicle_accel
 
                     # if the current stage is the second stage...
                     else:
 
                         # on the first iteration, calculate the BOOSTER acceleration
                         if i == 0:
-                            accel = self.calc_component_accel(stage)
+                            accel = component_accel(stage)
 
                         # otherwise, apply the normal acceleration
                         else:
-                            accel = self.acceleration
+                            accel = vehicle_accel
 
                     # Current Stage: 1
                         # Iteration 1: apply normal accel to 1st stage
@@ -366,25 +724,36 @@ class Simulation(object):
 
                 # calculate acceleration for fairing if it is jettisoned
                 if self.fairing_status == 0:
-                    accel = self.calc_component_accel(self.rocket.fairing)
+                    accel = component_accel(self.rocket.fairing)
                 # otherwise apply normal acceleration for fairing
                 else:
-                    accel = self.acceleration
+                    accel = vehicle_accel
 
                 self.apply_acceleration(self.rocket.fairing, accel)
 
             else:
-                self.apply_acceleration(self.rocket.stages[-1], self.acceleration)
+                self.apply_acceleration(self.rocket.stages[-1], vehicle_accel)
+
+            # advance every body in a single vectorized step, an adaptive step may be
+            # shorter than proposed, in which case the clock follows the step taken
+            if self.adaptive:
+                self.dt, self.dt_next = self.rocket.states.step_adaptive(self.dt, t0, self.params.atol, self.params.rtol, self.params.max_timestep, self.params.min_timestep)
+                self.elapsed = round(t0 + self.dt, 9)
+            else:
+                self.rocket.states.step(self.dt, t0)
+
+            if self.locate_events:
+                self.locate_event(t0)
 
 
         if self.stage_separation == 0:
             self.separation_sequence += self.dt
-            if self.separation_sequence >= self.trajectory.coast_time:
+            if self.separation_sequence >= self.trajectory.coast_time or self.event == 'ignition':
                 self.stage_separation = 1
                 self.separation_sequence = 0.0
 
         self.update_mass()
-        self.rocket.get_current_state()
+        self.rocket.get_current_state(self.elapsed)
 
         # # print seconds elapsed
         # if round(self.elapsed * 10) % 10 == 0:
@@ -396,15 +765,101 @@ class Simulation(object):
 
 
 
-    def apply_acceleration(self, stage, accel):
+    def check_coast_status(self):
+        ''' Returns True while the vehicle coasts unpowered above the atmosphere with
+            nothing else to integrate, between SECO and the circularization burn while
+            its altitude still climbs, and after the burn.
+        '''
+
+        stage = self.rocket.stages[self.stage]
+
+        if not (self.launch_sequence == False and self.recover == False and self.geo_transfer == False \
+            and self.circ_burn != True and stage.throttle == 0.0 and self.rocket.altitude > 85000):
+            return False
+
+        if self.circ_burn == False:
+            self.coast_steps = self.calc_coast_steps()
+            return self.coast_steps != 0
+
+        return True
+
+
+
+    def calc_coast_steps(self):
+        ''' Returns the number of whole steps the altitude still climbs on the Kepler orbit,
+            compared from one step to the next as check_circularization_status compares it,
+            or None if it climbs to the end of the simulation. The coast ends after them,
+            so the burn starts on the following step, as it does without the analytic coast.
+            Before the burn this is the geodetic apogee, not the radial apoapsis, which on
+            the oblate Earth can be far apart on a near circular orbit.
+        '''
+
+        state       = self.rocket.stages[-1].state
+        position    = state.position
+        velocity    = state.velocity
+        mu          = G_const * Earth.mass
+        h           = self.params.timestep
+        last        = int((self.params.duration - self.elapsed) / h)
+        chunk       = 100                                                   # steps between checks of the climb
+        altitudes   = {}
+
+        def altitude(k):
+            if k not in altitudes:
+                altitudes[k] = Earth.get_lat_lon(kepler_propagate(position, velocity, k * h, mu, self.params.coast_j2)[0])[2]
+            return altitudes[k]
+
+        def falls(k):
+            return altitude(k + 1) < altitude(k)
+
+        if falls(0):
+            return 0
+
+        # the first chunk of steps that starts falling, then its first falling step
+        low, high   = 0, min(chunk, last)
+        while not falls(high):
+            if high == last:
+                return None
+            low, high = high, min(high + chunk, last)
+
+        while high - low > 1:
+            middle  = (low + high) // 2
+            if falls(middle):
+                high = middle
+            else:
+                low = middle
+
+        return high
+
+
+
+    def coast(self):
+        ''' Propagates an unpowered coast with a single Kepler solve, to the last step before
+            apogee ahead of the circularization burn, see calc_coast_steps(), and to the end
+            of the simulation after it.
+        '''
+
+        state       = self.rocket.stages[-1].state
+        mu          = G_const * Earth.mass                                  # matches self.earth.calc_gravity
+        dt          = self.params.duration - self.elapsed + 1e-6
+        self.event  = None
 
-        # update position and velocity
-        for s, a in zip(stage.state.vector, accel.points):
-            rk4(s, a, self.dt)
+        if self.circ_burn == False and self.coast_steps is not None:
+            dt      = self.coast_steps * self.params.timestep
 
-        # update relative position and velocity
-        for s, a in zip(stage.state_rel.vector, accel.points):
-            rk4(s, a, self.dt)
+        position, velocity = kepler_propagate(state.position, state.velocity, dt, mu, self.params.coast_j2)
+        state.propagate(position, velocity, dt)
+
+        self.dt      = dt
+        self.elapsed = round(self.elapsed + dt, 9)
+
+
+
+
+    def apply_acceleration(self, stage, accel):
+
+        # queue the acceleration for both the inertial and relative state,
+        # applied to every body at once by StateArray.step
+        stage.state.accelerate(accel)
 
 
 
@@ -412,27 +867,46 @@ class Simulation(object):
 
     def update_rocket_orientation(self):
 
-        if self.elapsed < self.rocket.trajectory.pitchover[0]:
+        pitchover                = self.rocket.trajectory.pitchover
+
+        # steering law followed through the step when acceleration is re-evaluated at every stage
+        self.steering            = 'hold'
+
+        if self.elapsed < pitchover[0]:
             self.rocket.orientation = self.rocket.position.unit()
+            self.steering        = 'vertical'
 
-        elif self.elapsed == self.rocket.trajectory.pitchover[0]:
+        # first step at or past the pitchover start, with long timesteps this may already be past it
+        elif self.pitchover_status == 0:
             self.rocket.orientation = self.rocket.position.unit()
             self.trajectory.calc_pitchover()
+            self.pitchover_status   = 1
 
-        elif self.elapsed > self.rocket.trajectory.pitchover[0] and self.elapsed <= self.rocket.trajectory.pitchover[1]:
+            if self.elapsed > pitchover[0]:
+                self.update_rocket_orientation()
+
+        # the maneuver is indexed by time so it is independent of the timestep, and always
+        # completes even when a step jumps past the pitchover end
+        elif self.elapsed <= pitchover[1] or self.pitchover_status == 1:
             vector               = self.trajectory.pitchover_maneuver
-            i                    = int((self.elapsed - self.rocket.trajectory.pitchover[0]) * (1/self.dt))
-            self.rocket.orientation.update(vector[i])
+            i                    = int((self.elapsed - pitchover[0]) * (1/self.trajectory.maneuver_step))
+            self.rocket.orientation.update(vector[min(i, len(vector)-1)])
+            self.steering        = 'pitchover'
+
+            if self.elapsed >= pitchover[1]:
+                self.pitchover_status = 2
 
         else:
 
             if self.rocket.orbit == True:
                 self.rocket.orientation = self.rocket.velocity.unit()
+                self.steering        = 'prograde'
 
             else:
 
                 v_angle              = self.rocket.position.angle(self.rocket.velocity_rel)
                 o_angle              = self.rocket.position.angle(self.rocket.orientation)
+                self.steering        = 'gravity_turn'
 
                 if o_angle < v_angle:
                     if v_angle > math.radians(90.0):
@@ -440,6 +914,7 @@ class Simulation(object):
                         q = Quaternion(axis=self.trajectory.rotation_axis.points, degrees=math.degrees(d))
                         o = q.rotate(self.rocket.orientation.points)
                         self.rocket.orientation.update(o)
+                        self.steering    = 'hold'
                     else:
                         self.rocket.orientation = self.rocket.velocity_rel.unit()
 
@@ -467,9 +942,9 @@ class Simulation(object):
                 # print(altitude_stage, altitude_fairing)
 
                 # check altitudes, set recovery status to zero if altitude is zero
-                if round(altitude_stage) <= 0:
+                if round(altitude_stage) <= 0 or self.event == 'stage_impact':
                     stage.recovery_status               = 0
-                if round(altitude_fairing) <= 0:
+                if round(altitude_fairing) <= 0 or self.event == 'fairing_impact':
                     self.rocket.fairing.recovery_status      = 0
 
                 # if both stage and fairing altitudes are zero, then end
@@ -496,13 +971,22 @@ class Simulation(object):
 
 
 
-    def calc_circularization_prop(self):
+    def calc_circularization_prop(self, tolerance=1e-6):
+        ''' Returns the fuel and lox needed to circularize at the target apogee, engine start
+            quantities included. The propellant is carried through the burn, so it is solved
+            as the fixed point of the rocket equation, inverted for the final mass, with the
+            propellant added to the initial mass. Each pass shrinks the change by the fraction
+            of the mass burned, a few percent.
 
-        # circularization dV
-        circ_dV             = self.target_orbit.velocity_apogee - self.injection.velocity_apogee
+            Arguments:
+                tolerance: change in the propellant between passes to stop at [kg].
+
+            Leaves the number of passes and whether they met the tolerance within 50 in
+            circ_stats, like the statistics of the solvers.
+        '''
 
-        # increment size
-        stepsize            = 0.1  # [kg]
+        # circularization dV
+        circ_dV             = max(self.target_orbit.velocity_apogee - self.injection.velocity_apogee, 0.0)
 
         # last stage
         stage               = self.rocket.stages[-1]
@@ -515,21 +999,22 @@ class Simulation(object):
         start_lox           = self.params.engine.Start['LOx']      * len(stage.engines) * self.params.cores[-1]
 
         circ_prop           = 0.0
+        converged           = False
 
-        for i in range(3):
+        for i in range(50):
 
-            # second stage dry mass plus residual propellant
+            # second stage dry mass plus residual propellant, plus the propellant for the burn
             m0                  = stage.dry_mass + stage.fuel_resid + stage.lox_resid + circ_prop
-            mf                  = m0
-            dv                  = 0.0
-
-            # iterate until dv is sufficient for circularization burn
-            while dv < circ_dV:
-                mf              -= stepsize                                         # de-increment initial mass to get final mass
-                dv              = calc_dv(m0, mf, isp)                              # compute delta-v
 
             # different between initial mass and final mass is the propellant required for burn
-            circ_prop = m0 - mf
+            prop                = m0 - calc_mf(m0, circ_dV, isp)
+            converged           = abs(prop - circ_prop) <= tolerance
+            circ_prop           = prop
+
+            if converged:
+                break
+
+        self.circ_stats     = {'evaluations': i + 1, 'converged': converged}
 
         # compute fuel and lox mass from prop mass
         circ_fuel           = circ_prop / (1 + self.params.engine.ox_f_ratio)
@@ -551,7 +1036,7 @@ class Simulation(object):
 
         # status
         target_apogee                   = orbital.utilities.radius_from_altitude( self.rocket.params.apogee*1000, body=orbital.earth)
-        status                          = apogee >= target_apogee
+        status                          = apogee >= target_apogee or self.event == 'target_apogee'
 
         # if status:
         #     print("Apogee: %f, Perigee: %f" % (apogee, perigee))
@@ -602,7 +1087,7 @@ class Simulation(object):
 
         # check mass in both fuel and oxidizer tanks, if either are less than the
         # computed residual mass
-        if sum([tank.fuel_mass for tank in stage.tanks]) <= fuel_resid or sum([tank.lox_mass for tank in stage.tanks]) <= lox_resid:
+        if sum([tank.fuel_mass for tank in stage.tanks]) <= fuel_resid or sum([tank.lox_mass for tank in stage.tanks]) <= lox_resid or self.event == 'burnout':
             # if on last stage
             if self.stage+1 == self.params.stages:
                 self.stage_separation = 0
@@ -622,8 +1107,7 @@ class Simulation(object):
     def separate_stage(self):
 
         stage                       = self.rocket.stages[0]
-        state_rel                   = stage.state_rel.vector
-        p_rel                       = Vector3D([state_rel[0].p, state_rel[1].p, state_rel[2].p])
+        p_rel                       = stage.state.position_rel
         downrange                   = self.rocket.init_position.angle(p_rel) * Earth.radius_equator
 
         stage                       = self.rocket.stages[self.stage]
@@ -683,14 +1167,14 @@ class Simulation(object):
         # print(self.rocket.velocity.magnitude())
 
         # start circularization burn once apogee is reached
-        if self.rocket.altitude < self.apogee and self.circ_burn == False:
+        if (self.rocket.altitude < self.apogee or self.event == 'apogee') and self.circ_burn == False:
             self.rocket.stages[self.stage].throttle = self.rocket.params.throttle[self.stage]
             self.circ_burn = True
             self.target_orbit = Orbit(self.rocket.altitude, self.rocket.altitude)      # target orbit object
 
 
         # end circularization burn once desired velocity is attained
-        if self.circ_burn == True and self.rocket.velocity.magnitude() >= self.target_orbit.velocity_apogee:
+        if self.circ_burn == True and (self.rocket.velocity.magnitude() >= self.target_orbit.velocity_apogee or self.event == 'circularized'):
             self.rocket.stages[self.stage].throttle = 0.0
             self.circ_burn = -1
             # status = False
@@ -737,4 +1221,63 @@ class Simulation(object):
         stage.throttle = 1.0
 
 
+
+
+def copy_state(value):
+    ''' Copies the mutable values held in the flight state, vectors and lists, others are shared. '''
+
+    if isinstance(value, (Vector3D, list, dict)):
+        return copy.copy(value)
+
+    return value
+
+
+
+
 # end
+
+
+
+
+
+if __name__ == "__main__":
+
+    from params import Params, Config
+    from rocket import Rocket
+
+    def stepped(simulation, stepsize=0.1):
+        ''' The circularization propellant and start quantities found by stepping the final
+            mass down in three passes, as they were before the fixed point, for comparison.
+        '''
+
+        params      = simulation.params
+        stage       = simulation.rocket.stages[-1]
+        circ_dV     = simulation.target_orbit.velocity_apogee - simulation.injection.velocity_apogee
+        isp         = params.engine.Isp['VAC'][params.performance]
+        start       = (params.engine.Start['Kerosene'] + params.engine.Start['LOx']) * len(stage.engines) * params.cores[-1]
+        circ_prop   = 0.0
+
+        for i in range(3):
+            m0      = stage.dry_mass + stage.fuel_resid + stage.lox_resid + circ_prop
+            mf      = m0
+            dv      = 0.0
+            while dv < circ_dV:
+                mf  -= stepsize
+                dv  = calc_dv(m0, mf, isp)
+            circ_prop = m0 - mf
+
+        return circ_prop + start
+
+    # the stepped propellant rounds up to its 0.1 kg step, and three passes leave well under
+    # a gram of the fixed point unsolved, so the two agree within one step
+    tolerance       = 0.1                                                   # [kg]
+
+    for apogee, payload in [(400, 60.0), (485, 100.0), (600, 125.0), (800, 40.0), (1200, 10.0)]:
+        rocket      = Rocket(Config.from_params(Params).replace(apogee=apogee, perigee=apogee, payload=payload))
+        simulation  = Simulation(rocket, rocket.trajectory)
+        prop        = simulation.circ_fuel + simulation.circ_lox
+        reference   = stepped(simulation)
+        print("apogee %i km | payload %.1f kg | fixed point %.4f kg in %i passes | stepped %.4f kg | difference %.4f kg" % \
+            (apogee, payload, prop, simulation.circ_stats['evaluations'], reference, reference - prop))
+        assert simulation.circ_stats['converged'], 'circularization propellant did not converge'
+        assert abs(reference - prop) <= tolerance, 'circularization propellant moved %.4f kg from the stepped solution' % (prop - reference)
@@ -0,0 +1,517 @@
+'''
+Bracketing root finders for the trajectory optimizers.
+
+Each evaluation of an objective here is a full ascent, so the solvers are
+written to need as few of them as possible. bracket() steps out from a first
+guess by secant extrapolation until the objective changes sign. brent() or
+secant() then close in on the root inside the bracket without leaving it.
+solve() strings them together, caches every evaluation, and reports how many
+ascents the solve took and how long.
+
+multisection() trades ascents for wall time: each round evaluates a batch of
+points at once in a process pool, first stepping out to bracket the root,
+then splitting the bracket into equal sections and keeping the one that
+still changes sign.
+
+broyden() solves several unknowns against as many residuals at once, so that
+nested one dimensional solves need not be flown inside each other.
+'''
+
+import time
+import pickle
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+# objective of a worker process, set by _initialize()
+_objective  = None
+
+
+
+def bracket(f, x0, f0, step, lower, upper, ftol=0.0, max_iterations=20):
+    ''' Steps from x0 until f changes sign. The step is taken in the direction of increasing x
+        while f is positive, so f must decrease through its root, as the pitchover error does.
+        After the first step, each one extrapolates the secant through the last two points a
+        little past the root it predicts, so a smooth objective is bracketed tightly in a few
+        evaluations. The step can grow at most four times longer than the last.
+
+        Arguments:
+            f: objective function of one variable.
+            x0, f0: first guess and f at it.
+            step: first step size.
+            lower, upper: limits of x.
+            ftol: |f| at which the search stops on a root without bracketing it.
+            max_iterations: most evaluations to spend on the search.
+
+        Returns:
+            a, b, fa, fb with f changing sign between a and b or |fb| <= ftol, or None if
+            neither was found within the limits.
+    '''
+
+    a, fa       = None, None
+    b, fb       = x0, f0
+
+    for i in range(max_iterations):
+
+        if abs(fb) <= ftol:
+            return b, b, fb, fb
+
+        direction   = 1.0 if fb > 0 else -1.0
+
+        if a is None or fa == fb:
+            distance    = step
+        else:
+            distance    = -fb * (b - a) / (fb - fa) * direction * 1.1
+            distance    = min(max(distance, 0.1 * abs(b - a)), 4.0 * abs(b - a))
+
+        x           = min(upper, max(lower, b + direction * distance))
+        if x == b:
+            return None
+
+        a, fa       = b, fb
+        b, fb       = x, f(x)
+
+        if fa * fb < 0.0:
+            return a, b, fa, fb
+
+    return None
+
+
+
+def brent(f, a, b, fa, fb, xtol, ftol, max_iterations=50):
+    ''' Brent's method, inverse quadratic interpolation and secant steps safeguarded by
+        bisection, on a bracket [a, b] where f changes sign.
+
+        Arguments:
+            f: objective function of one variable.
+            a, b, fa, fb: bracket and f at its ends.
+            xtol: width of the bracket at convergence.
+            ftol: |f| at convergence.
+            max_iterations: most evaluations to spend.
+
+        Returns:
+            root estimate, f at it, and whether it converged.
+    '''
+
+    if abs(fa) < abs(fb):
+        a, b, fa, fb = b, a, fb, fa
+
+    c, fc       = a, fa
+    d           = e = b - a
+
+    for i in range(max_iterations):
+
+        if abs(fb) <= ftol:
+            return b, fb, True
+
+        # keep the root between b and c, with b the best estimate
+        if fb * fc > 0.0:
+            c, fc   = a, fa
+            d       = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c     = b, c, b
+            fa, fb, fc  = fb, fc, fb
+
+        tol         = 2e-16 * abs(b) + 0.5 * xtol
+        m           = 0.5 * (c - b)
+
+        if abs(m) <= tol:
+            return b, fb, True
+
+        if abs(e) >= tol and abs(fa) > abs(fb):
+
+            s       = fb / fa
+            if a == c:
+                # secant
+                p   = 2.0 * m * s
+                q   = 1.0 - s
+            else:
+                # inverse quadratic interpolation
+                q   = fa / fc
+                r   = fb / fc
+                p   = s * (2.0 * m * q * (q - r) - (b - a) * (r - 1.0))
+                q   = (q - 1.0) * (r - 1.0) * (s - 1.0)
+
+            if p > 0.0:
+                q   = -q
+            p       = abs(p)
+
+            # accept the interpolation only if it stays well inside the bracket
+            if 2.0 * p < min(3.0 * m * q - abs(tol * q), abs(e * q)):
+                e, d = d, p / q
+            else:
+                d = e = m
+        else:
+            d = e = m
+
+        a, fa       = b, fb
+        b           += d if abs(d) > tol else (tol if m > 0 else -tol)
+        fb          = f(b)
+
+    return b, fb, False
+
+
+
+def secant(f, a, b, fa, fb, xtol, ftol, max_iterations=50):
+    ''' Secant steps on a bracket [a, b] where f changes sign, falling back to bisection
+        whenever a step would leave the bracket.
+
+        Arguments and returns as brent().
+    '''
+
+    for i in range(max_iterations):
+
+        x       = b - fb * (b - a) / (fb - fa) if fb != fa else 0.5 * (a + b)
+        if not min(a, b) < x < max(a, b):
+            x   = 0.5 * (a + b)
+
+        fx      = f(x)
+
+        if abs(fx) <= ftol:
+            return x, fx, True
+
+        # keep the bracket, the newest point replaces the end with the same sign
+        if fx * fb < 0.0:
+            a, fa = b, fb
+        b, fb   = x, fx
+
+        if abs(b - a) <= xtol:
+            return b, fb, True
+
+    return b, fb, False
+
+
+
+def solve(f, x0, step, lower, upper, method='brent', xtol=1e-4, ftol=1e-6, max_iterations=50):
+    ''' Finds a root of f by bracketing it from x0, then closing in with Brent's method
+        or secant steps.
+
+        Arguments:
+            f: objective function of one variable, decreasing through its root.
+            x0: first guess.
+            step: initial bracketing step.
+            lower, upper: limits of x.
+            method: 'brent' or 'secant'.
+            xtol, ftol: convergence tolerances on x and on |f|.
+            max_iterations: most evaluations to spend.
+
+        Returns:
+            root estimate, and a dict of statistics: evaluations, time [s], f at the root,
+            whether it converged and the method.
+    '''
+
+    start           = time.time()
+    cache           = {}
+
+    def evaluate(x):
+        if x not in cache:
+            cache[x] = f(x)
+        return cache[x]
+
+    x, fx           = x0, evaluate(x0)
+    converged       = abs(fx) <= ftol
+
+    if not converged:
+        found       = bracket(evaluate, x0, fx, step, lower, upper, ftol, max_iterations)
+        if found is not None:
+            a, b, fa, fb    = found
+            closer          = secant if method == 'secant' else brent
+            x, fx, converged = closer(evaluate, a, b, fa, fb, xtol, ftol, max_iterations - len(cache))
+        else:
+            # no sign change within the limits, settle for the smallest |f| seen
+            x       = min(cache, key=lambda k: abs(cache[k]))
+            fx      = cache[x]
+
+    stats           = {
+        'method'        : method,
+        'evaluations'   : len(cache),
+        'time'          : time.time() - start,
+        'error'         : fx,
+        'converged'     : converged
+    }
+
+    return x, stats
+
+
+
+
+def _evaluate(x):
+    return _objective(x)
+
+
+
+def _initialize(f):
+    ''' Sets the objective of a worker, handed to it by forking or else pickled. '''
+
+    global _objective
+
+    _objective      = f
+
+
+
+def _picklable(f):
+
+    try:
+        pickle.dumps(f)
+    except Exception:
+        return False
+
+    return True
+
+
+
+def _parallel_map(f, workers):
+    ''' Returns a process pool of workers evaluating f, or None to evaluate it in this process,
+        and a function mapping f over a list of points with it. Workers are forked where the
+        platform can fork, so f need not be picklable. Elsewhere, Windows among them, they
+        are started the platform's default way, which pickles f, and f is evaluated in this
+        process if it can not be pickled. The objective is only set in the workers, so
+        searches in several threads of one process do not share it.
+    '''
+
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        context     = multiprocessing.get_context('fork')
+    elif workers > 1 and _picklable(f):
+        context     = multiprocessing.get_context()
+    else:
+        return None, lambda xs: [f(x) for x in xs]
+
+    pool            = ProcessPoolExecutor(workers, mp_context=context, initializer=_initialize, initargs=(f,))
+
+    return pool, lambda xs: list(pool.map(_evaluate, xs))
+
+
+
+def _shutdown(pool):
+
+    if pool is not None:
+        pool.shutdown()
+
+
+
+def _sign_change(cache, x0):
+    ''' Returns the pair of neighbouring evaluated points closest to x0 where f changes sign,
+        or None.
+    '''
+
+    xs          = sorted(cache)
+    pairs       = [(a, b) for a, b in zip(xs[:-1], xs[1:]) if cache[a] * cache[b] < 0.0]
+
+    if not pairs:
+        return None
+
+    return min(pairs, key=lambda pair: abs(0.5 * (pair[0] + pair[1]) - x0))
+
+
+
+def multisection(f, x0, step, lower, upper, workers=1, batch=4, xtol=1e-4, ftol=1e-6, max_iterations=50):
+    ''' Finds a root of f by evaluating batches of points in parallel. The first batches step
+        out from x0 in doubling steps, as bracket() does, until f changes sign between two
+        points. Each batch after that divides the bracket into batch + 1 equal sections
+        and keeps the one where f still changes sign.
+
+        The objective must give the same value for the same x in any process, see
+        _parallel_map() for how it reaches the workers. The points of a batch only depend
+        on the values of earlier batches and on the batch size, not on the workers, so any
+        number of workers, one included, evaluates the same points and returns the same
+        root; the workers only change the wall time.
+
+        Arguments:
+            f: objective function of one variable, decreasing through its root.
+            x0: first guess.
+            step: initial bracketing step.
+            lower, upper: limits of x.
+            workers: processes evaluating each batch, 1 evaluates it in this process.
+            batch: points per batch, at least 2.
+            xtol, ftol: convergence tolerances on x and on |f|.
+            max_iterations: most batches to evaluate.
+
+        Returns:
+            root estimate, and a dict of statistics as solve(), plus the number of batches.
+    '''
+
+    start           = time.time()
+    cache           = {}
+    batch           = max(2, batch)
+    pool, mapper    = _parallel_map(f, workers)
+
+    def evaluate(xs):
+        xs          = [x for x in sorted(set(xs)) if x not in cache]
+        for x, fx in zip(xs, mapper(xs)):
+            cache[x] = fx
+        return len(xs)
+
+    # step out from x0 until f changes sign, upwards first, then away from x0 on the side of its sign
+    rounds          = 1
+    steps           = {1.0: batch - 1, -1.0: 0}
+    evaluate([x0] + [min(upper, max(lower, x0 + step * 2.0 ** k)) for k in range(batch - 1)])
+    found           = _sign_change(cache, x0)
+
+    while found is None and rounds < max_iterations and min(abs(fx) for fx in cache.values()) > ftol:
+        direction   = 1.0 if cache[x0] > 0.0 else -1.0
+        xs          = [min(upper, max(lower, x0 + direction * step * 2.0 ** k)) for k in range(steps[direction], steps[direction] + batch)]
+        steps[direction] += batch
+        rounds      += 1
+        if evaluate(xs) == 0:
+            break
+        found       = _sign_change(cache, x0)
+
+    # split the bracket into equal sections until it is narrower than xtol
+    while found is not None and rounds < max_iterations:
+        a, b        = found
+        if b - a <= xtol or min(abs(cache[a]), abs(cache[b])) <= ftol:
+            break
+        rounds      += 1
+        if evaluate([a + (b - a) * (i + 1) / (batch + 1) for i in range(batch)]) == 0:
+            break
+        found       = _sign_change(dict((x, cache[x]) for x in cache if a <= x <= b), x0)
+
+    _shutdown(pool)
+
+    candidates      = found if found is not None else list(cache)
+    x               = min(candidates, key=lambda k: abs(cache[k]))
+    converged       = abs(cache[x]) <= ftol or (found is not None and found[1] - found[0] <= xtol)
+
+    stats           = {
+        'method'        : 'multisection',
+        'evaluations'   : len(cache),
+        'rounds'        : rounds,
+        'workers'       : workers,
+        'time'          : time.time() - start,
+        'error'         : cache[x],
+        'converged'     : converged
+    }
+
+    return x, stats
+
+
+
+def broyden(f, x0, h, lower, upper, max_step, xtol, ftol, workers=1, max_iterations=30):
+    ''' Solves f(x) = 0 for a vector of unknowns with Broyden's method. The Jacobian is
+        estimated by forward differences, the n + 1 points evaluated in one batch in a
+        process pool, and then corrected by a rank one update after every step.
+
+        A step is kept if it shortens the Newton step, measured in units of xtol, so that
+        residuals of very different scales are weighed alike. A step that does not, or that
+        lands where f returns None, halves the trust region and the Jacobian is estimated
+        again, a step that is kept doubles it back up to max_step.
+
+        Arguments:
+            f: function of a sequence of n unknowns returning a sequence of n residuals, or
+                None where the residuals are of no use to the solver.
+            x0: first guess, where f must return residuals, as at x0 + h.
+            h: forward difference step of each unknown, negative to step downwards.
+            lower, upper: limits of each unknown.
+            max_step: longest step of each unknown, the Newton step is shortened to fit.
+            xtol: Newton step of each unknown at convergence.
+            ftol: |residual| of each residual at convergence.
+            workers: processes evaluating the finite differences, 1 evaluates them in turn.
+            max_iterations: most Newton steps.
+
+        Returns:
+            solution estimate, and a dict of statistics as solve(), plus the number of
+            batches flown one after another and of Jacobians estimated. The error is the
+            residual vector at the solution.
+    '''
+
+    start           = time.time()
+    x               = np.array(x0, dtype=float)
+    h, lower, upper = np.array(h, dtype=float), np.array(lower, dtype=float), np.array(upper, dtype=float)
+    max_step, xtol  = np.array(max_step, dtype=float), np.array(xtol, dtype=float)
+    ftol            = np.array(ftol, dtype=float)
+    n               = len(x)
+    counts          = {'evaluations': 0, 'rounds': 0, 'jacobians': 0}
+    pool, mapper    = _parallel_map(f, workers)
+
+    def evaluate(points):
+        counts['evaluations'] += len(points)
+        counts['rounds']      += 1
+        return [None if fx is None else np.array(fx, dtype=float) for fx in mapper(points)]
+
+    def jacobian(x, fx=None):
+        # step back rather than past a limit
+        steps       = np.where((x + h > upper) | (x + h < lower), -h, h)
+        points      = [x + np.eye(n)[i] * steps[i] for i in range(n)]
+        values      = evaluate(points if fx is not None else [x] + points)
+        fx          = fx if fx is not None else values.pop(0)
+        counts['jacobians'] += 1
+        return fx, np.array([(values[i] - fx) / steps[i] for i in range(n)]).T
+
+    def newton(J, fx):
+        return -np.linalg.lstsq(J, fx, rcond=None)[0]
+
+    fx, J           = jacobian(x)
+    radius          = 1.0
+    fresh           = True
+    converged       = False
+
+    for i in range(max_iterations):
+
+        dx          = newton(J, fx)
+
+        # the residuals are within tolerance, or the root is within xtol of x
+        if np.all(np.abs(fx) <= ftol) or np.all(np.abs(dx) <= xtol):
+            converged   = True
+            break
+
+        # the trust region shrank below xtol without getting any closer
+        if np.all(radius * max_step <= xtol):
+            break
+
+        dx          *= min(1.0, 1.0 / np.max(np.abs(dx) / (radius * max_step)))
+        x_new       = np.clip(x + dx, lower, upper)
+        dx          = x_new - x
+        f_new       = evaluate([x_new])[0]
+
+        if f_new is not None and np.any(dx != 0.0):
+            J       += np.outer(f_new - fx - J.dot(dx), dx) / dx.dot(dx)
+
+        if f_new is not None and np.linalg.norm(newton(J, f_new) / xtol) < np.linalg.norm(newton(J, fx) / xtol):
+            x, fx   = x_new, f_new
+            radius  = min(1.0, radius * 2.0)
+            fresh   = False
+        else:
+            radius  *= 0.5
+            if not fresh:
+                fx, J   = jacobian(x, fx)
+                fresh   = True
+
+    _shutdown(pool)
+
+    stats           = {
+        'method'        : 'broyden',
+        'evaluations'   : counts['evaluations'],
+        'rounds'        : counts['rounds'],
+        'jacobians'     : counts['jacobians'],
+        'workers'       : workers,
+        'time'          : time.time() - start,
+        'error'         : fx,
+        'converged'     : converged
+    }
+
+    return x, stats
+
+
+
+if __name__ == '__main__':
+
+    import math
+
+    # a monotone objective with a flat stretch, like the pitchover error
+    f = lambda x: math.atan(5.0 * (1.25 - x)) * 0.1 + 0.002 * (1.25 - x) ** 3
+
+    for method in ['brent', 'secant']:
+        x, stats = solve(f, 0.8, 0.1, 0.0, 10.0, method, xtol=1e-6, ftol=1e-9)
+        print('%-6s | root %.8f | %i evaluations | converged %r' % (method, x, stats['evaluations'], stats['converged']))
+
+    # the parallel search visits the same points whatever the number of workers
+    for workers in [1, 2, 4]:
+        x, stats = multisection(f, 0.8, 0.1, 0.0, 10.0, workers, xtol=1e-6, ftol=1e-9)
+        print('multisection x%i | root %.8f | %i evaluations in %i rounds | converged %r' % (workers, x, stats['evaluations'], stats['rounds'], stats['converged']))
+
+    # two unknowns against two residuals, a circle and a line through it
+    g = lambda x: [x[0] ** 2 + x[1] ** 2 - 4.0, x[1] - 0.5 * x[0]]
+    x, stats = broyden(g, [1.0, 1.0], [1e-4, 1e-4], [0.0, 0.0], [10.0, 10.0], [1.0, 1.0], [1e-8, 1e-8], [1e-10, 1e-10])
+    print('broyden | root %.8f %.8f | %i evaluations in %i rounds | converged %r' % (x[0], x[1], stats['evaluations'], stats['rounds'], stats['converged']))
@@ -4,8 +4,8 @@ from constants      import T_stp
 from functions      import normalize
 from engine         import Hadley
 from tanks          import PropellantTank
-from runge_kutta    import StateVector
 from pressure       import moles
+from drag           import get_drag_table
 
 
 class Stage(object):
@@ -15,8 +15,7 @@ class Stage(object):
         self.stage                  = stage
         self.params                 = rocket.params
         self.throttle               = self.params.throttle[stage]
-        self.state                  = StateVector(rocket.position, rocket.velocity)
-        self.state_rel              = StateVector(rocket.position_rel, rocket.velocity_rel)
+        self.state                  = rocket.states.allocate(rocket.position, rocket.velocity, rocket.position_rel, rocket.velocity_rel)
 
         self.mass_ratio             = self.params.mass_ratios[stage]
         self.engines                = [self.params.engine() for _ in range(self.params.engines[stage])]
@@ -69,6 +68,7 @@ class Stage(object):
         self.burn_duration          = self.calc_burn_duration()
         self.x_A                    = math.pi * (0.5 * rocket.diameter) ** 2
         self.C_d                    = 0.5
+        self.drag_table             = get_drag_table(self.params.drag, self.C_d, 'stage')
         self.recovery_status        = 1
 
 
@@ -1,5 +1,6 @@
 import copy
 import math
+import time
 import orbital
 from functions      import *
 from simulation     import Simulation
@@ -8,6 +9,8 @@ from vector3d       import Vector3D
 from pyquaternion   import Quaternion
 from keplerian      import keplerian_orbit, keplerian_elements
 from earth          import Earth
+from solvers        import solve, multisection
+from cache          import get_cache, Memo
 
 
 class Trajectory(object):
@@ -18,7 +21,8 @@ class Trajectory(object):
         self.params              = rocket.params
         self.pitchover           = self.params.trajectory_params['pitchover']
         self.rotation_axis       = self.calc_rotation_axis()
-        self.intermediates       = int((self.pitchover[1]-self.pitchover[0]) * (1/self.params.timestep))
+        self.maneuver_step       = 0.1                                       # [s] resolution of the pitchover maneuver, independent of the timestep
+        self.intermediates       = int((self.pitchover[1]-self.pitchover[0]) * (1/self.maneuver_step))
         self.max_iterations      = 50
         self.coast_time          = self.params.trajectory_params['coast_time']
 
@@ -59,11 +63,82 @@ class Trajectory(object):
 
 
 
-    def optimize_pitchover(self):
+    def optimize_pitchover(self, solver=None):
+        ''' Finds the pitchover angle that injects the rocket horizontally.
 
-        injection                = orbital.utilities.radius_from_altitude( copy.copy(self.params.injection)*1000, body=orbital.earth)
-        target_perigee           = injection
-        target_apogee            = orbital.utilities.radius_from_altitude( copy.copy(self.params.apogee)*1000, body=orbital.earth)
+            Arguments:
+                solver: 'pi' for the proportional loop on the pitchover error, 'brent' or
+                    'secant' to bracket the angle and solve for the root of the injection
+                    angle error, or 'multisection' to search for the same root with batches
+                    of Params.workers ascents flown in parallel. The pitchover error flips
+                    sign with the apogee and perigee checks, so it has no sign change to
+                    bracket; the root finders converge on the injection angle error, where
+                    the proportional loop stops once the error is within its tolerance or
+                    after max_iterations. Defaults to Params.pitchover_solver.
+        '''
+
+        solver                   = self.params.pitchover_solver if solver is None else solver
+
+        # a pitchover already solved for this configuration is taken from Params.cache
+        cache                    = get_cache(self.params)
+        inputs                   = {'payload': self.rocket.payload, 'coast_time': self.coast_time, 'solver': solver}
+        cached                   = cache.get('pitchover', self.params, **inputs) if cache is not None else None
+
+        if cached is not None:
+            self.pitchover_angle = cached['pitchover_angle']
+            self.solver_stats    = {'method': solver, 'evaluations': 0, 'time': 0.0, 'error': cached['error'], 'converged': cached['converged'], 'cached': True}
+            print("Pitchover: %.4f, solver: %s, cached" % (self.pitchover_angle, solver))
+            return
+
+        # every iteration flies the same launch hold and vertical rise up to the pitchover,
+        # which is flown once and checkpointed, each iteration continues from there
+        rocket                   = self.rocket
+        simulation               = Simulation(rocket, self)
+        snapshot                 = simulation.snapshot()
+        checkpoint               = simulation.run_until(self.pitchover[0])
+
+        def ascend(angle):
+            self.pitchover_angle = angle
+            simulation.restore(checkpoint)
+            simulation.run_simulation()
+            return self.calc_pitchover_error(rocket)
+
+        # the solvers come back to angles they have flown, when bracketing or stalled
+        fly                      = Memo(ascend, self.params.memo_size, self.params.memo_tolerance)
+
+        # the injection angle error decreases through zero as the pitchover steepens
+        x0                       = self.pitchover_angle if self.pitchover_angle > 0.0 else self.params.pitchover_angle
+
+        if solver == 'pi':
+            self.solver_stats    = self.optimize_pitchover_pi(fly)
+        elif solver == 'multisection':
+            # where the platform forks, the workers are forked after the checkpoint and each flies
+            # its angles from there, elsewhere the ascents are flown in this process
+            angle, self.solver_stats = multisection(lambda angle: fly(angle)[1], x0, 0.1, 0.0, 10.0, self.params.workers, xtol=1e-4, ftol=1e-5, max_iterations=self.max_iterations)
+            self.pitchover_angle = angle
+        else:
+            angle, self.solver_stats = solve(lambda angle: fly(angle)[1], x0, 0.1, 0.0, 10.0, solver, xtol=1e-4, ftol=1e-5, max_iterations=self.max_iterations)
+            self.pitchover_angle = angle
+
+        # evaluations counts the ascents flown, repeats those served from memory
+        self.solver_stats['evaluations'] -= fly.hits
+        self.solver_stats['repeats'] = fly.hits
+
+        print("Pitchover: %.4f, solver: %s, ascents: %i, repeats: %i, time: %.2f s, converged: %r" % \
+            (self.pitchover_angle, solver, self.solver_stats['evaluations'], fly.hits, self.solver_stats['time'], self.solver_stats['converged']))
+
+        if cache is not None:
+            cache.put('pitchover', self.params, {'pitchover_angle': self.pitchover_angle, 'error': self.solver_stats['error'], 'converged': self.solver_stats['converged']}, **inputs)
+
+        simulation.restore(snapshot)
+
+
+
+
+    def optimize_pitchover_pi(self, fly):
+        ''' Proportional-integral loop on the pitchover error, returning solver statistics. '''
+
+        start                    = time.time()
         count                    = 0
         gain                     = 0.15
         tau_i                    = 0.01
@@ -72,73 +147,104 @@ class Trajectory(object):
 
         while abs(error) > math.pi * 0.5 * 0.001:
 
-            rocket               = copy.deepcopy(self.rocket)
-            simulation           = Simulation(rocket, self)
-            simulation.run_simulation()
+            error                = fly(self.pitchover_angle)[0]
+
+            self.pitchover_angle += gain * error + tau_i * integral_error
+            self.pitchover_angle = constrain(self.pitchover_angle, 0.0, 10.0)
+
+            count += 1
 
-            k                    = keplerian_elements(rocket.position, rocket.velocity)
-            apogee               = k[0]
-            perigee              = k[1]
-            peri_norm            = normalize(perigee, 0, target_perigee)
-            apo_norm             = normalize(apogee, 0.0, target_apogee)
-            apo_norm             = constrain(apo_norm, 0.0, 1.0)
-            alt_norm             = normalize(rocket.position.magnitude(), 0.0, injection)
+            if count > self.max_iterations:
+                break
 
-            # get the final injection angle
-            horizontal           = math.pi * 0.5
-            injection_angle      = simulation.rocket.position.angle(simulation.rocket.velocity)
-            diff                 = horizontal - injection_angle                 # begins at 1.57 radian, approaches 0 when horizontal, goes negative if losing altitude
-            diff_norm            = normalize(diff, 0.0, math.pi * 0.5)
+        return {'method': 'pi', 'evaluations': count, 'time': time.time() - start, 'error': error, 'converged': abs(error) <= math.pi * 0.5 * 0.001}
 
 
-            # if the rocket's injection altitude is greater than 130km, continue increasing the pitchover angle
-            # so that it approaches a tangential injection angle
-            if alt_norm >= 1.0:
 
-                if apo_norm < 1.0:
-                    error = -diff_norm
-                else:
-                    error = diff_norm
 
-            # if the rocket's injection altitude is below 130km, this could be for a number of reasons
+    def calc_pitchover_error(self, rocket):
+        ''' Returns the pitchover error of a flown rocket, positive when the pitchover angle
+            should increase, and the injection angle error it is built from, which is
+            positive while the rocket still climbs at injection.
+        '''
+
+        injection                = orbital.utilities.radius_from_altitude( copy.copy(self.params.injection)*1000, body=orbital.earth)
+        target_perigee           = injection
+        target_apogee            = orbital.utilities.radius_from_altitude( copy.copy(self.params.apogee)*1000, body=orbital.earth)
+
+        k                        = keplerian_elements(rocket.position, rocket.velocity)
+        apogee                   = k[0]
+        perigee                  = k[1]
+        peri_norm                = normalize(perigee, 0, target_perigee)
+        apo_norm                 = normalize(apogee, 0.0, target_apogee)
+        apo_norm                 = constrain(apo_norm, 0.0, 1.0)
+        alt_norm                 = normalize(rocket.position.magnitude(), 0.0, injection)
+
+        # get the final injection angle
+        horizontal               = math.pi * 0.5
+        injection_angle          = rocket.position.angle(rocket.velocity)
+        diff                     = horizontal - injection_angle                 # begins at 1.57 radian, approaches 0 when horizontal, goes negative if losing altitude
+        diff_norm                = normalize(diff, 0.0, math.pi * 0.5)
+
+
+        # if the rocket's injection altitude is greater than 130km, continue increasing the pitchover angle
+        # so that it approaches a tangential injection angle
+        if alt_norm >= 1.0:
+
+            if apo_norm < 1.0:
+                error = -diff_norm
             else:
+                error = diff_norm
 
-                # if the rocket's apogee doesn't reach the target, then the pitchover is too steep
-                if apo_norm < 1.0:
-                    error = -diff_norm
+        # if the rocket's injection altitude is below 130km, this could be for a number of reasons
+        else:
 
-                # if the rocket's apogee reaches the target, then check to see what it's perigee is
-                else:
+            # if the rocket's apogee doesn't reach the target, then the pitchover is too steep
+            if apo_norm < 1.0:
+                error = -diff_norm
 
-                    # if the rocket's normalized perigee is greater than the normalized pitchover angle,
-                    # then the pitchover angle is too steep
-                    if peri_norm > diff_norm:
-                        error = -diff_norm
+            # if the rocket's apogee reaches the target, then check to see what it's perigee is
+            else:
 
-                    # if the normalized pitchover angle is greater than the normalized perigee,
-                    # then increasing the pitchover angle will raise the apogee
-                    else:
-                        error = diff_norm
+                # if the rocket's normalized perigee is greater than the normalized pitchover angle,
+                # then the pitchover angle is too steep
+                if peri_norm > diff_norm:
+                    error = -diff_norm
+
+                # if the normalized pitchover angle is greater than the normalized perigee,
+                # then increasing the pitchover angle will raise the apogee
+                else:
+                    error = diff_norm
 
+        perigee                  = orbital.utilities.altitude_from_radius(perigee, body=orbital.earth)
+        apogee                   = orbital.utilities.altitude_from_radius(apogee, body=orbital.earth)
 
-            self.pitchover_angle += gain * error + tau_i * integral_error
-            self.pitchover_angle = constrain(self.pitchover_angle, 0.0, 10.0)
+        print("Error: %.4f, Pitchover: %.4f, apogee: %.2f, perigee: %.2f, altitude: %.2f, angle: %.4f" % \
+            (error, self.pitchover_angle, apogee, perigee, rocket.altitude, injection_angle))
 
-            perigee                         = orbital.utilities.altitude_from_radius(perigee, body=orbital.earth)
-            apogee                          = orbital.utilities.altitude_from_radius(apogee, body=orbital.earth)
+        return error, diff_norm
 
-            print("Error: %.2f, Pitchover: %.2f, apogee: %.2f, perigee: %.2f, altitude: %.2f, angle: %.2f" % \
-                (error, self.pitchover_angle, apogee, perigee, rocket.altitude, injection_angle))
 
-            count += 1
 
-            if count > self.max_iterations:
-                break
 
+    def simulate(self, cache=False):
+        ''' Flies the mission and returns the propellant left over the payload if the rocket
+            reaches orbit, or the payload and the velocity it is short of orbit by if not.
 
+            Arguments:
+                cache: take the result from Params.cache if it holds one for this rocket and
+                    trajectory, in which case the rocket is not flown, and its simulation,
+                    flight recorder and output are left as they were. Only callers that need
+                    the result alone, like the optimizers, pass True.
+        '''
 
+        cache                    = get_cache(self.params) if cache else None
+        inputs                   = {'payload': self.rocket.payload, 'pitchover_angle': self.pitchover_angle, 'coast_time': self.coast_time}
 
-    def simulate(self):
+        if cache is not None:
+            result               = cache.get('simulate', self.params, **inputs)
+            if result is not None:
+                return result
 
         self.simulation          = Simulation(self.rocket, self)
 
@@ -159,4 +265,7 @@ class Trajectory(object):
             dv_remaining         = self.simulation.injection.velocity_perigee - self.rocket.velocity.magnitude()
             result               = self.rocket.payload + dv_remaining
 
+        if cache is not None:
+            cache.put('simulate', self.params, result, **inputs)
+
         return result
@@ -1,81 +1,115 @@
 import math
+import numpy as np
 
 
 class Vector3D(object):
+    ''' Three dimensional vector. The components are held in slots and every in-place
+        operation updates them directly; the operations that return a vector take an
+        optional out= vector to write the result into instead of allocating one.
+    '''
 
-    def __init__(self, points = [0.0, 0.0, 0.0]):
-        self.points = points
-        self.x      = self.points[0]
-        self.y      = self.points[1]
-        self.z      = self.points[2]
+    __slots__ = ('x', 'y', 'z')
 
+    def __init__(self, points=None):
+        if points is None:
+            self.x, self.y, self.z = 0.0, 0.0, 0.0
+        else:
+            self.x, self.y, self.z = points
+
+
+    @property
+    def points(self):
+        return [self.x, self.y, self.z]
+
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+        yield self.z
+
+
+    def __repr__(self):
+        return 'Vector3D(%r)' % self.points
 
-    def sum(self, vector):
-        new = [x+y for x, y in zip(self.points, vector.points)]
-        return Vector3D(new)
 
+    def sum(self, vector, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
+        out.x, out.y, out.z = self.x + vector.x, self.y + vector.y, self.z + vector.z
+        return out
 
-    def difference(self, vector):
-        new = [x-y for x, y in zip(self.points, vector.points)]
-        return Vector3D(new)
+
+    def difference(self, vector, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
+        out.x, out.y, out.z = self.x - vector.x, self.y - vector.y, self.z - vector.z
+        return out
 
 
     def add(self, vector):
-        for i, x in enumerate(vector.points):
-            self.points[i] += x
-        self.__init__(self.points)
+        self.x += vector.x
+        self.y += vector.y
+        self.z += vector.z
 
 
     def subtract(self, vector):
-        for i, x in enumerate(vector.points):
-            self.points[i] -= x
-        self.__init__(self.points)
+        self.x -= vector.x
+        self.y -= vector.y
+        self.z -= vector.z
 
 
     def scale(self, scalar):
-        for x in range(len(self.points)):
-            self.points[x] *= scalar
-        self.__init__(self.points)
+        self.x *= scalar
+        self.y *= scalar
+        self.z *= scalar
 
 
     def divide(self, scalar):
-        for x in range(len(self.points)):
-            self.points[x] /= scalar
-        self.__init__(self.points)
+        self.x /= scalar
+        self.y /= scalar
+        self.z /= scalar
+
+
+    def add_scaled(self, vector, scalar):
+        self.x += vector.x * scalar
+        self.y += vector.y * scalar
+        self.z += vector.z * scalar
 
 
     def dot(self, vector):
-        new = sum([x*y for x, y in zip(self.points, vector.points)])
-        return new
+        return self.x * vector.x + self.y * vector.y + self.z * vector.z
 
 
-    def cross(self, vector):
-        x = self.y * vector.z - self.z * vector.y
-        y = self.z * vector.x - self.x * vector.z
-        z = self.x * vector.y - self.y * vector.x
-        return Vector3D([x,y,z])
+    def cross(self, vector, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
+        out.x, out.y, out.z = self.y * vector.z - self.z * vector.y, \
+                              self.z * vector.x - self.x * vector.z, \
+                              self.x * vector.y - self.y * vector.x
+        return out
 
 
-    def copy(self):
-        return Vector3D(list(self.points))
+    def copy(self, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
+        out.x, out.y, out.z = self.x, self.y, self.z
+        return out
 
 
     def magnitude(self):
         return math.sqrt(self.x**2 + self.y**2 + self.z**2)
 
 
-    def unit(self):
+    def unit(self, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
         m = self.magnitude()
         if m == 0:
-            new = [0, 0, 0]
+            out.x, out.y, out.z = 0, 0, 0
         else:
-            new = [1/m * self.x, 1/m * self.y, 1/m * self.z]
-        return Vector3D(new)
+            out.x, out.y, out.z = 1/m * self.x, 1/m * self.y, 1/m * self.z
+        return out
 
 
-    def inverse(self):
-        new = [-1 * x for x in self.points]
-        return Vector3D(new)
+    def inverse(self, out=None):
+        out = out if out is not None else Vector3D.__new__(Vector3D)
+        out.x, out.y, out.z = -self.x, -self.y, -self.z
+        return out
 
 
     def angle(self, vector):
@@ -93,4 +127,296 @@ class Vector3D(object):
 
 
     def update(self, array):
-        self.__init__(array)
+        self.x, self.y, self.z = array
+
+
+
+
+class Vector3DArray(object):
+    ''' N three dimensional vectors held as the rows of an (N, 3) float64 array, so that
+        operations over a whole trajectory run as single NumPy calls. Reductions such as
+        dot, magnitude and angle return (N,) arrays; the rest return a new Vector3DArray.
+    '''
+
+    def __init__(self, points):
+        self.points = np.array(points, dtype=float).reshape(-1, 3)
+
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        return cls([v.points for v in vectors])
+
+
+    @property
+    def x(self):
+        return self.points[:, 0]
+
+
+    @property
+    def y(self):
+        return self.points[:, 1]
+
+
+    @property
+    def z(self):
+        return self.points[:, 2]
+
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Vector3D(self.points[index].tolist())
+        return Vector3DArray(self.points[index])
+
+
+    def __repr__(self):
+        return 'Vector3DArray(%r)' % self.points
+
+
+    def sum(self, vectors):
+        return Vector3DArray(self.points + _rows(vectors))
+
+
+    def difference(self, vectors):
+        return Vector3DArray(self.points - _rows(vectors))
+
+
+    def scale(self, scalar):
+        ''' Scales every vector in place by a scalar or an (N,) array of scalars. '''
+        self.points *= np.reshape(scalar, (-1, 1))
+
+
+    def dot(self, vectors):
+        return np.einsum('ij,ij->i', self.points, np.broadcast_to(_rows(vectors), self.points.shape))
+
+
+    def cross(self, vectors):
+        return Vector3DArray(_cross(self.points, _rows(vectors)))
+
+
+    def magnitude(self):
+        return np.sqrt(np.einsum('ij,ij->i', self.points, self.points))
+
+
+    def unit(self):
+        m = self.magnitude()[:, None]
+        return Vector3DArray(np.divide(self.points, m, out=np.zeros_like(self.points), where=m != 0))
+
+
+    def inverse(self):
+        return Vector3DArray(-self.points)
+
+
+    def angle(self, vectors):
+        other = np.broadcast_to(_rows(vectors), self.points.shape)
+        m2    = np.sqrt(np.einsum('ij,ij->i', other, other))
+        return np.arccos(np.clip(self.dot(other) / (self.magnitude() * m2), -1.0, 1.0))
+
+
+    def rotate_Z(self, theta):
+        ''' Rotates every vector about the z axis by theta [rad], a scalar or an (N,) array. '''
+
+        c       = np.cos(theta)
+        s       = np.sin(theta)
+        x, y, z = self.points.T
+
+        return Vector3DArray(np.column_stack((x * c - y * s, x * s + y * c, z)))
+
+
+    def rotate(self, axes, angles):
+        ''' Rotates every vector about a unit axis by an angle [rad], Rodrigues' formula as in
+            keplerian.rotate. Axes and angles are one per vector, or shared by all of them.
+        '''
+
+        axes    = np.broadcast_to(_rows(axes), self.points.shape)
+        c       = np.reshape(np.cos(angles), (-1, 1))
+        s       = np.reshape(np.sin(angles), (-1, 1))
+        k_cross = _cross(axes, self.points)
+        k_dot   = np.einsum('ij,ij->i', axes, self.points)[:, None]
+
+        return Vector3DArray(self.points * c + k_cross * s + axes * k_dot * (1 - c))
+
+
+    def get_lat_lon(self):
+        ''' Converts ECEF positions to geodetic coordinates, as Earth.get_lat_lon does for one vector.
+
+            Returns:
+                latitude [rad], longitude [rad] and height above the ellipsoid [m], each an (N,) array.
+        '''
+
+        from earth import Earth
+
+        x, y, z = self.points.T
+        a       = Earth.radius_equator
+        b       = Earth.radius_poles
+        p       = np.hypot(x, y)
+
+        lon     = np.arctan2(y, x)
+        theta   = np.arctan2(z * a, p * b)
+
+        num     = z + Earth.e_prime**2 * b * np.sin(theta)**3
+        den     = p - Earth.e**2 * a * np.cos(theta)**3
+        lat     = np.arctan2(num, den)
+
+        N       = a / np.sqrt(1 - Earth.e**2 * np.sin(lat)**2)
+        h       = p / np.cos(lat) - N
+
+        return lat, lon, h
+
+
+    @classmethod
+    def from_lat_lon(cls, lat, lon, alt):
+        ''' Converts geodetic coordinates to ECEF positions, as Earth.get_cartesian does for one point.
+
+            Arguments:
+                lat: latitude [deg], lon: longitude [deg], alt: height above the ellipsoid [m];
+                    scalars or (N,) arrays.
+        '''
+
+        from earth import Earth
+
+        lat     = np.radians(lat)
+        lon     = np.radians(lon)
+        a       = Earth.radius_equator
+        b       = Earth.radius_poles
+
+        N       = a / np.sqrt(1 - Earth.e**2 * np.sin(lat)**2)
+
+        x       = (N + alt) * np.cos(lat) * np.cos(lon)
+        y       = (N + alt) * np.cos(lat) * np.sin(lon)
+        z       = ((b**2/a**2) * N + alt) * np.sin(lat)
+
+        return cls(np.column_stack(np.broadcast_arrays(x, y, z)))
+
+
+
+
+def _cross(a, b):
+    ''' Row-wise cross product, written out as np.cross carries a large overhead on short arrays. '''
+
+    ax, ay, az = a[..., 0], a[..., 1], a[..., 2]
+    bx, by, bz = b[..., 0], b[..., 1], b[..., 2]
+
+    return np.stack((ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx), axis=-1)
+
+
+
+
+def _rows(vectors):
+    ''' Returns the (N, 3) or (3,) array behind a Vector3DArray, a Vector3D or a sequence. '''
+
+    if isinstance(vectors, Vector3DArray):
+        return vectors.points
+    if isinstance(vectors, Vector3D):
+        return np.array(vectors.points)
+    return np.asarray(vectors, dtype=float)
+
+
+
+
+if __name__ == '__main__':
+
+    import timeit
+
+    class ListVector3D(object):
+        ''' The list backed Vector3D this class replaced, with the operations calc_accel used. '''
+
+        def __init__(self, points = [0.0, 0.0, 0.0]):
+            self.points = points
+            self.x      = self.points[0]
+            self.y      = self.points[1]
+            self.z      = self.points[2]
+
+        def add(self, vector):
+            for i, x in enumerate(vector.points):
+                self.points[i] += x
+            self.__init__(self.points)
+
+        def scale(self, scalar):
+            for x in range(len(self.points)):
+                self.points[x] *= scalar
+            self.__init__(self.points)
+
+        def magnitude(self):
+            return math.sqrt(self.x**2 + self.y**2 + self.z**2)
+
+        def unit(self):
+            m = self.magnitude()
+            if m == 0:
+                new = [0, 0, 0]
+            else:
+                new = [1/m * self.x, 1/m * self.y, 1/m * self.z]
+            return ListVector3D(new)
+
+        def inverse(self):
+            new = [-1 * x for x in self.points]
+            return ListVector3D(new)
+
+    # thrust + drag + gravity the way calc_accel summed them before, one list backed vector per term
+    old_position    = ListVector3D([6478137.0, 0.0, 0.0])
+    old_velocity    = ListVector3D([0.0, 7800.0, 0.0])
+    old_orientation = ListVector3D([0.1, 1.0, 0.0])
+
+    def accel_before():
+        accel = old_orientation.unit()
+        accel.scale(20.0)
+        drag = old_velocity.unit().inverse()
+        drag.scale(0.5)
+        gravity = old_position.unit().inverse()
+        gravity.scale(9.5)
+        acceleration = ListVector3D([0,0,0])
+        acceleration.add(accel)
+        acceleration.add(drag)
+        acceleration.add(gravity)
+        return acceleration
+
+    # the same sum with slotted vectors, accumulated in place into the thrust vector as calc_accel does now
+    position    = Vector3D([6478137.0, 0.0, 0.0])
+    velocity    = Vector3D([0.0, 7800.0, 0.0])
+    orientation = Vector3D([0.1, 1.0, 0.0])
+    scratch     = Vector3D()
+
+    def accel_after():
+        acceleration = orientation.unit()
+        acceleration.scale(20.0)
+        acceleration.add_scaled(velocity.unit(out=scratch), -0.5)
+        acceleration.add_scaled(position.unit(out=scratch), -9.5)
+        return acceleration
+
+    assert accel_before().points == accel_after().points
+
+    # time each step, then count every vector it allocates, whether constructed or returned by an operation
+    allocations = [0]
+
+    def counting_new(cls, *args):
+        allocations[0] += 1
+        return object.__new__(cls)
+
+    for name, f, cls in [('before', accel_before, ListVector3D), ('after', accel_after, Vector3D)]:
+        t               = min(timeit.repeat(f, number=100000, repeat=5)) / 100000
+        cls.__new__     = staticmethod(counting_new)
+        allocations[0]  = 0
+        f()
+        print('%-6s | %i vectors per step | %.2f us per step' % (name, allocations[0], t * 1e6))
+
+
+    # geodetic conversion of a whole trajectory at once against one vector at a time
+    from earth import Earth
+
+    samples     = 50000
+    track       = Vector3DArray.from_lat_lon(np.linspace(-80, 80, samples), np.linspace(-180, 180, samples), np.linspace(0, 500e3, samples))
+    track       = track.rotate_Z(np.linspace(0, 0.1, samples))
+
+    t           = timeit.default_timer()
+    loop        = np.array([Earth.get_lat_lon(track[i]) for i in range(samples)])
+    t_loop      = timeit.default_timer() - t
+
+    t           = timeit.default_timer()
+    lat, lon, h = track.get_lat_lon()
+    t_array     = timeit.default_timer() - t
+
+    error       = np.max(np.abs(loop - np.column_stack((lat, lon, h))), axis=0)
+    print('get_lat_lon x %i | loop %.1f ms | array %.1f ms | max difference %.1e rad %.1e rad %.1e m' % (samples, t_loop * 1e3, t_array * 1e3, *error))
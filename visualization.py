@@ -2,7 +2,7 @@ import math
 from earth      import Earth
 from params     import Params
 from functions  import normalize
-from vector3d   import Vector3D
+from vector3d   import Vector3D, Vector3DArray
 
 
 
@@ -46,9 +46,7 @@ class Render3D(object):
         vp.scene.camera.follow(start)
 
         c                  = vp.curve(radius=3000.0, color=vp.color.yellow)
-
-        for d in self.data:
-            c.append(vp.vector(d[5], d[6], d[4]))
+        c.append([vp.vector(x, y, z) for x, y, z in data.iloc[:, [5, 6, 4]].values.tolist()])
 
 
 
@@ -69,14 +67,15 @@ class Render3D(object):
         label_altitude     = vp.label( pixel_pos=True, pos=vp.vector(vp.scene.width - 180,vp.scene.height - 120,0), text='Altitude',  box=False, align='left')
         label_downrange    = vp.label( pixel_pos=True, pos=vp.vector(vp.scene.width - 180,vp.scene.height - 140,0), text='Downrange', box=False, align='left')
 
+        # the speed of every frame at once
+        speeds             = Vector3DArray(data.iloc[:, [10, 11, 12]].values).magnitude()
 
         for i in range(len(data)):
             vp.rate(100)
             c.pos          = vp.vector(data.loc[i][5],  data.loc[i][6],  data.loc[i][4])
             s.pos          = vp.vector(data.loc[i][14], data.loc[i][15], data.loc[i][13])
             elapsed        = 'Elapsed    '  + str(round(data.loc[i][0])) + ' s'
-            v              = Vector3D([data.loc[i][10], data.loc[i][11], data.loc[i][12]]).magnitude()
-            velocity       = 'Velocity    ' + str(round(v)) + ' m/s'
+            velocity       = 'Velocity    ' + str(round(speeds[i])) + ' m/s'
             # a              = Vector3D([data.loc[i][7], data.loc[i][8], data.loc[i][9]]).magnitude()
             altitude       = 'Altitude    ' + str(round(data.loc[i][20] * 0.001, 1)) + ' km'
             downrange      = 'Downrange     ' + str(round(data.loc[i][21] * 0.001, 1)) + ' km'